@@ -0,0 +1,56 @@
+# What authentication costs per request, with and without the auth cache: JWT verification
+# plus loading the user and their roles, measured on authenticate() alone and on a whole
+# profile request. "No cache" is what the default per-process cache gets. No Redis here, so
+# the shared cache is stood in for by this process's locmem cache (the lower bound: a real
+# one adds a network round trip) and by DatabaseCache, a shared backend that needs no server.
+from .common import bearer, make_driver, report, test_database, time_calls
+from contextlib import ExitStack, contextmanager
+from unittest import mock
+from django.core.cache.backends.db import DatabaseCache
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from users import authentication
+
+CALLS = 5_000
+CACHE_TABLE = 'bench_auth_cache'
+
+@contextmanager
+def auth_cache(shared, cache=None):
+    with ExitStack() as stack:
+        stack.enter_context(mock.patch.object(authentication, 'AUTH_CACHE_SHARED', shared))
+        if cache is not None:
+            stack.enter_context(mock.patch.object(authentication, 'auth_cache', cache))
+        authentication.auth_cache.clear()
+        yield
+
+def main():
+    with test_database():
+        call_command('createcachetable', CACHE_TABLE, verbosity=0)
+        driver = make_driver('driver', 51.5, -0.1)
+        token = bearer(driver.user)
+        request = RequestFactory().get('/api/users/profile/', HTTP_AUTHORIZATION=token)
+        authenticator = authentication.CachedJWTAuthentication()
+        client = Client()
+        
+        def profile():
+            response = client.get('/api/users/profile/', HTTP_AUTHORIZATION=token)
+            assert response.status_code == 200, response.content
+        
+        modes = [
+            ('no cache', dict(shared=False)),
+            ('shared cache (locmem stand-in)', dict(shared=True)),
+            ('shared cache (DatabaseCache)', dict(shared=True, cache=DatabaseCache(CACHE_TABLE, {}))),
+        ]
+        for label, options in modes:
+            with auth_cache(**options):
+                user, _ = authenticator.authenticate(request)
+                assert user.driver.id == driver.id
+                with CaptureQueriesContext(connection) as queries:
+                    authenticator.authenticate(request)
+                report(f'{label}: authenticate() with {len(queries)} queries', time_calls(lambda: authenticator.authenticate(request), CALLS))
+                report(f'{label}: GET /api/users/profile/', time_calls(profile, CALLS))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+# Shared setup for the scripts in this package. Run them from the project root,
+# e.g. `python -m benchmarks.grid_index`; anything that needs the database gets a
+# throwaway test database, so the configured one is never touched.
+import os
+import statistics
+import time
+from contextlib import contextmanager
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'riderapp.settings')
+django.setup()
+
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from riderapp.testing import bearer, make_driver, make_passenger, make_ride, make_user  # noqa: F401 (re-exported)
+
+@contextmanager
+def test_database():
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def time_calls(func, calls):
+    # Per-call wall time in milliseconds
+    samples = []
+    for _ in range(calls):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+def report(title, samples):
+    print(
+        f'{title}: mean {statistics.mean(samples):.3f} ms, p50 {percentile(samples, 50):.3f} ms, '
+        f'p99 {percentile(samples, 99):.3f} ms ({len(samples)} calls)'
+    )
@@ -0,0 +1,47 @@
+# Matching 1,000 open rides to 1,000 idle drivers spread over central London: the exact
+# solver against the greedy fallback, and against offering each ride in request order to
+# the nearest free driver. Reports solve time, rides matched and total pickup distance.
+from .common import report, time_calls
+import numpy as np
+from django.conf import settings
+from rides.dispatch import greedy_assignment, haversine_matrix_km, solve_assignment
+
+RIDES = 1_000
+DRIVERS = 1_000
+CALLS = 5
+
+def in_request_order(cost, feasible):
+    cost = np.where(feasible, cost, np.inf)
+    rows, cols = [], []
+    for row in range(cost.shape[0]):
+        col = int(np.argmin(cost[row]))
+        if np.isfinite(cost[row, col]):
+            rows.append(row)
+            cols.append(col)
+            cost[:, col] = np.inf
+    return np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp)
+
+def main():
+    rng = np.random.default_rng(1)
+    # 0.2 x 0.3 degrees, about 22 x 21 km: one dispatch region and its neighbours
+    ride_lat, ride_lng = 51.4 + rng.random(RIDES) * 0.2, -0.25 + rng.random(RIDES) * 0.3
+    driver_lat, driver_lng = 51.4 + rng.random(DRIVERS) * 0.2, -0.25 + rng.random(DRIVERS) * 0.3
+    cost = haversine_matrix_km(ride_lat, ride_lng, driver_lat, driver_lng) * settings.DISTANCE_ROAD_FACTOR
+    feasible = cost <= settings.DISPATCH_MAX_PICKUP_KM
+    
+    solvers = [
+        ('exact', lambda: solve_assignment(cost, feasible, exact_max_pairs=cost.size)),
+        ('greedy', lambda: greedy_assignment(cost, feasible)),
+        ('nearest free driver in request order', lambda: in_request_order(cost, feasible)),
+    ]
+    print(f'{RIDES:,} rides x {DRIVERS:,} drivers, pickups up to {settings.DISPATCH_MAX_PICKUP_KM} km')
+    for label, solve in solvers:
+        rows, cols = solve()
+        assert len(set(rows.tolist())) == len(rows) and len(set(cols.tolist())) == len(cols)
+        assert feasible[rows, cols].all()
+        report(f'{label} solve', time_calls(solve, CALLS))
+        pickup_km = cost[rows, cols]
+        print(f'  {len(rows):,} matched, pickup {pickup_km.sum():,.0f} km in total, mean {pickup_km.mean():.2f} km, max {pickup_km.max():.2f} km')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+# Batch fare calculation against the scalar calculate_fare loop at 1M rides,
+# with 100k fares placed next to half-penny boundaries. Results must match the
+# scalar path exactly before anything is timed.
+from . import common  # noqa: F401 (configures Django)
+import time
+import numpy as np
+from rides.services import FareCalculationStrategy
+
+RIDES = 1_000_000
+
+def timed(func):
+    started = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - started
+
+def main():
+    calculator = FareCalculationStrategy()
+    rng = np.random.default_rng(0)
+    distances = rng.random(RIDES) * 40
+    distances[:100_000] = np.round(rng.random(100_000) * 4000) / 1000 + 0.0025
+    ride_types = rng.choice(['STANDARD', 'POOL', 'LUXURY'], RIDES)
+    surges = np.round(1 + rng.random(RIDES) * 2, 1)
+    as_lists = distances.tolist(), ride_types.tolist(), surges.tolist()
+    
+    scalar, scalar_seconds = timed(lambda: [calculator.calculate_fare(*trip) for trip in zip(*as_lists)])
+    print(f'calculate_fare loop: {scalar_seconds:.2f} s')
+    expected_cents = [int(fare.scaleb(2)) for fare in scalar]
+    
+    for label, inputs in (('arrays', (distances, ride_types, surges)), ('lists', as_lists)):
+        cents, seconds = timed(lambda: calculator.calculate_fares_in_cents(*inputs))
+        assert cents.tolist() == expected_cents
+        print(f'calculate_fares_in_cents from {label}: {seconds:.3f} s ({scalar_seconds / seconds:.0f}x)')
+        fares, seconds = timed(lambda: calculator.calculate_fares(*inputs))
+        assert fares == scalar
+        print(f'calculate_fares from {label}: {seconds:.3f} s ({scalar_seconds / seconds:.0f}x)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+# Nearest-driver lookups against DriverLocationIndex with 100k drivers spread
+# over Greater London, checked against a brute-force scan before timing.
+import random
+from .common import report, time_calls
+from rides.geo import DriverLocationIndex, haversine_km
+
+DRIVERS = 100_000
+CALLS = 5_000
+BOUNDS = (51.3, 51.7, -0.5, 0.2)
+
+def random_point(rng):
+    min_lat, max_lat, min_lng, max_lng = BOUNDS
+    return rng.uniform(min_lat, max_lat), rng.uniform(min_lng, max_lng)
+
+def main():
+    rng = random.Random(1)
+    index = DriverLocationIndex(max_age=float('inf'))
+    positions = {}
+    for driver_id in range(DRIVERS):
+        positions[driver_id] = random_point(rng)
+        index.update(driver_id, *positions[driver_id])
+    
+    for _ in range(20):
+        latitude, longitude = random_point(rng)
+        expected = sorted(
+            (haversine_km(latitude, longitude, lat, lng), driver_id)
+            for driver_id, (lat, lng) in positions.items()
+        )[:5]
+        assert index.nearest(latitude, longitude, 10, 5) == [pair for pair in expected if pair[0] <= 10]
+    
+    queries = [random_point(rng) for _ in range(CALLS)]
+    for radius_km, limit in ((2, 5), (10, 5), (10, 20)):
+        lookups = iter(queries)
+        samples = time_calls(lambda: index.nearest(*next(lookups), radius_km, limit), CALLS)
+        report(f'nearest {limit} within {radius_km} km, {DRIVERS} drivers', samples)
+    
+    # A pickup with nobody nearby has to give up after scanning the whole radius
+    samples = time_calls(lambda: index.nearest(52.5, -0.1, 10, 5), CALLS)
+    report('nearest 5 within 10 km, no drivers nearby', samples)
+
+if __name__ == '__main__':
+    main()
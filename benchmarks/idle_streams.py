@@ -0,0 +1,96 @@
+# Holds 10k idle offer streams open through the ASGI application, the way uvicorn
+# would, then publishes one offer that every stream should receive. Reports the
+# memory held per idle subscriber and the fan-out time.
+from .common import make_driver, test_database
+import asyncio
+import threading
+import time
+import tracemalloc
+from riderapp.asgi import application as asgi_application
+from rides.push import push_hub
+from rides.views import StreamToken
+
+SUBSCRIBERS = 10_000
+OPEN_BATCH = 500
+
+class StreamClient:
+    # One connected EventSource: sends the request, then never disconnects
+    def __init__(self, application, path, query_string):
+        self.scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+            'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'root_path': '',
+            'query_string': query_string.encode(), 'headers': [(b'host', b'testserver')],
+            'server': ('testserver', 80), 'client': ('127.0.0.1', 50000),
+        }
+        self.application = application
+        self.status = None
+        self.opened = asyncio.Event()
+        self.received = None
+        self._request_sent = False
+    
+    async def receive(self):
+        if not self._request_sent:
+            self._request_sent = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        await asyncio.Future()
+    
+    async def send(self, message):
+        if message['type'] == 'http.response.start':
+            self.status = message['status']
+        elif message.get('body', b'').startswith(b'event: offer'):
+            self.received.set_result(None)
+        elif message.get('body', b'').startswith(b'retry:'):
+            # Sent as soon as the stream is subscribed
+            self.opened.set()
+    
+    def start(self):
+        self.received = asyncio.get_running_loop().create_future()
+        return asyncio.ensure_future(self.application(self.scope, self.receive, self.send))
+
+async def run(application, user):
+    # Every client fetches its own stream token, as browsers would
+    def new_client():
+        return StreamClient(application, '/api/rides/available/events/', f'token={StreamToken.for_user(user)}')
+    
+    # The first request imports and builds everything a request needs
+    warm_up = new_client()
+    task = warm_up.start()
+    await warm_up.opened.wait()
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    
+    clients, tasks = [], []
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    for _ in range(0, SUBSCRIBERS, OPEN_BATCH):
+        batch = [new_client() for _ in range(OPEN_BATCH)]
+        tasks += [client.start() for client in batch]
+        await asyncio.gather(*(client.opened.wait() for client in batch))
+        clients += batch
+    opened_in = time.perf_counter() - started
+    assert all(client.status == 200 for client in clients) and len(push_hub) == SUBSCRIBERS
+    await asyncio.sleep(1)
+    held = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    print(f'opened {SUBSCRIBERS} streams in {opened_in:.1f} s')
+    print(f'memory held while idle: {held / 2 ** 20:.1f} MiB, {held / SUBSCRIBERS / 1024:.1f} KiB per subscriber')
+    print(f'threads while idle: {threading.active_count()}')
+    
+    started = time.perf_counter()
+    push_hub.publish_offer(1, 51.5, -0.1, 12)
+    await asyncio.gather(*(client.received for client in clients))
+    print(f'one offer reached all {SUBSCRIBERS} subscribers in {(time.perf_counter() - started) * 1000:.0f} ms')
+    
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    assert len(push_hub) == 0
+
+def main():
+    with test_database():
+        driver = make_driver('driver', 51.5, -0.1)
+        asyncio.run(run(asgi_application, driver.user))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# Driver location pings through the API: a staff gateway relaying batches for a
+# fleet of 1,000 drivers, and one driver sending single pings. The background
+# flusher is replaced by a flush every DRIVER_LOCATION_FLUSH_INTERVAL on this
+# thread, so the database writes can be counted.
+from .common import bearer, make_driver, make_user, test_database
+import random
+import time
+from unittest import mock
+from django.conf import settings
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from users.locations import driver_positions
+from users.models import Driver
+
+DRIVERS = 1_000
+BATCH = 500
+SECONDS = 5
+
+def run(label, send, pings_per_request):
+    driver_positions.flush()
+    rows = statements = requests = 0
+    started = last_flush = time.perf_counter()
+    while time.perf_counter() - started < SECONDS:
+        send()
+        requests += 1
+        if time.perf_counter() - last_flush >= settings.DRIVER_LOCATION_FLUSH_INTERVAL:
+            with CaptureQueriesContext(connection) as queries:
+                rows += driver_positions.flush()
+            statements += len(queries)
+            last_flush = time.perf_counter()
+    seconds = time.perf_counter() - started
+    print(
+        f'{label}: {requests * pings_per_request / seconds:,.0f} pings/sec in {requests / seconds:,.0f} requests/sec; '
+        f'{rows / seconds:,.0f} driver rows/sec written by {statements / seconds:.1f} statements/sec'
+    )
+
+def main():
+    with test_database(), mock.patch.object(driver_positions, '_ensure_flusher'):
+        drivers = [make_driver(f'driver{n}', 51.5, -0.1) for n in range(DRIVERS)]
+        staff = make_user('gateway')
+        staff.is_staff = True
+        staff.save()
+        client = Client()
+        rng = random.Random(1)
+        
+        def relay_batch():
+            pings = [
+                {'driver_id': rng.choice(drivers).id, 'latitude': 51.5 + rng.random() / 10, 'longitude': -0.1 + rng.random() / 10}
+                for _ in range(BATCH)
+            ]
+            response = client.post('/api/users/drivers/locations/', {'pings': pings}, content_type='application/json', HTTP_AUTHORIZATION=bearer(staff))
+            assert response.status_code == 200, response.content
+        
+        driver = drivers[0]
+        token = bearer(driver.user)
+        
+        def single_ping():
+            response = client.put(
+                f'/api/users/drivers/{driver.id}/location/', {'latitude': 51.5 + rng.random() / 10, 'longitude': -0.1},
+                content_type='application/json', HTTP_AUTHORIZATION=token
+            )
+            assert response.status_code == 200, response.content
+        
+        run(f'gateway batches of {BATCH} over {DRIVERS} drivers', relay_batch, BATCH)
+        run('single pings from one driver', single_ping, 1)
+        assert Driver.objects.filter(current_latitude__gt=51.5).exists()
+
+if __name__ == '__main__':
+    main()
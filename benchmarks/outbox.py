@@ -0,0 +1,65 @@
+# Outbox delivery throughput: a backlog of events spread over many rides, drained
+# by OutboxDispatcher into a stand-in sink that only counts, then pruned once
+# past retention. The target is 10k events/sec.
+from .common import make_passenger, test_database
+import threading
+import time
+from datetime import timedelta
+from django.test.utils import override_settings
+from django.utils import timezone
+from rides.models import Location, OutboxEvent, Ride
+from rides.observers import RideObserver, RideSubject
+from rides.outbox import OutboxDispatcher
+
+EVENTS = 100_000
+RIDES = 2_000
+
+class CountingSink(RideObserver):
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+    
+    def update(self, ride, event_type):
+        with self._lock:
+            self.count += 1
+
+def main():
+    with test_database():
+        passenger = make_passenger('passenger')
+        location = Location.objects.create(latitude=51.5, longitude=-0.1, address='1 High St', postcode='SW1A 1AA')
+        rides = Ride.objects.bulk_create(
+            Ride(passenger=passenger, pickup_location=location, dropoff_location=location, fare=10) for _ in range(RIDES)
+        )
+        OutboxEvent.objects.bulk_create(
+            (OutboxEvent(ride=rides[n % RIDES], event_type=OutboxEvent.EventType.RIDE_ACCEPTED) for n in range(EVENTS)),
+            batch_size=5000
+        )
+        
+        sink = CountingSink()
+        subject = RideSubject()
+        subject.attach(sink)
+        dispatcher = OutboxDispatcher(subject=subject)
+        dispatcher.start()
+        started = time.perf_counter()
+        try:
+            while dispatcher.dispatch_batch():
+                pass
+        finally:
+            dispatcher.stop()
+        seconds = time.perf_counter() - started
+        assert sink.count == EVENTS and not OutboxEvent.objects.filter(dispatched_at__isnull=True).exists()
+        print(
+            f'delivered {EVENTS} events in {seconds:.2f} s: {EVENTS / seconds:,.0f} events/sec '
+            f'({dispatcher.workers} workers, batches of {dispatcher.batch_size})'
+        )
+        
+        OutboxEvent.objects.update(dispatched_at=timezone.now() - timedelta(days=30))
+        started = time.perf_counter()
+        with override_settings(OUTBOX_RETENTION_SECONDS=24 * 3600):
+            pruned = dispatcher.prune()
+        seconds = time.perf_counter() - started
+        assert pruned == EVENTS and not OutboxEvent.objects.exists()
+        print(f'pruned {pruned} delivered events in {seconds:.2f} s: {pruned / seconds:,.0f} events/sec')
+
+if __name__ == '__main__':
+    main()
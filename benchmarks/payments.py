@@ -0,0 +1,41 @@
+# Payment worker throughput against the local stand-in provider, which takes
+# PAYMENT_LOCAL_LATENCY (300 ms) per charge like a slow card network: payments charged
+# per second for a backlog of queued card payments, by the number of worker threads.
+from .common import make_passenger, make_ride, test_database
+import time
+from django.conf import settings
+from django.test import override_settings
+from payments.models import Payment
+from payments.services import PaymentProcessor
+from rides.models import Ride
+
+PAYMENTS = 320
+WORKERS = (1, 8, 32)
+
+def main():
+    with test_database(), override_settings(PAYMENT_PROVIDER='local'):
+        passenger = make_passenger('passenger')
+        rides = [make_ride(passenger, status=Ride.RideStatus.COMPLETED) for _ in range(PAYMENTS)]
+        print(f'{PAYMENTS} card payments, {settings.PAYMENT_LOCAL_LATENCY * 1000:.0f} ms per provider call')
+        for workers in WORKERS:
+            Payment.objects.all().delete()
+            # One worker would take minutes over the whole backlog; it gets a sample
+            count = min(PAYMENTS, workers * 20)
+            Payment.objects.bulk_create([
+                Payment(ride=ride, passenger=passenger, amount=ride.fare, payment_type=Payment.PaymentType.CREDIT_CARD)
+                for ride in rides[:count]
+            ])
+            processor = PaymentProcessor(workers=workers, batch_size=max(settings.PAYMENT_BATCH_SIZE, workers))
+            processor.start()
+            try:
+                started = time.perf_counter()
+                while processor.process_batch():
+                    pass
+                seconds = time.perf_counter() - started
+            finally:
+                processor.stop()
+            assert Payment.objects.filter(status=Payment.PaymentStatus.COMPLETED).count() == count
+            print(f'workers={workers}: {count / seconds:.1f} payments/sec ({count} in {seconds:.1f} s)')
+
+if __name__ == '__main__':
+    main()
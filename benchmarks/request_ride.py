@@ -0,0 +1,58 @@
+# POST /api/rides/request/ with a stub Maps client that sleeps on every call.
+# Each request uses new postcodes, so both geocodes miss the cache; the two run
+# concurrently, so p50 should sit near one stub call (plus the distance call
+# when DISTANCE_ENGINE is 'google'), not the sum of all of them.
+from .common import bearer, make_passenger, report, test_database
+import time
+from django.test import Client
+from rides import views
+from rides.distance import FallbackDistanceEngine, GoogleDistanceEngine, HaversineDistanceEngine
+
+CALL_LATENCY = 0.2
+REQUESTS = 30
+
+class StubMapsClient:
+    def geocode(self, postcode):
+        time.sleep(CALL_LATENCY)
+        latitude = 51.55 if postcode.startswith('D') else 51.5
+        return [{'geometry': {'location': {'lat': latitude, 'lng': -0.1}}}]
+    
+    def distance_matrix(self, **kwargs):
+        time.sleep(CALL_LATENCY)
+        return {'rows': [{'elements': [{'distance': {'value': 7300}}]}]}
+
+def run(client, token, label):
+    numbers = iter(range(1_000_000))
+    
+    def request_ride():
+        n = next(numbers)
+        response = client.post('/api/rides/request/', {
+            'pickupAddress': '1 High St', 'pickupPostcode': f'P{label[0]}{n} 1AA',
+            'dropoffAddress': '2 High St', 'dropoffPostcode': f'D{label[0]}{n} 2BB', 'rideType': 'STANDARD'
+        }, content_type='application/json', HTTP_AUTHORIZATION=token)
+        assert response.status_code == 201, response.content
+    
+    request_ride()
+    samples = []
+    for _ in range(REQUESTS):
+        started = time.perf_counter()
+        request_ride()
+        samples.append((time.perf_counter() - started) * 1000)
+    report(f'request_ride, {label}', samples)
+
+def main():
+    with test_database():
+        system = views.ride_system
+        system.maps_service.client = StubMapsClient()
+        client = Client()
+        token = bearer(make_passenger('passenger').user)
+        print(f'stub latency {CALL_LATENCY * 1000:.0f} ms per call')
+        
+        system.distance_engine = HaversineDistanceEngine()
+        run(client, token, 'haversine distance (2 geocodes, sequential sum 400 ms)')
+        
+        system.distance_engine = FallbackDistanceEngine(GoogleDistanceEngine(system.maps_service), HaversineDistanceEngine())
+        run(client, token, 'google distance (2 geocodes + 1 distance, sequential sum 600 ms)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# Storage for 1M location pings: 1,000 drivers sending one ping every 4 s, kept as
+# LocationSegment rows by the trail store, against the same pings stored as one
+# indexed row each. Sizes are the growth of the test database, so they include
+# indexes and page overhead as well as the data itself.
+from .common import make_driver, test_database
+import random
+import time
+from django.db import connection
+from users.models import LocationSegment
+from users.trails import LocationTrailStore, decode_points, to_fixed
+
+DRIVERS = 1_000
+PINGS = 1_000
+INTERVAL = 4
+
+def database_bytes():
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT pg_database_size(current_database())')
+            return cursor.fetchone()[0]
+        cursor.execute('PRAGMA page_count')
+        pages = cursor.fetchone()[0]
+        cursor.execute('PRAGMA page_size')
+        return pages * cursor.fetchone()[0]
+
+def simulate(driver_ids, started):
+    # A drive at 20-50 km/h with GPS jitter on both the position and the ping time
+    rng = random.Random(1)
+    for driver_id in driver_ids:
+        latitude, longitude = 51.3 + rng.random() / 2, -0.4 + rng.random() / 2
+        step_lat, step_lng = rng.uniform(-1, 1) * 3e-4, rng.uniform(-1, 1) * 4e-4
+        for n in range(PINGS):
+            latitude += step_lat + rng.gauss(0, 2e-5)
+            longitude += step_lng + rng.gauss(0, 2e-5)
+            yield driver_id, started + n * INTERVAL + rng.uniform(0, 0.25), latitude, longitude
+
+def main():
+    with test_database():
+        driver_ids = [make_driver(f'driver{n}').id for n in range(DRIVERS)]
+        started = time.time() - PINGS * INTERVAL
+        pings = DRIVERS * PINGS
+        
+        store = LocationTrailStore()
+        before = database_bytes()
+        for ping in simulate(driver_ids, started):
+            store.append(*ping)
+        store.flush(force=True)
+        segments = database_bytes() - before
+        payload = sum(len(data) for data in LocationSegment.objects.values_list('data', flat=True))
+        rows = LocationSegment.objects.count()
+        # The stored points are exactly the fixed-point pings that went in
+        stored = sorted(point for data in LocationSegment.objects.filter(driver_id=driver_ids[0]).values_list('data', flat=True) for point in decode_points(data))
+        assert stored == [to_fixed(*ping[1:]) for ping in simulate(driver_ids[:1], started)]
+        
+        before = database_bytes()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE TABLE bench_location_ping (id bigint PRIMARY KEY, driver_id bigint NOT NULL, '
+                'recorded_at timestamp NOT NULL, latitude double precision NOT NULL, longitude double precision NOT NULL)'
+            )
+            cursor.execute('CREATE INDEX bench_location_ping_driver_idx ON bench_location_ping (driver_id, recorded_at)')
+            cursor.executemany(
+                'INSERT INTO bench_location_ping VALUES (%s, %s, %s, %s, %s)',
+                [
+                    (n, driver_id, time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp)), latitude, longitude)
+                    for n, (driver_id, timestamp, latitude, longitude) in enumerate(simulate(driver_ids, started))
+                ]
+            )
+        per_ping = database_bytes() - before
+        
+        print(f'{pings:,} pings from {DRIVERS:,} drivers, one every {INTERVAL} s')
+        print(
+            f'trail segments: {segments / 2**20:.1f} MiB ({segments / pings:.1f} bytes/ping) in {rows:,} rows; '
+            f'encoded data {payload / 2**20:.1f} MiB ({payload / pings:.1f} bytes/ping)'
+        )
+        print(f'one row per ping: {per_ping / 2**20:.1f} MiB ({per_ping / pings:.1f} bytes/ping), {per_ping / segments:.1f}x the segments')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from payments.services import PaymentProcessor
+
+class Command(BaseCommand):
+    help = 'Charge pending payments through the payment provider, retrying failures with backoff'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, help='Concurrent provider calls (default PAYMENT_WORKERS)')
+        parser.add_argument('--batch-size', type=int, help='Payments claimed per batch (default PAYMENT_BATCH_SIZE)')
+        parser.add_argument('--once', action='store_true', help='Process the payments due now and exit')
+    
+    def handle(self, *args, **options):
+        processor = PaymentProcessor(workers=options['workers'], batch_size=options['batch_size'])
+        processor.start()
+        try:
+            while True:
+                claimed = processor.process_batch()
+                if claimed:
+                    self.stdout.write(f'Processed {claimed} payment(s)')
+                    continue
+                if options['once']:
+                    return
+                time.sleep(settings.PAYMENT_POLL_INTERVAL)
+        finally:
+            processor.stop()
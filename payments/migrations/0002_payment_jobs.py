@@ -0,0 +1,74 @@
+# Generated by Django 4.2.7 on 2026-10-18 13:40
+
+from django.db import migrations, models
+import django.utils.timezone
+import payments.models
+from payments.models import new_idempotency_key
+
+
+def assign_idempotency_keys(apps, schema_editor):
+    Payment = apps.get_model("payments", "Payment")
+    rows = list(Payment.objects.only("id"))
+    for payment in rows:
+        payment.idempotency_key = new_idempotency_key()
+    Payment.objects.bulk_update(rows, ["idempotency_key"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("payments", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="payment",
+            name="attempts",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="payment",
+            name="last_error",
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name="payment",
+            name="declined",
+            field=models.BooleanField(default=False),
+        ),
+        # Payments made before the worker existed were charged inline; a PENDING one of those may
+        # have reached the provider already, so none of them is picked up for charging
+        migrations.AddField(
+            model_name="payment",
+            name="next_attempt_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name="payment",
+            name="next_attempt_at",
+            field=models.DateTimeField(
+                blank=True, default=django.utils.timezone.now, null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name="payment",
+            name="idempotency_key",
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.RunPython(assign_idempotency_keys, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="payment",
+            name="idempotency_key",
+            field=models.CharField(
+                default=payments.models.new_idempotency_key, max_length=64, unique=True
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="payment",
+            index=models.Index(
+                condition=models.Q(("status", "PENDING")),
+                fields=["next_attempt_at", "id"],
+                name="payment_pending_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.2.7 on 2026-10-18 14:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_passengers(apps, schema_editor):
+    Payment = apps.get_model("payments", "Payment")
+    Ride = apps.get_model("rides", "Ride")
+    Payment.objects.filter(passenger__isnull=True).update(
+        passenger_id=models.Subquery(
+            Ride.objects.filter(id=models.OuterRef("ride_id")).values("passenger_id")[
+                :1
+            ]
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0001_initial"),
+        ("rides", "0001_initial"),
+        ("payments", "0002_payment_jobs"),
+    ]
+
+    operations = [
+        # Added nullable and filled from each payment's ride; 0004 makes it required. The two
+        # are separate migrations because PostgreSQL refuses to ALTER a table with pending
+        # trigger events from the backfill in the same transaction.
+        migrations.AddField(
+            model_name="payment",
+            name="passenger",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="users.passenger",
+            ),
+        ),
+        migrations.RunPython(copy_passengers, migrations.RunPython.noop),
+    ]
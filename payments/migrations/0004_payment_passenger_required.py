@@ -0,0 +1,28 @@
+# Generated by Django 4.2.7 on 2026-10-18 14:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("payments", "0003_payment_passenger"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="payment",
+            name="passenger",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE, to="users.passenger"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="payment",
+            index=models.Index(
+                fields=["passenger", "created_at", "id"],
+                name="payment_passenger_history_idx",
+            ),
+        ),
+    ]
@@ -1,5 +1,11 @@
+import uuid
 from django.db import models
+from django.utils import timezone
 from rides.models import Ride
+from users.models import Passenger
+
+def new_idempotency_key():
+    return uuid.uuid4().hex
 
 class Payment(models.Model):
     class PaymentStatus(models.TextChoices):
@@ -14,12 +20,30 @@ class Payment(models.Model):
         CASH = 'CASH', 'Cash'
     
     ride = models.OneToOneField(Ride, on_delete=models.CASCADE)
+    # Copied from the ride so a passenger's history is read from one index
+    passenger = models.ForeignKey(Passenger, on_delete=models.CASCADE)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     payment_type = models.CharField(max_length=20, choices=PaymentType.choices)
     status = models.CharField(max_length=20, choices=PaymentStatus.choices, default=PaymentStatus.PENDING)
     stripe_payment_intent_id = models.CharField(max_length=255, null=True, blank=True)
+    # Charging runs in `run_payment_worker`. The key is sent with every provider call for this
+    # payment, so a retried charge can't go through twice.
+    idempotency_key = models.CharField(max_length=64, unique=True, default=new_idempotency_key)
+    attempts = models.PositiveIntegerField(default=0)
+    # None once the payment is settled or retries are exhausted
+    next_attempt_at = models.DateTimeField(null=True, blank=True, default=timezone.now)
+    last_error = models.TextField(blank=True)
+    # FAILED because the provider refused the charge, rather than because retries ran out
+    # (in which case the charge may still have gone through)
+    declined = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    class Meta:
+        indexes = [
+            models.Index(fields=['passenger', 'created_at', 'id'], name='payment_passenger_history_idx'),
+            models.Index(fields=['next_attempt_at', 'id'], condition=models.Q(status='PENDING'), name='payment_pending_idx'),
+        ]
+    
     def __str__(self):
         return f"Payment {self.id} - {self.status}"
\ No newline at end of file
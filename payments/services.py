@@ -1,37 +1,82 @@
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 import stripe
 from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
 from .models import Payment
 
+logger = logging.getLogger(__name__)
+
 stripe.api_key = settings.STRIPE_SECRET_KEY
 
+class PaymentFailed(Exception):
+    # The provider rejected the request for good; retrying it won't help
+    pass
+
+class PaymentDeclined(PaymentFailed):
+    # The provider refused the charge, so nothing was charged
+    pass
+
+class LocalPaymentProvider:
+    # Stand-in for Stripe's PaymentIntent API for local runs and load tests: waits
+    # PAYMENT_LOCAL_LATENCY seconds per call and, like Stripe, answers a repeated
+    # idempotency key with the intent it already created
+    class PaymentIntent:
+        latency = None
+        
+        @classmethod
+        def create(cls, amount, currency, idempotency_key=None, **kwargs):
+            time.sleep(cls.latency if cls.latency is not None else settings.PAYMENT_LOCAL_LATENCY)
+            digest = hashlib.sha1((idempotency_key or '').encode()).hexdigest()[:24]
+            return stripe.PaymentIntent.construct_from({'id': f'pi_local_{digest}', 'amount': amount, 'currency': currency}, None)
+
+PAYMENT_PROVIDERS = {
+    'stripe': stripe,
+    'local': LocalPaymentProvider,
+}
+
 class PaymentStrategy:
+    # Runs on a worker thread with a payment snapshot: talks to the provider and returns the
+    # fields to store on success, without touching the database. Raises PaymentDeclined when
+    # the charge is refused and PaymentFailed when the request can never succeed; any other
+    # exception is retried.
     def process_payment(self, payment, **kwargs):
         raise NotImplementedError
 
 class CreditCardPayment(PaymentStrategy):
-    def process_payment(self, payment, stripe_token=None):
+    def __init__(self, provider=None):
+        self.provider = provider or PAYMENT_PROVIDERS[settings.PAYMENT_PROVIDER]
+    
+    def process_payment(self, payment, **kwargs):
         try:
-            intent = stripe.PaymentIntent.create(
+            intent = self.provider.PaymentIntent.create(
                 amount=int(payment.amount * 100),  # Convert to cents
                 currency='usd',
                 payment_method_types=['card'],
-                metadata={'ride_id': payment.ride.id}
+                metadata={'ride_id': payment.ride_id},
+                idempotency_key=payment.idempotency_key
             )
-            payment.stripe_payment_intent_id = intent.id
-            payment.status = Payment.PaymentStatus.COMPLETED
-            payment.save()
-            return True
-        except stripe.error.StripeError:
-            payment.status = Payment.PaymentStatus.FAILED
-            payment.save()
-            return False
+        except stripe.error.CardError as exc:
+            raise PaymentDeclined(exc.user_message or str(exc))
+        except (stripe.error.InvalidRequestError, stripe.error.AuthenticationError, stripe.error.PermissionError) as exc:
+            # Rejected before any charge was made; the same request would be rejected again
+            raise PaymentDeclined(f'{type(exc).__name__}: {exc.user_message or exc}')
+        except stripe.error.IdempotencyError as exc:
+            # The key was already used with other parameters, so a charge may exist under it
+            raise PaymentFailed(f'{type(exc).__name__}: {exc.user_message or exc}')
+        # Rate limits, connection errors and provider-side errors are retried
+        return {'stripe_payment_intent_id': intent.id}
 
 class WalletPayment(PaymentStrategy):
     def process_payment(self, payment, **kwargs):
         # Simulate wallet payment processing
-        payment.status = Payment.PaymentStatus.COMPLETED
-        payment.save()
-        return True
+        return {}
 
 class PaymentFactory:
     @staticmethod
@@ -46,8 +91,103 @@ class StripeService:
     def __init__(self):
         self.payment_factory = PaymentFactory()
     
+    def supports(self, payment_type):
+        return payment_type in (Payment.PaymentType.CREDIT_CARD, Payment.PaymentType.WALLET)
+    
     def process_payment(self, payment, **kwargs):
         strategy = self.payment_factory.get_payment_strategy(payment.payment_type)
-        if strategy:
-            return strategy.process_payment(payment, **kwargs)
-        return False
\ No newline at end of file
+        if strategy is None:
+            raise PaymentDeclined(f'Unsupported payment type {payment.payment_type}')
+        return strategy.process_payment(payment, **kwargs)
+
+class PaymentProcessor:
+    # Charges PENDING payments off the request path. Like the ride outbox, payments are
+    # claimed in batches under a lease (skip_locked, so several workers share the queue),
+    # the provider calls run on a thread pool, and the outcomes are written from the
+    # claiming thread. Each outcome is a conditional update on status=PENDING, so a payment
+    # settled elsewhere is left alone. Failures other than PaymentFailed are retried with
+    # exponential backoff under the same idempotency key, so at most one charge goes through.
+    def __init__(self, service=None, workers=None, batch_size=None):
+        self.service = service or StripeService()
+        self.workers = workers or settings.PAYMENT_WORKERS
+        self.batch_size = batch_size or settings.PAYMENT_BATCH_SIZE
+        self._executor = None
+        self._results_lock = threading.Lock()
+        self._completed = []
+        self._rejected = []
+        self._failed = []
+    
+    def start(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='payment')
+    
+    def stop(self):
+        self._executor.shutdown(wait=True)
+        self._executor = None
+    
+    def _charge(self, payment):
+        try:
+            changes = self.service.process_payment(payment)
+        except PaymentFailed as exc:
+            with self._results_lock:
+                self._rejected.append((payment, str(exc), isinstance(exc, PaymentDeclined)))
+        except Exception as exc:
+            logger.exception("Charging payment %s failed", payment.id)
+            with self._results_lock:
+                self._failed.append((payment, repr(exc)))
+        else:
+            with self._results_lock:
+                self._completed.append((payment, changes))
+    
+    def claim(self):
+        now = timezone.now()
+        with transaction.atomic():
+            payment_ids = list(
+                Payment.objects.select_for_update(skip_locked=True)
+                .filter(status=Payment.PaymentStatus.PENDING, next_attempt_at__lte=now)
+                .order_by('next_attempt_at', 'id')
+                .values_list('id', flat=True)[:self.batch_size]
+            )
+            Payment.objects.filter(id__in=payment_ids).update(
+                attempts=F('attempts') + 1,
+                next_attempt_at=now + timedelta(seconds=settings.PAYMENT_LEASE_SECONDS)
+            )
+        return list(Payment.objects.filter(id__in=payment_ids).order_by('id'))
+    
+    def process_batch(self):
+        # Returns the number of payments claimed
+        payments = self.claim()
+        list(self._executor.map(self._charge, payments))
+        self._record_results()
+        return len(payments)
+    
+    def _record_results(self):
+        with self._results_lock:
+            completed, self._completed = self._completed, []
+            rejected, self._rejected = self._rejected, []
+            failed, self._failed = self._failed, []
+        
+        pending = Payment.objects.filter(status=Payment.PaymentStatus.PENDING)
+        for payment, changes in completed:
+            pending.filter(id=payment.id).update(
+                status=Payment.PaymentStatus.COMPLETED, next_attempt_at=None, last_error='',
+                updated_at=timezone.now(), **changes
+            )
+        for payment, error, declined in rejected:
+            pending.filter(id=payment.id).update(
+                status=Payment.PaymentStatus.FAILED, declined=declined, next_attempt_at=None, last_error=error,
+                updated_at=timezone.now()
+            )
+        for payment, error in failed:
+            retry_at = self.retry_at(payment.attempts)
+            if retry_at is None:
+                pending.filter(id=payment.id).update(
+                    status=Payment.PaymentStatus.FAILED, next_attempt_at=None, last_error=error, updated_at=timezone.now()
+                )
+            else:
+                pending.filter(id=payment.id).update(next_attempt_at=retry_at, last_error=error)
+    
+    def retry_at(self, attempts):
+        if attempts >= settings.PAYMENT_MAX_ATTEMPTS:
+            return None
+        delay = min(settings.PAYMENT_RETRY_BASE_SECONDS * 2 ** (attempts - 1), settings.PAYMENT_RETRY_MAX_SECONDS)
+        return timezone.now() + timedelta(seconds=delay)
@@ -0,0 +1,250 @@
+import time
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+import stripe
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from riderapp.testing import AuthenticatedTestCase, make_passenger, make_ride
+from rides.models import Ride
+from .models import Payment
+from .services import PAYMENT_PROVIDERS, LocalPaymentProvider, PaymentProcessor
+from .views import payment_history_pagination
+
+class StubProvider:
+    # Stands in for the stripe module: PaymentIntent.create raises the queued errors in
+    # turn, then charges through LocalPaymentProvider
+    def __init__(self, *errors):
+        self.PaymentIntent = self
+        self.errors = list(errors)
+        self.keys = []
+    
+    def create(self, amount, currency, idempotency_key=None, **kwargs):
+        self.keys.append(idempotency_key)
+        if self.errors:
+            raise self.errors.pop(0)
+        return LocalPaymentProvider.PaymentIntent.create(amount, currency, idempotency_key=idempotency_key, **kwargs)
+
+@override_settings(PAYMENT_PROVIDER='stub', PAYMENT_LOCAL_LATENCY=0, PAYMENT_MAX_ATTEMPTS=3, PAYMENT_RETRY_BASE_SECONDS=2, PAYMENT_RETRY_MAX_SECONDS=5)
+class PaymentProcessorTests(TestCase):
+    def setUp(self):
+        self.passenger = make_passenger('passenger')
+        self.processor = PaymentProcessor(workers=4, batch_size=50)
+        self.processor.start()
+        self.addCleanup(self.processor.stop)
+    
+    def use_provider(self, provider):
+        patcher = mock.patch.dict(PAYMENT_PROVIDERS, {'stub': provider})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return provider
+    
+    def make_payment(self, **fields):
+        ride = make_ride(self.passenger, status=Ride.RideStatus.COMPLETED)
+        return Payment.objects.create(
+            ride=ride, passenger=self.passenger, amount=ride.fare, payment_type=Payment.PaymentType.CREDIT_CARD, **fields
+        )
+    
+    def make_due(self, payment):
+        Payment.objects.filter(id=payment.id).update(next_attempt_at=timezone.now())
+    
+    @override_settings(PAYMENT_PROVIDER='local')
+    def test_charge_completes_with_the_payment_key(self):
+        payment = self.make_payment()
+        self.assertEqual(self.processor.process_batch(), 1)
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.attempts, payment.next_attempt_at), (Payment.PaymentStatus.COMPLETED, 1, None))
+        # Like Stripe, the provider answers a repeated key with the same intent
+        intent = LocalPaymentProvider.PaymentIntent.create(1000, 'usd', idempotency_key=payment.idempotency_key)
+        self.assertEqual(payment.stripe_payment_intent_id, intent.id)
+    
+    def test_claim_leases_payments(self):
+        self.use_provider(StubProvider())
+        payment = self.make_payment()
+        before = timezone.now()
+        self.assertEqual([claimed.id for claimed in self.processor.claim()], [payment.id])
+        payment.refresh_from_db()
+        self.assertEqual(payment.attempts, 1)
+        self.assertGreaterEqual(payment.next_attempt_at, before + timedelta(seconds=60))
+        # Leased: no other worker picks it up until the lease runs out
+        self.assertEqual(self.processor.claim(), [])
+        Payment.objects.filter(id=payment.id).update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual([claimed.attempts for claimed in self.processor.claim()], [2])
+        # Only due PENDING payments are claimed
+        self.make_payment(next_attempt_at=timezone.now() + timedelta(hours=1))
+        self.make_payment(status=Payment.PaymentStatus.COMPLETED)
+        self.assertEqual(self.processor.claim(), [])
+    
+    def test_failures_back_off_then_fail_under_one_key(self):
+        provider = self.use_provider(StubProvider(*(stripe.error.APIConnectionError('Network error') for _ in range(3))))
+        payment = self.make_payment()
+        for attempt, delay in ((1, 2), (2, 4)):
+            before = timezone.now()
+            with self.assertLogs('payments.services', 'ERROR'):
+                self.processor.process_batch()
+            payment.refresh_from_db()
+            self.assertEqual((payment.status, payment.attempts), (Payment.PaymentStatus.PENDING, attempt))
+            self.assertIn('Network error', payment.last_error)
+            self.assertGreaterEqual(payment.next_attempt_at, before + timedelta(seconds=delay))
+            self.assertLess(payment.next_attempt_at, before + timedelta(seconds=delay + 1))
+            self.assertEqual(self.processor.process_batch(), 0)
+            self.make_due(payment)
+        with self.assertLogs('payments.services', 'ERROR'):
+            self.processor.process_batch()
+        payment.refresh_from_db()
+        # Retries ran out; the charge may still have reached the provider
+        self.assertEqual((payment.status, payment.declined, payment.next_attempt_at), (Payment.PaymentStatus.FAILED, False, None))
+        self.assertEqual(provider.keys, [payment.idempotency_key] * 3)
+    
+    def test_backoff_is_capped(self):
+        now = timezone.now()
+        delays = [(self.processor.retry_at(attempts) - now).total_seconds() for attempts in (1, 2)]
+        self.assertEqual([round(delay) for delay in delays], [2, 4])
+        with override_settings(PAYMENT_MAX_ATTEMPTS=10):
+            self.assertEqual(round((self.processor.retry_at(5) - now).total_seconds()), 5)
+        self.assertIsNone(self.processor.retry_at(3))
+    
+    def test_non_retryable_errors_fail_at_once(self):
+        cases = [
+            (stripe.error.CardError('Your card was declined.', None, 'card_declined'), True),
+            (stripe.error.InvalidRequestError('No such payment_method', 'payment_method'), True),
+            (stripe.error.AuthenticationError('Invalid API Key provided'), True),
+            (stripe.error.PermissionError('The provided key does not have access'), True),
+            # A charge may exist under the key, so it isn't a decline
+            (stripe.error.IdempotencyError('Keys for idempotent requests can only be used with the same parameters'), False),
+        ]
+        for error, declined in cases:
+            with self.subTest(error=type(error).__name__):
+                self.use_provider(StubProvider(error))
+                payment = self.make_payment()
+                self.processor.process_batch()
+                payment.refresh_from_db()
+                self.assertEqual(
+                    (payment.status, payment.declined, payment.attempts, payment.next_attempt_at),
+                    (Payment.PaymentStatus.FAILED, declined, 1, None)
+                )
+                self.assertIn(str(error.user_message or error), payment.last_error)
+    
+    def test_throughput_with_concurrent_provider_calls(self):
+        # 4 workers against a provider taking 50 ms a call: 40 payments in 10 rounds, not 40
+        latency, count = 0.05, 40
+        self.use_provider(StubProvider())
+        for _ in range(count):
+            self.make_payment()
+        with override_settings(PAYMENT_LOCAL_LATENCY=latency):
+            started = time.perf_counter()
+            self.assertEqual(self.processor.process_batch(), count)
+            elapsed = time.perf_counter() - started
+        self.assertLess(elapsed, count * latency / 2)
+        self.assertEqual(Payment.objects.filter(status=Payment.PaymentStatus.COMPLETED).count(), count)
+
+class ProcessPaymentViewTests(AuthenticatedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.passenger = make_passenger('passenger')
+        self.ride = make_ride(self.passenger, status=Ride.RideStatus.COMPLETED)
+        self.login(self.passenger.user)
+    
+    def post(self, payment_type=Payment.PaymentType.CREDIT_CARD):
+        return self.client.post('/api/payments/process/', {'ride_id': self.ride.id, 'payment_type': payment_type}, format='json')
+    
+    def test_payment_is_queued_once(self):
+        response = self.post()
+        self.assertEqual(response.status_code, 202)
+        payment = Payment.objects.get(ride=self.ride)
+        self.assertEqual(response['Location'], f'/api/payments/{payment.id}/status/')
+        self.assertEqual((self.post().json()['id'], Payment.objects.count()), (payment.id, 1))
+    
+    def test_retry_after_exhausted_attempts_keeps_the_key(self):
+        self.post()
+        payment = Payment.objects.get(ride=self.ride)
+        Payment.objects.filter(id=payment.id).update(status=Payment.PaymentStatus.FAILED, attempts=6, next_attempt_at=None)
+        self.assertEqual(self.post(Payment.PaymentType.WALLET).status_code, 202)
+        retried = Payment.objects.get(id=payment.id)
+        self.assertEqual((retried.status, retried.attempts), (Payment.PaymentStatus.PENDING, 0))
+        # The provider answers the same key with the charge it may already have made
+        self.assertEqual((retried.idempotency_key, retried.payment_type), (payment.idempotency_key, Payment.PaymentType.CREDIT_CARD))
+    
+    def test_retry_after_decline_is_a_new_charge(self):
+        self.post()
+        payment = Payment.objects.get(ride=self.ride)
+        Payment.objects.filter(id=payment.id).update(status=Payment.PaymentStatus.FAILED, declined=True, next_attempt_at=None)
+        self.assertEqual(self.post(Payment.PaymentType.WALLET).status_code, 202)
+        retried = Payment.objects.get(id=payment.id)
+        self.assertEqual((retried.status, retried.declined, retried.payment_type), (Payment.PaymentStatus.PENDING, False, Payment.PaymentType.WALLET))
+        self.assertNotEqual(retried.idempotency_key, payment.idempotency_key)
+
+class PaymentHistoryTests(AuthenticatedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.passenger = make_passenger('passenger')
+        other = make_passenger('other')
+        self.login(self.passenger.user)
+        # Seven payments over five timestamps, so pages also split rows with equal created_at
+        base = timezone.now() - timedelta(days=1)
+        offsets = [0, 1, 1, 2, 3, 3, 4]
+        for offset in offsets:
+            payment = Payment.objects.create(
+                ride=make_ride(self.passenger), passenger=self.passenger, amount=Decimal('10.00'), payment_type=Payment.PaymentType.WALLET
+            )
+            Payment.objects.filter(id=payment.id).update(created_at=base + timedelta(minutes=offset))
+        Payment.objects.create(ride=make_ride(other), passenger=other, amount=Decimal('10.00'), payment_type=Payment.PaymentType.WALLET)
+        self.expected = list(
+            Payment.objects.filter(passenger=self.passenger).order_by('-created_at', '-id').values_list('id', flat=True)
+        )
+    
+    def get(self, **params):
+        return self.client.get('/api/payments/history/', params)
+    
+    def test_pages_cover_the_history_once_newest_first(self):
+        seen, cursor, pages = [], None, 0
+        while True:
+            response = self.get(limit=2, **({'cursor': cursor} if cursor else {}))
+            self.assertEqual(response.status_code, 200)
+            seen += [payment['id'] for payment in response.json()]
+            pages += 1
+            cursor = response.get('X-Next-Cursor')
+            if not cursor:
+                break
+        self.assertEqual((seen, pages), (self.expected, 4))
+    
+    def test_page_is_one_query_after_auth(self):
+        response = self.get(limit=3)
+        with self.assertNumQueries(2):
+            response = self.get(limit=3, cursor=response['X-Next-Cursor'])
+        self.assertEqual([payment['id'] for payment in response.json()], self.expected[3:6])
+    
+    def test_limits_and_cursors_are_validated(self):
+        self.assertFalse(self.get().has_header('X-Next-Cursor'))
+        with mock.patch.object(payment_history_pagination, 'max_page_size', 5):
+            response = self.get(limit=100)
+        self.assertEqual([payment['id'] for payment in response.json()], self.expected[:5])
+        self.assertTrue(response.has_header('X-Next-Cursor'))
+        for params in ({'limit': 0}, {'limit': 'ten'}, {'cursor': 'not-a-cursor'}, {'cursor': 'bm90fGE='}):
+            self.assertEqual(self.get(**params).status_code, 400, params)
+
+class PassengerBackfillMigrationTests(TransactionTestCase):
+    # payments 0003 copies each payment's passenger from its ride, and 0004 makes it required
+    before, after = ('payments', '0002_payment_jobs'), ('payments', '0004_payment_passenger_required')
+    
+    def migrate(self, target):
+        executor = MigrationExecutor(connection)
+        executor.migrate([target])
+        return executor.loader.project_state([target]).apps
+    
+    def test_payments_get_their_ride_passenger(self):
+        rides = [make_ride(make_passenger(name)) for name in ('first', 'second')]
+        self.addCleanup(self.migrate, self.after)
+        old_apps = self.migrate(self.before)
+        OldPayment = old_apps.get_model('payments', 'Payment')
+        payments = [
+            OldPayment.objects.create(ride_id=ride.id, amount=Decimal('10.00'), payment_type='WALLET', idempotency_key=f'key{ride.id}')
+            for ride in rides
+        ]
+        self.migrate(self.after)
+        self.assertEqual(
+            dict(Payment.objects.values_list('id', 'passenger_id')),
+            {payment.id: ride.passenger_id for payment, ride in zip(payments, rides)}
+        )
@@ -1,40 +1,61 @@
+from django.conf import settings
+from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
-from .models import Payment
+from .models import Payment, new_idempotency_key
 from .serializers import PaymentRequestSerializer, PaymentResponseSerializer
 from .services import StripeService
 from rides.models import Ride
+from rides.pagination import KeysetPagination
 
 stripe_service = StripeService()
+payment_history_pagination = KeysetPagination('created_at', settings.PAYMENT_HISTORY_PAGE_SIZE, settings.PAYMENT_HISTORY_MAX_PAGE_SIZE)
 
 @api_view(['POST'])
 def process_payment(request):
+    # Queues the charge for `run_payment_worker` and answers right away; clients poll the
+    # status URL in the Location header. Repeating the request returns the same payment.
     serializer = PaymentRequestSerializer(data=request.data)
     if serializer.is_valid():
         try:
-            ride = Ride.objects.get(id=serializer.validated_data['ride_id'])
+            ride = Ride.objects.only('id', 'passenger_id', 'fare').get(id=serializer.validated_data['ride_id'])
             
             # Check if user is authorized for this ride
-            if ride.passenger.user != request.user:
+            if not request.passenger or ride.passenger_id != request.passenger.id:
                 return Response({'error': 'Unauthorized'}, status=status.HTTP_403_FORBIDDEN)
             
-            payment = Payment.objects.create(
-                ride=ride,
-                amount=ride.fare,
-                payment_type=serializer.validated_data['payment_type']
-            )
+            payment_type = serializer.validated_data['payment_type']
+            if not stripe_service.supports(payment_type):
+                return Response({'error': 'Unsupported payment type'}, status=status.HTTP_400_BAD_REQUEST)
             
-            success = stripe_service.process_payment(
-                payment, 
-                stripe_token=serializer.validated_data.get('stripe_token')
+            payment, created = Payment.objects.get_or_create(
+                ride=ride,
+                defaults={'passenger_id': ride.passenger_id, 'amount': ride.fare, 'payment_type': payment_type}
             )
+            if not created and payment.status == Payment.PaymentStatus.FAILED:
+                retry = {
+                    'status': Payment.PaymentStatus.PENDING, 'attempts': 0, 'next_attempt_at': timezone.now(),
+                    'last_error': '', 'updated_at': timezone.now()
+                }
+                if payment.declined:
+                    # A declined charge didn't happen, so the retry is a new charge with a new
+                    # key, and may use another payment type
+                    retry.update(
+                        payment_type=payment_type, amount=ride.fare, declined=False, idempotency_key=new_idempotency_key()
+                    )
+                # Otherwise retries ran out and the provider may have taken the charge; retrying
+                # under the same key lets the provider return that charge instead of making another
+                if Payment.objects.filter(id=payment.id, status=Payment.PaymentStatus.FAILED).update(**retry):
+                    payment.refresh_from_db()
             
-            if success:
-                return Response(PaymentResponseSerializer(payment).data)
-            else:
-                return Response({'error': 'Payment failed'}, status=status.HTTP_400_BAD_REQUEST)
-                
+            data = PaymentResponseSerializer(payment).data
+            if payment.status != Payment.PaymentStatus.PENDING:
+                return Response(data)
+            location = reverse('get_payment_status', args=[payment.id])
+            return Response(data, status=status.HTTP_202_ACCEPTED, headers={'Location': location})
+        
         except Ride.DoesNotExist:
             return Response({'error': 'Ride not found'}, status=status.HTTP_404_NOT_FOUND)
     
@@ -42,14 +63,26 @@ def process_payment(request):
 
 @api_view(['GET'])
 def get_payment_history(request):
-    # Get payments for rides where user is the passenger
-    payments = Payment.objects.filter(ride__passenger__user=request.user).order_by('-created_at')
-    return Response(PaymentResponseSerializer(payments, many=True).data)
+    # Newest first, one keyset page at a time (see rides.pagination)
+    if not request.passenger:
+        return Response([])
+    payments = Payment.objects.filter(passenger_id=request.passenger.id)
+    try:
+        page, next_cursor = payment_history_pagination.paginate(payments, request)
+    except ValueError:
+        return Response({'error': 'Invalid cursor or limit'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    response = Response(PaymentResponseSerializer(page, many=True).data)
+    if next_cursor:
+        response['X-Next-Cursor'] = next_cursor
+    return response
 
 @api_view(['GET'])
 def get_payment_status(request, payment_id):
     try:
-        payment = Payment.objects.get(id=payment_id, ride__passenger__user=request.user)
+        if not request.passenger:
+            raise Payment.DoesNotExist
+        payment = Payment.objects.get(id=payment_id, passenger_id=request.passenger.id)
         return Response(PaymentResponseSerializer(payment).data)
     except Payment.DoesNotExist:
         return Response({'error': 'Payment not found'}, status=status.HTTP_404_NOT_FOUND)
\ No newline at end of file
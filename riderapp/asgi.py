@@ -0,0 +1,14 @@
+import os
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'riderapp.settings')
+django_application = get_asgi_application()
+
+async def application(scope, receive, send):
+    # Django gives each request its own thread for sync code and keeps it until the response
+    # finishes. An event stream stays open for minutes while idle, so stream requests skip
+    # that and share asgiref's single thread; their sync work only runs while opening.
+    if scope['type'] == 'http' and scope['path'].endswith('/events/'):
+        await django_application.handle(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
@@ -29,6 +29,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'users.roles.RoleMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -52,6 +53,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'riderapp.wsgi.application'
+ASGI_APPLICATION = 'riderapp.asgi.application'
 
 DATABASES = {
     'default': {
@@ -83,7 +85,7 @@ AUTH_USER_MODEL = 'users.User'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'users.authentication.CachedJWTAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
@@ -97,6 +99,15 @@ SIMPLE_JWT = {
 }
 
 CORS_ALLOW_ALL_ORIGINS = True
+CORS_EXPOSE_HEADERS = ['X-Next-Cursor']
+
+# Ride history pages (?limit=, ?cursor= from the X-Next-Cursor header)
+RIDE_HISTORY_PAGE_SIZE = config('RIDE_HISTORY_PAGE_SIZE', default=50, cast=int)
+RIDE_HISTORY_MAX_PAGE_SIZE = config('RIDE_HISTORY_MAX_PAGE_SIZE', default=200, cast=int)
+
+# Payment history pages, paged the same way
+PAYMENT_HISTORY_PAGE_SIZE = config('PAYMENT_HISTORY_PAGE_SIZE', default=50, cast=int)
+PAYMENT_HISTORY_MAX_PAGE_SIZE = config('PAYMENT_HISTORY_MAX_PAGE_SIZE', default=200, cast=int)
 
 # Stripe Configuration
 STRIPE_SECRET_KEY = config('SECRET', default='')
@@ -105,6 +116,144 @@ STRIPE_PUBLISHABLE_KEY = config('PUBLISH', default='')
 # Google Maps API
 GOOGLE_MAPS_API_KEY = config('MAP', default='')
 
+# Outbound Maps calls: worker threads, per-call timeout and the total budget for one ride request (seconds)
+MAPS_MAX_WORKERS = config('MAPS_MAX_WORKERS', default=8, cast=int)
+MAPS_CALL_TIMEOUT = config('MAPS_CALL_TIMEOUT', default=2.0, cast=float)
+RIDE_REQUEST_LATENCY_BUDGET = config('RIDE_REQUEST_LATENCY_BUDGET', default=3.0, cast=float)
+
+# Ride distances: 'haversine' estimates locally (straight line x road factor), 'google' uses the
+# Distance Matrix API with the local estimate as fallback and memoizes results per cell pair
+DISTANCE_ENGINE = config('DISTANCE_ENGINE', default='haversine')
+DISTANCE_ROAD_FACTOR = config('DISTANCE_ROAD_FACTOR', default=1.3, cast=float)
+DISTANCE_REGION_CELL_DEG = config('DISTANCE_REGION_CELL_DEG', default=0.5, cast=float)
+DISTANCE_CACHE_CELL_DEG = config('DISTANCE_CACHE_CELL_DEG', default=0.002, cast=float)
+# Average road speed used for ETAs when the provider has no answer
+ESTIMATED_SPEED_KMH = config('ESTIMATED_SPEED_KMH', default=25.0, cast=float)
+
+# Open-ride feed for drivers: REQUESTED rides near the driver, from a grid keyed by pickup cell
+OPEN_RIDE_INDEX_CELL_DEG = config('OPEN_RIDE_INDEX_CELL_DEG', default=0.01, cast=float)
+OPEN_RIDE_INDEX_MAX_AGE = config('OPEN_RIDE_INDEX_MAX_AGE', default=5, cast=int)
+OPEN_RIDE_RADIUS_KM = config('OPEN_RIDE_RADIUS_KM', default=5.0, cast=float)
+OPEN_RIDE_MAX_RADIUS_KM = config('OPEN_RIDE_MAX_RADIUS_KM', default=25.0, cast=float)
+OPEN_RIDE_FEED_LIMIT = config('OPEN_RIDE_FEED_LIMIT', default=20, cast=int)
+
+# Streaming ride updates (served under ASGI): grid cell for offer fan-out, per-client queue
+# bound, keep-alive interval, the lifetime of one stream before the client reconnects and
+# how long a stream token can be used to open (or reopen) a stream
+PUSH_CELL_DEG = config('PUSH_CELL_DEG', default=0.05, cast=float)
+PUSH_QUEUE_SIZE = config('PUSH_QUEUE_SIZE', default=16, cast=int)
+PUSH_HEARTBEAT_SECONDS = config('PUSH_HEARTBEAT_SECONDS', default=20, cast=float)
+PUSH_MAX_STREAM_SECONDS = config('PUSH_MAX_STREAM_SECONDS', default=300, cast=float)
+PUSH_STREAM_TOKEN_SECONDS = config('PUSH_STREAM_TOKEN_SECONDS', default=60, cast=int)
+
+# Surge pricing: demand/supply per cell over a sliding window. Surge starts once requests
+# per available driver exceed the threshold and grows by SURGE_SENSITIVITY per extra request.
+SURGE_CELL_DEG = config('SURGE_CELL_DEG', default=0.02, cast=float)
+SURGE_WINDOW_SECONDS = config('SURGE_WINDOW_SECONDS', default=300, cast=int)
+SURGE_DEMAND_THRESHOLD = config('SURGE_DEMAND_THRESHOLD', default=1.0, cast=float)
+SURGE_SENSITIVITY = config('SURGE_SENSITIVITY', default=0.5, cast=float)
+SURGE_MAX_MULTIPLIER = config('SURGE_MAX_MULTIPLIER', default=3.0, cast=float)
+
+# Leave driver ledger credits pending (rolled up by `rollup_driver_earnings`) instead of
+# updating Driver.earnings on every completed ride
+DRIVER_EARNINGS_BATCHED = config('DRIVER_EARNINGS_BATCHED', default=False, cast=bool)
+
+# Weight of the newest rating in Driver.recent_rating (roughly the last 1 / decay rides)
+DRIVER_RATING_DECAY = config('DRIVER_RATING_DECAY', default=0.05, cast=float)
+
+# Ride event outbox (`run_outbox_worker`): observer threads, events claimed per batch, per-thread
+# queue bound, claim lease and retry backoff in seconds; delivered events are deleted once older
+# than the retention period, checked every prune interval (seconds)
+OUTBOX_WORKERS = config('OUTBOX_WORKERS', default=4, cast=int)
+OUTBOX_BATCH_SIZE = config('OUTBOX_BATCH_SIZE', default=500, cast=int)
+OUTBOX_QUEUE_SIZE = config('OUTBOX_QUEUE_SIZE', default=250, cast=int)
+OUTBOX_POLL_INTERVAL = config('OUTBOX_POLL_INTERVAL', default=0.5, cast=float)
+OUTBOX_LEASE_SECONDS = config('OUTBOX_LEASE_SECONDS', default=60, cast=int)
+OUTBOX_MAX_ATTEMPTS = config('OUTBOX_MAX_ATTEMPTS', default=8, cast=int)
+OUTBOX_RETRY_BASE_SECONDS = config('OUTBOX_RETRY_BASE_SECONDS', default=2, cast=float)
+OUTBOX_RETRY_MAX_SECONDS = config('OUTBOX_RETRY_MAX_SECONDS', default=600, cast=float)
+OUTBOX_RETENTION_SECONDS = config('OUTBOX_RETENTION_SECONDS', default=7 * 24 * 3600, cast=int)
+OUTBOX_PRUNE_INTERVAL = config('OUTBOX_PRUNE_INTERVAL', default=300, cast=float)
+
+# POOL matching: open POOL rides are indexed by pickup and dropoff cell and heading sector; a new
+# one pairs with the candidate saving the most km whose route keeps each rider within both detour limits
+POOL_CELL_DEG = config('POOL_CELL_DEG', default=0.01, cast=float)
+POOL_HEADING_SECTORS = config('POOL_HEADING_SECTORS', default=8, cast=int)
+POOL_INDEX_MAX_AGE = config('POOL_INDEX_MAX_AGE', default=5, cast=int)
+POOL_MAX_DETOUR_RATIO = config('POOL_MAX_DETOUR_RATIO', default=1.4, cast=float)
+POOL_MAX_DETOUR_KM = config('POOL_MAX_DETOUR_KM', default=3.0, cast=float)
+POOL_MAX_CANDIDATES = config('POOL_MAX_CANDIDATES', default=50, cast=int)
+
+# Batch dispatch (`run_dispatcher`): every window, open rides are matched to idle drivers by
+# total pickup ETA within regions of DISPATCH_REGION_DEG degrees (keep them wider than the pickup
+# limit), and offered for DISPATCH_OFFER_SECONDS. Regions with more ride x driver pairs than
+# DISPATCH_EXACT_MAX_PAIRS are matched greedily instead of exactly.
+DISPATCH_WINDOW_SECONDS = config('DISPATCH_WINDOW_SECONDS', default=2.0, cast=float)
+DISPATCH_REGION_DEG = config('DISPATCH_REGION_DEG', default=0.25, cast=float)
+DISPATCH_MAX_PICKUP_KM = config('DISPATCH_MAX_PICKUP_KM', default=10.0, cast=float)
+DISPATCH_OFFER_SECONDS = config('DISPATCH_OFFER_SECONDS', default=15, cast=int)
+DISPATCH_EXACT_MAX_PAIRS = config('DISPATCH_EXACT_MAX_PAIRS', default=4000000, cast=int)
+
+# Payment worker (`run_payment_worker`): PAYMENT_PROVIDER is 'stripe' or 'local' (an in-process
+# stand-in that answers after PAYMENT_LOCAL_LATENCY seconds); concurrent provider calls, payments
+# claimed per batch, claim lease and retry backoff in seconds
+PAYMENT_PROVIDER = config('PAYMENT_PROVIDER', default='stripe')
+PAYMENT_LOCAL_LATENCY = config('PAYMENT_LOCAL_LATENCY', default=0.3, cast=float)
+PAYMENT_WORKERS = config('PAYMENT_WORKERS', default=8, cast=int)
+PAYMENT_BATCH_SIZE = config('PAYMENT_BATCH_SIZE', default=50, cast=int)
+PAYMENT_POLL_INTERVAL = config('PAYMENT_POLL_INTERVAL', default=0.5, cast=float)
+PAYMENT_LEASE_SECONDS = config('PAYMENT_LEASE_SECONDS', default=60, cast=int)
+PAYMENT_MAX_ATTEMPTS = config('PAYMENT_MAX_ATTEMPTS', default=6, cast=int)
+PAYMENT_RETRY_BASE_SECONDS = config('PAYMENT_RETRY_BASE_SECONDS', default=2, cast=float)
+PAYMENT_RETRY_MAX_SECONDS = config('PAYMENT_RETRY_MAX_SECONDS', default=300, cast=float)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # In-process LRU in front of the GeocodedPostcode table
+    'geocode': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'geocode',
+        'TIMEOUT': config('GEOCODE_CACHE_TTL', default=86400, cast=int),
+        'OPTIONS': {'MAX_ENTRIES': config('GEOCODE_CACHE_SIZE', default=10000, cast=int)},
+    },
+    'distance': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'distance',
+        'TIMEOUT': config('DISTANCE_CACHE_TTL', default=86400, cast=int),
+        'OPTIONS': {'MAX_ENTRIES': config('DISTANCE_CACHE_SIZE', default=50000, cast=int)},
+    },
+    # Authenticated users and their role ids (CachedJWTAuthentication). Entries are dropped when
+    # a user or profile is saved, but only in the cache of the process that saved it, so the
+    # default per-process cache isn't used: every request loads the user from the database.
+    # Point AUTH_CACHE_BACKEND/AUTH_CACHE_LOCATION at a cache all workers share (e.g.
+    # django.core.cache.backends.redis.RedisCache, redis://...) to serve users from it.
+    'auth': {
+        'BACKEND': config('AUTH_CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('AUTH_CACHE_LOCATION', default='auth'),
+        'TIMEOUT': config('AUTH_USER_CACHE_TTL', default=60, cast=int),
+        'OPTIONS': {'MAX_ENTRIES': config('AUTH_USER_CACHE_SIZE', default=10000, cast=int)},
+    },
+}
+
+# Nearby driver search: 'memory' uses the in-process grid index, 'database' queries Driver directly
+NEARBY_DRIVER_BACKEND = config('NEARBY_DRIVER_BACKEND', default='memory')
+
+# Driver location pings: latest positions are buffered in memory and written to Driver in one
+# bulk UPDATE per interval (seconds); a batch request carries at most DRIVER_LOCATION_MAX_BATCH pings
+DRIVER_LOCATION_FLUSH_INTERVAL = config('DRIVER_LOCATION_FLUSH_INTERVAL', default=0.5, cast=float)
+DRIVER_LOCATION_FLUSH_BATCH_SIZE = config('DRIVER_LOCATION_FLUSH_BATCH_SIZE', default=500, cast=int)
+DRIVER_LOCATION_MAX_BATCH = config('DRIVER_LOCATION_MAX_BATCH', default=1000, cast=int)
+
+# Driver location trails: pings are stored in one segment per driver per time bucket (seconds)
+LOCATION_TRAIL_SEGMENT_SECONDS = config('LOCATION_TRAIL_SEGMENT_SECONDS', default=120, cast=int)
+LOCATION_TRAIL_MAX_SEGMENT_POINTS = config('LOCATION_TRAIL_MAX_SEGMENT_POINTS', default=1000, cast=int)
+
+# Driver location index (grid cell size in degrees, seconds before a full reload)
+DRIVER_INDEX_CELL_DEG = config('DRIVER_INDEX_CELL_DEG', default=0.005, cast=float)
+DRIVER_INDEX_MAX_AGE = config('DRIVER_INDEX_MAX_AGE', default=60, cast=int)
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -0,0 +1,39 @@
+# Model factories and the API test base shared by the apps' tests and the benchmarks
+from django.core.cache import caches
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+from rides.models import Location, Ride
+from users.models import Driver, Passenger, User
+
+def make_user(name):
+    # Requests authenticate with JWTs, so no password: hashing one per user dominated setup
+    return User.objects.create_user(
+        username=name, email=f'{name}@example.com', password=None, first_name=name, last_name='Test'
+    )
+
+def make_passenger(name, **fields):
+    return Passenger.objects.create(user=make_user(name), **fields)
+
+def make_driver(name, latitude=None, longitude=None, **fields):
+    return Driver.objects.create(
+        user=make_user(name), license_number='L1', vehicle_make='Toyota', vehicle_model='Prius',
+        vehicle_year=2020, vehicle_color='Black', license_plate='AB12 CDE',
+        current_latitude=latitude, current_longitude=longitude, **fields
+    )
+
+def make_ride(passenger, driver=None, latitude=51.5, longitude=-0.1, **fields):
+    pickup = Location.objects.create(latitude=latitude, longitude=longitude, address='1 High St', postcode='SW1A 1AA')
+    dropoff = Location.objects.create(latitude=latitude + 0.02, longitude=longitude, address='2 High St', postcode='SW1A 2AA')
+    return Ride.objects.create(passenger=passenger, driver=driver, pickup_location=pickup, dropoff_location=dropoff, fare=10, **fields)
+
+def bearer(user):
+    return f'Bearer {RefreshToken.for_user(user).access_token}'
+
+class AuthenticatedTestCase(APITestCase):
+    # The auth cache outlives each test's transaction, so users cached by one test
+    # would otherwise be served to the next
+    def setUp(self):
+        caches['auth'].clear()
+    
+    def login(self, user):
+        self.client.credentials(HTTP_AUTHORIZATION=bearer(user))
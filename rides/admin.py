@@ -1,5 +1,8 @@
 from django.contrib import admin
-from .models import Ride, Location
+from .models import Ride, Location, GeocodedPostcode, RoadFactor, OutboxEvent
 
 admin.site.register(Ride)
-admin.site.register(Location)
\ No newline at end of file
+admin.site.register(Location)
+admin.site.register(GeocodedPostcode)
+admin.site.register(RoadFactor)
+admin.site.register(OutboxEvent)
\ No newline at end of file
@@ -0,0 +1,184 @@
+import logging
+import time
+from datetime import timedelta
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from scipy.optimize import linear_sum_assignment
+from users.models import Driver
+from .distance import HaversineDistanceEngine
+from .geo import EARTH_RADIUS_KM, cell_for, ring_cells
+from .models import OutboxEvent, Ride
+from .outbox import record_event
+
+logger = logging.getLogger(__name__)
+
+def haversine_matrix_km(lat1, lng1, lat2, lng2):
+    # Great-circle distance from every point of the first set (rows) to every point of the second (columns)
+    lat1, lng1 = np.radians(lat1)[:, None], np.radians(lng1)[:, None]
+    lat2, lng2 = np.radians(lat2)[None, :], np.radians(lng2)[None, :]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def solve_assignment(cost, feasible, exact_max_pairs):
+    # Matches rows to columns over feasible pairs; returns (rows, cols) index arrays
+    if cost.size > exact_max_pairs:
+        return greedy_assignment(cost, feasible)
+    # Infeasible pairs cost more than all feasible ones together, so the solver first
+    # matches as many rows as it can and then minimizes their total cost
+    penalty = cost[feasible].sum() + 1.0
+    rows, cols = linear_sum_assignment(np.where(feasible, cost, penalty))
+    keep = feasible[rows, cols]
+    return rows[keep], cols[keep]
+
+def greedy_assignment(cost, feasible, nearest=8):
+    # Cheapest pair first, looking only at each row's `nearest` cheapest free columns per round;
+    # rows that lose all of theirs try again against the columns still free
+    cost = np.where(feasible, cost, np.inf)
+    rows = np.flatnonzero(np.isfinite(cost).any(axis=1))
+    free = np.ones(cost.shape[1], dtype=bool)
+    matched_rows, matched_cols = [], []
+    while len(rows) and free.any():
+        cols = np.flatnonzero(free)
+        sub = cost[np.ix_(rows, cols)]
+        k = min(nearest, len(cols))
+        candidates = np.argpartition(sub, k - 1, axis=1)[:, :k]
+        candidate_cost = np.take_along_axis(sub, candidates, axis=1).ravel()
+        order = np.argsort(candidate_cost, kind='stable')
+        order = order[np.isfinite(candidate_cost[order])]
+        used_rows, used_cols = bytearray(len(rows)), bytearray(len(cols))
+        for row, col in zip((order // k).tolist(), candidates.ravel()[order].tolist()):
+            if used_rows[row] or used_cols[col]:
+                continue
+            used_rows[row] = used_cols[col] = 1
+            matched_rows.append(rows[row])
+            matched_cols.append(cols[col])
+        taken_rows = np.frombuffer(used_rows, dtype=bool)
+        if not taken_rows.any():
+            break
+        free[cols[np.frombuffer(used_cols, dtype=bool)]] = False
+        rows = rows[~taken_rows]
+    return np.array(matched_rows, dtype=np.intp), np.array(matched_cols, dtype=np.intp)
+
+class DispatchEngine:
+    # Batch dispatch. Every window, open rides are matched to idle drivers so that the total
+    # pickup ETA over a region is as small as possible, instead of each ride going to whichever
+    # driver polls first. Each ride is then offered to its driver, who alone can accept it until
+    # the offer expires; a ride that isn't accepted goes back into a later window, and is never
+    # offered again to a driver who let it lapse.
+    def __init__(self, estimator=None, region_deg=None, max_pickup_km=None, offer_seconds=None, exact_max_pairs=None):
+        self.estimator = estimator or HaversineDistanceEngine()
+        self.region_deg = region_deg or settings.DISPATCH_REGION_DEG
+        self.max_pickup_km = max_pickup_km or settings.DISPATCH_MAX_PICKUP_KM
+        self.offer_seconds = offer_seconds or settings.DISPATCH_OFFER_SECONDS
+        self.exact_max_pairs = exact_max_pairs or settings.DISPATCH_EXACT_MAX_PAIRS
+        self._offered = {}  # ride id -> drivers it has been offered to
+    
+    def open_rides(self, now):
+        # (id, latitude, longitude) of REQUESTED rides without a live offer
+        rows = Ride.objects.filter(status=Ride.RideStatus.REQUESTED).values_list(
+            'id', 'pickup_location__latitude', 'pickup_location__longitude', 'offer_expires_at', 'pool_partner_id'
+        )
+        rides = []
+        requested = set()
+        for ride_id, latitude, longitude, expires_at, partner_id in rows:
+            requested.add(ride_id)
+            # A pool is dispatched as one ride, through its first request; accepting it takes both
+            if partner_id is not None and partner_id < ride_id:
+                continue
+            if expires_at is None or expires_at < now:
+                rides.append((ride_id, latitude, longitude))
+        # Forget offers of rides that have been accepted or cancelled
+        self._offered = {ride_id: drivers for ride_id, drivers in self._offered.items() if ride_id in requested}
+        return rides
+    
+    def idle_drivers(self, now):
+        # (id, latitude, longitude) of available drivers not on a ride and not holding a live offer
+        on_ride = Ride.objects.filter(driver=OuterRef('pk'), status__in=[Ride.RideStatus.ACCEPTED, Ride.RideStatus.PICKED_UP])
+        holding_offer = Ride.objects.filter(offered_driver=OuterRef('pk'), status=Ride.RideStatus.REQUESTED, offer_expires_at__gte=now)
+        return list(
+            Driver.objects.filter(is_available=True, current_latitude__isnull=False, current_longitude__isnull=False)
+            .exclude(Exists(on_ride)).exclude(Exists(holding_offer))
+            .values_list('id', 'current_latitude', 'current_longitude')
+        )
+    
+    def plan(self, rides, drivers):
+        # rides and drivers are (id, latitude, longitude); returns (ride_id, driver_id, pickup_km) matches.
+        # Regions are solved busiest first, each against the still unmatched drivers in it and the
+        # eight regions around it, so rides near a region edge can still get drivers across it.
+        if not rides or not drivers:
+            return []
+        ride_ids, ride_lat, ride_lng = (np.array(column) for column in zip(*rides))
+        driver_ids, driver_lat, driver_lng = (np.array(column) for column in zip(*drivers))
+        road_factors = np.array([self.estimator.factor_for(lat, lng) for _, lat, lng in rides])
+        
+        ride_regions, driver_regions = {}, {}
+        for index, (_, lat, lng) in enumerate(rides):
+            ride_regions.setdefault(cell_for(lat, lng, self.region_deg), []).append(index)
+        for index, (_, lat, lng) in enumerate(drivers):
+            driver_regions.setdefault(cell_for(lat, lng, self.region_deg), []).append(index)
+        
+        taken = np.zeros(len(drivers), dtype=bool)
+        matches = []
+        for region, ride_indexes in sorted(ride_regions.items(), key=lambda item: -len(item[1])):
+            nearby = [index for ring in (0, 1) for cell in ring_cells(region, ring) for index in driver_regions.get(cell, ())]
+            candidates = np.array(nearby, dtype=np.intp)
+            candidates = candidates[~taken[candidates]]
+            if not len(candidates):
+                continue
+            region_rides = np.array(ride_indexes, dtype=np.intp)
+            pickup_km = haversine_matrix_km(
+                ride_lat[region_rides], ride_lng[region_rides], driver_lat[candidates], driver_lng[candidates]
+            ) * road_factors[region_rides][:, None]
+            feasible = pickup_km <= self.max_pickup_km
+            for row, ride_index in enumerate(ride_indexes):
+                lapsed = self._offered.get(int(ride_ids[ride_index]))
+                if lapsed:
+                    feasible[row] &= ~np.isin(driver_ids[candidates], list(lapsed))
+            
+            rows, cols = solve_assignment(pickup_km, feasible, self.exact_max_pairs)
+            taken[candidates[cols]] = True
+            matches.extend(zip(
+                ride_ids[region_rides[rows]].tolist(), driver_ids[candidates[cols]].tolist(), pickup_km[rows, cols].tolist()
+            ))
+        return matches
+    
+    def offer(self, matches, now):
+        # Returns the number of offers made
+        expires_at = now + timedelta(seconds=self.offer_seconds)
+        offered = 0
+        with transaction.atomic():
+            for ride_id, driver_id, pickup_km in matches:
+                # Skips rides accepted, cancelled or offered by another dispatcher since they were read
+                if Ride.objects.filter(
+                    Q(offer_expires_at__isnull=True) | Q(offer_expires_at__lt=now),
+                    id=ride_id, status=Ride.RideStatus.REQUESTED
+                ).update(offered_driver_id=driver_id, offer_expires_at=expires_at):
+                    # The driver hears about it through the outbox observers
+                    record_event(ride_id, OutboxEvent.EventType.RIDE_OFFERED, {
+                        'driver_id': driver_id,
+                        'pickup_km': round(pickup_km, 3),
+                        'eta_minutes': self.estimator.estimate_minutes(pickup_km),
+                        'expires_at': expires_at.isoformat()
+                    })
+                    self._offered.setdefault(ride_id, set()).add(driver_id)
+                    offered += 1
+        return offered
+    
+    def run_window(self, now=None):
+        now = now or timezone.now()
+        rides = self.open_rides(now)
+        drivers = self.idle_drivers(now) if rides else []
+        started = time.perf_counter()
+        matches = self.plan(rides, drivers)
+        solve_seconds = time.perf_counter() - started
+        offered = self.offer(matches, now) if matches else 0
+        return {
+            'rides': len(rides),
+            'drivers': len(drivers),
+            'offered': offered,
+            'pickup_km': round(sum(pickup_km for _, _, pickup_km in matches), 3),
+            'solve_seconds': round(solve_seconds, 4)
+        }
@@ -0,0 +1,92 @@
+import threading
+import time
+from django.conf import settings
+from django.core.cache import caches
+from .geo import cell_for, haversine_km
+from .models import RoadFactor
+
+class DistanceEngine:
+    # Returns the road distance in km, or None if the engine has no answer
+    def distance_km(self, pickup_location, dropoff_location, timeout=None):
+        raise NotImplementedError
+
+class HaversineDistanceEngine(DistanceEngine):
+    # Great-circle distance scaled by a road factor, calibrated per region
+    # from historical rides when `calibrate_road_factors` has been run
+    def __init__(self, road_factor=None, region_cell_deg=None, refresh_seconds=300):
+        self.road_factor = road_factor or settings.DISTANCE_ROAD_FACTOR
+        self.region_cell_deg = region_cell_deg or settings.DISTANCE_REGION_CELL_DEG
+        self.refresh_seconds = refresh_seconds
+        self._factors = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+    
+    def _regional_factors(self):
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.refresh_seconds:
+            with self._lock:
+                rows = RoadFactor.objects.filter(cell_deg=self.region_cell_deg).values_list('cell_row', 'cell_col', 'factor')
+                self._factors = {(row, col): factor for row, col, factor in rows}
+                self._loaded_at = time.monotonic()
+        return self._factors
+    
+    def factor_for(self, latitude, longitude):
+        region = cell_for(latitude, longitude, self.region_cell_deg)
+        return self._regional_factors().get(region, self.road_factor)
+    
+    def estimate_km(self, origin_lat, origin_lng, destination_lat, destination_lng):
+        straight_line = haversine_km(origin_lat, origin_lng, destination_lat, destination_lng)
+        return round(straight_line * self.factor_for(origin_lat, origin_lng), 3)
+    
+    def estimate_minutes(self, distance_km):
+        return round(distance_km / settings.ESTIMATED_SPEED_KMH * 60, 1)
+    
+    def distance_km(self, pickup_location, dropoff_location, timeout=None):
+        return self.estimate_km(
+            pickup_location.latitude, pickup_location.longitude,
+            dropoff_location.latitude, dropoff_location.longitude
+        )
+
+class GoogleDistanceEngine(DistanceEngine):
+    def __init__(self, maps_service):
+        self.maps_service = maps_service
+    
+    def distance_km(self, pickup_location, dropoff_location, timeout=None):
+        return self.maps_service.calculate_distance(pickup_location, dropoff_location, timeout=timeout)
+
+class FallbackDistanceEngine(DistanceEngine):
+    def __init__(self, primary, fallback):
+        self.primary = primary
+        self.fallback = fallback
+    
+    def distance_km(self, pickup_location, dropoff_location, timeout=None):
+        distance = self.primary.distance_km(pickup_location, dropoff_location, timeout=timeout)
+        if distance is None:
+            return self.fallback.distance_km(pickup_location, dropoff_location)
+        return distance
+
+class CachedDistanceEngine(DistanceEngine):
+    # Memoizes distances by (pickup cell, dropoff cell); trips starting and
+    # ending in the same pair of cells share one lookup
+    def __init__(self, engine, cell_deg=None):
+        self.engine = engine
+        self.cell_deg = cell_deg or settings.DISTANCE_CACHE_CELL_DEG
+        self.cache = caches['distance']
+    
+    def distance_km(self, pickup_location, dropoff_location, timeout=None):
+        pickup_cell = cell_for(pickup_location.latitude, pickup_location.longitude, self.cell_deg)
+        dropoff_cell = cell_for(dropoff_location.latitude, dropoff_location.longitude, self.cell_deg)
+        key = '{}:{}:{}:{}'.format(*pickup_cell, *dropoff_cell)
+        
+        distance = self.cache.get(key)
+        if distance is None:
+            distance = self.engine.distance_km(pickup_location, dropoff_location, timeout=timeout)
+            if distance is not None:
+                self.cache.set(key, distance)
+        return distance
+
+def get_distance_engine(maps_service):
+    haversine = HaversineDistanceEngine()
+    if settings.DISTANCE_ENGINE == 'google':
+        # Only the remote engine is worth memoizing; the local estimate is cheaper than a cache hit
+        return FallbackDistanceEngine(CachedDistanceEngine(GoogleDistanceEngine(maps_service)), haversine)
+    return haversine
@@ -0,0 +1,199 @@
+import heapq
+import math
+import threading
+import time
+from django.conf import settings
+from django.db import connection
+from users.models import Driver
+from .models import Ride, pool_lead
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.195
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+def cell_for(latitude, longitude, cell_deg):
+    return int(math.floor(latitude / cell_deg)), int(math.floor(longitude / cell_deg))
+
+def ring_cells(cell, radius):
+    # Cells at exactly `radius` steps (Chebyshev distance) from `cell`
+    row, col = cell
+    if radius == 0:
+        yield cell
+        return
+    for d in range(-radius, radius + 1):
+        yield row - radius, col + d
+        yield row + radius, col + d
+    for d in range(-radius + 1, radius):
+        yield row + d, col - radius
+        yield row + d, col + radius
+
+def bounding_box(latitude, longitude, radius_km):
+    lat_delta = radius_km / KM_PER_DEGREE
+    lng_delta = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+    return latitude - lat_delta, latitude + lat_delta, longitude - lng_delta, longitude + lng_delta
+
+def min_cell_width_km(latitude, radius_km, cell_deg):
+    # Longitude cells shrink towards the poles, so use the latitude furthest
+    # from the equator that the search can reach
+    worst_lat = min(abs(latitude) + radius_km / KM_PER_DEGREE, 89.0)
+    cell_height = cell_deg * KM_PER_DEGREE
+    return min(cell_height, cell_height * math.cos(math.radians(worst_lat)))
+
+# Uniform lat/lng grid of points keyed by id. It is loaded from the database,
+# kept current in place, and fully reloaded every `max_age` seconds so writes
+# made by other workers show up; subclasses choose the rows.
+class GridIndex:
+    def __init__(self, cell_deg, max_age):
+        self.cell_deg = cell_deg
+        self.max_age = max_age
+        self._cells = {}
+        self._positions = {}
+        self._warmed_at = None
+        self._lock = threading.RLock()
+        self._warm_lock = threading.Lock()
+    
+    def is_loaded(self):
+        return self._warmed_at is not None
+    
+    def is_warm(self):
+        return self.is_loaded() and time.monotonic() - self._warmed_at < self.max_age
+    
+    def load_rows(self):
+        # (id, latitude, longitude) for every point the index should hold
+        raise NotImplementedError
+    
+    def warm(self):
+        cells, positions = {}, {}
+        for key, latitude, longitude in self.load_rows().iterator(chunk_size=5000):
+            cell = cell_for(latitude, longitude, self.cell_deg)
+            cells.setdefault(cell, {})[key] = (latitude, longitude)
+            positions[key] = cell
+        
+        with self._lock:
+            self._cells, self._positions = cells, positions
+            self._warmed_at = time.monotonic()
+    
+    def ensure_warm(self, wait=True):
+        if self.is_warm():
+            return
+        if wait and not self.is_loaded():
+            # First load: callers have nothing to search yet, so wait for it
+            with self._warm_lock:
+                if not self.is_loaded():
+                    self.warm()
+        else:
+            # Reloads happen off the request path; the current grid stays usable meanwhile
+            self.refresh_in_background()
+    
+    def refresh_in_background(self):
+        if self._warm_lock.acquire(blocking=False):
+            threading.Thread(target=self._background_warm, daemon=True).start()
+    
+    def _background_warm(self):
+        try:
+            self.warm()
+        finally:
+            self._warm_lock.release()
+            connection.close()
+    
+    def update(self, key, latitude, longitude):
+        if latitude is None or longitude is None:
+            self.remove(key)
+            return
+        cell = cell_for(latitude, longitude, self.cell_deg)
+        with self._lock:
+            old_cell = self._positions.get(key)
+            if old_cell is not None and old_cell != cell:
+                self._discard(old_cell, key)
+            self._cells.setdefault(cell, {})[key] = (latitude, longitude)
+            self._positions[key] = cell
+    
+    def remove(self, key):
+        with self._lock:
+            cell = self._positions.pop(key, None)
+            if cell is not None:
+                self._discard(cell, key)
+    
+    def position(self, key):
+        # (latitude, longitude) of `key`, or None if it isn't indexed
+        with self._lock:
+            cell = self._positions.get(key)
+            return None if cell is None else self._cells[cell][key]
+    
+    def _discard(self, cell, key):
+        bucket = self._cells.get(cell)
+        if bucket is not None:
+            bucket.pop(key, None)
+            if not bucket:
+                del self._cells[cell]
+    
+    def nearest(self, latitude, longitude, radius_km, limit):
+        # Returns up to `limit` (distance_km, key) pairs within `radius_km`, nearest first
+        origin = cell_for(latitude, longitude, self.cell_deg)
+        step = min_cell_width_km(latitude, radius_km, self.cell_deg)
+        max_ring = int(radius_km // step) + 1
+        
+        best = []  # max-heap of (-distance, key)
+        with self._lock:
+            for ring in range(max_ring + 1):
+                # Anything in this ring or beyond is at least (ring - 1) cells away
+                if len(best) >= limit and -best[0][0] <= (ring - 1) * step:
+                    break
+                for cell in ring_cells(origin, ring):
+                    bucket = self._cells.get(cell)
+                    if not bucket:
+                        continue
+                    for key, (lat, lng) in bucket.items():
+                        distance = haversine_km(latitude, longitude, lat, lng)
+                        if distance > radius_km:
+                            continue
+                        if len(best) < limit:
+                            heapq.heappush(best, (-distance, key))
+                        elif distance < -best[0][0]:
+                            heapq.heapreplace(best, (-distance, key))
+        
+        return sorted((-neg_distance, key) for neg_distance, key in best)
+    
+    def __len__(self):
+        return len(self._positions)
+
+# Positions of available drivers
+class DriverLocationIndex(GridIndex):
+    def __init__(self, cell_deg=None, max_age=None):
+        super().__init__(
+            cell_deg or settings.DRIVER_INDEX_CELL_DEG,
+            max_age if max_age is not None else settings.DRIVER_INDEX_MAX_AGE
+        )
+    
+    def load_rows(self):
+        return Driver.objects.filter(
+            is_available=True,
+            current_latitude__isnull=False,
+            current_longitude__isnull=False
+        ).values_list('id', 'current_latitude', 'current_longitude')
+    
+    def update(self, driver_id, latitude, longitude, is_available=True):
+        if not is_available:
+            self.remove(driver_id)
+            return
+        super().update(driver_id, latitude, longitude)
+
+# REQUESTED rides keyed by pickup cell, without the second rides of pools
+class OpenRideIndex(GridIndex):
+    def __init__(self, cell_deg=None, max_age=None):
+        super().__init__(
+            cell_deg or settings.OPEN_RIDE_INDEX_CELL_DEG,
+            max_age if max_age is not None else settings.OPEN_RIDE_INDEX_MAX_AGE
+        )
+    
+    def load_rows(self):
+        return Ride.objects.filter(pool_lead(), status=Ride.RideStatus.REQUESTED).values_list(
+            'id', 'pickup_location__latitude', 'pickup_location__longitude'
+        )
+
+driver_index = DriverLocationIndex()
+open_ride_index = OpenRideIndex()
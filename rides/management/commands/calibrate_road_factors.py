@@ -0,0 +1,42 @@
+import statistics
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from rides.geo import cell_for, haversine_km
+from rides.models import Ride, RoadFactor
+
+class Command(BaseCommand):
+    help = 'Calibrate per-region road factors from the distances of completed rides'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--min-samples', type=int, default=20)
+        parser.add_argument('--min-km', type=float, default=0.5, help='Ignore trips shorter than this in a straight line')
+    
+    def handle(self, *args, **options):
+        cell_deg = settings.DISTANCE_REGION_CELL_DEG
+        rides = Ride.objects.filter(status=Ride.RideStatus.COMPLETED, distance__gt=0).values_list(
+            'distance',
+            'pickup_location__latitude', 'pickup_location__longitude',
+            'dropoff_location__latitude', 'dropoff_location__longitude'
+        )
+        
+        ratios = {}
+        for distance, pickup_lat, pickup_lng, dropoff_lat, dropoff_lng in rides.iterator(chunk_size=5000):
+            straight_line = haversine_km(pickup_lat, pickup_lng, dropoff_lat, dropoff_lng)
+            if straight_line < options['min_km']:
+                continue
+            ratio = distance / straight_line
+            # Drops the old fixed 5 km fallback and geocoding misses
+            if 1.0 <= ratio <= 3.0:
+                ratios.setdefault(cell_for(pickup_lat, pickup_lng, cell_deg), []).append(ratio)
+        
+        updated = 0
+        for (row, col), samples in ratios.items():
+            if len(samples) < options['min_samples']:
+                continue
+            RoadFactor.objects.update_or_create(
+                cell_deg=cell_deg, cell_row=row, cell_col=col,
+                defaults={'factor': statistics.median(samples), 'sample_count': len(samples)}
+            )
+            updated += 1
+        
+        self.stdout.write(self.style.SUCCESS(f'Calibrated {updated} region(s) from {sum(map(len, ratios.values()))} rides'))
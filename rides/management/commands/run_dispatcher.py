@@ -0,0 +1,27 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from rides.services import RideManagementSystem
+
+class Command(BaseCommand):
+    help = 'Match open rides to idle drivers in batch windows and offer each ride to its driver'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--window', type=float, help='Seconds per dispatch window (default DISPATCH_WINDOW_SECONDS)')
+        parser.add_argument('--once', action='store_true', help='Run a single window and exit')
+    
+    def handle(self, *args, **options):
+        window = options['window'] or settings.DISPATCH_WINDOW_SECONDS
+        # Keep one engine across windows: it remembers who let which offer lapse
+        system = RideManagementSystem()
+        while True:
+            started = time.monotonic()
+            stats = system.dispatch_requested_rides()
+            if stats['offered']:
+                self.stdout.write(
+                    f"Offered {stats['offered']} of {stats['rides']} ride(s) to {stats['drivers']} idle driver(s), "
+                    f"{stats['pickup_km']} pickup km, solved in {stats['solve_seconds']}s"
+                )
+            if options['once']:
+                return
+            time.sleep(max(0.0, window - (time.monotonic() - started)))
@@ -0,0 +1,34 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from rides.outbox import OutboxDispatcher
+
+class Command(BaseCommand):
+    help = 'Deliver ride lifecycle events from the outbox to the ride observers'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, help='Observer threads (default OUTBOX_WORKERS)')
+        parser.add_argument('--batch-size', type=int, help='Events claimed per batch (default OUTBOX_BATCH_SIZE)')
+        parser.add_argument('--once', action='store_true', help='Drain the pending events and exit')
+    
+    def handle(self, *args, **options):
+        dispatcher = OutboxDispatcher(workers=options['workers'], batch_size=options['batch_size'])
+        dispatcher.start()
+        pruned_at = None
+        try:
+            while True:
+                if pruned_at is None or time.monotonic() - pruned_at >= settings.OUTBOX_PRUNE_INTERVAL:
+                    pruned = dispatcher.prune()
+                    pruned_at = time.monotonic()
+                    if pruned:
+                        self.stdout.write(f'Pruned {pruned} delivered event(s)')
+                claimed = dispatcher.dispatch_batch()
+                if claimed:
+                    self.stdout.write(f'Dispatched {claimed} event(s)')
+                    continue
+                if options['once']:
+                    return
+                # Only idle between empty polls; a full backlog is drained back to back
+                time.sleep(settings.OUTBOX_POLL_INTERVAL)
+        finally:
+            dispatcher.stop()
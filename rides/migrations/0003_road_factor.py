@@ -0,0 +1,40 @@
+# Generated by Django 4.2.7 on 2026-10-18 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("rides", "0002_geocoded_postcode"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RoadFactor",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("cell_deg", models.FloatField()),
+                ("cell_row", models.IntegerField()),
+                ("cell_col", models.IntegerField()),
+                ("factor", models.FloatField()),
+                ("sample_count", models.IntegerField(default=0)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="roadfactor",
+            constraint=models.UniqueConstraint(
+                fields=("cell_deg", "cell_row", "cell_col"),
+                name="unique_road_factor_region",
+            ),
+        ),
+    ]
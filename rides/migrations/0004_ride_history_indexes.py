@@ -0,0 +1,26 @@
+# Generated by Django 4.2.7 on 2026-10-18 12:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("rides", "0003_road_factor"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="ride",
+            index=models.Index(
+                fields=["passenger", "request_time", "id"],
+                name="ride_passenger_history_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="ride",
+            index=models.Index(
+                fields=["driver", "request_time", "id"], name="ride_driver_history_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.7 on 2026-10-18 12:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("rides", "0004_ride_history_indexes"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="ride",
+            index=models.Index(
+                condition=models.Q(("status", "REQUESTED")),
+                fields=["request_time"],
+                name="ride_open_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,75 @@
+# Generated by Django 4.2.7 on 2026-10-18 12:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("rides", "0005_ride_open_idx"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OutboxEvent",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "event_type",
+                    models.CharField(
+                        choices=[
+                            ("RIDE_REQUESTED", "Ride Requested"),
+                            ("RIDE_ACCEPTED", "Ride Accepted"),
+                            ("RIDE_STARTED", "Ride Started"),
+                            ("RIDE_COMPLETED", "Ride Completed"),
+                            ("RIDE_CANCELLED", "Ride Cancelled"),
+                        ],
+                        max_length=30,
+                    ),
+                ),
+                ("payload", models.JSONField(blank=True, default=dict)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("dispatched_at", models.DateTimeField(blank=True, null=True)),
+                ("attempts", models.PositiveIntegerField(default=0)),
+                (
+                    "next_attempt_at",
+                    models.DateTimeField(
+                        blank=True, default=django.utils.timezone.now, null=True
+                    ),
+                ),
+                ("last_error", models.TextField(blank=True)),
+                (
+                    "ride",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="events",
+                        to="rides.ride",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        condition=models.Q(("dispatched_at__isnull", True)),
+                        fields=["next_attempt_at", "id"],
+                        name="outbox_pending_idx",
+                    ),
+                    models.Index(
+                        condition=models.Q(("dispatched_at__isnull", False)),
+                        fields=["dispatched_at"],
+                        name="outbox_dispatched_idx",
+                    ),
+                ],
+            },
+        ),
+    ]
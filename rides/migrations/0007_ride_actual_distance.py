@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 13:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("rides", "0006_ride_outbox"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ride",
+            name="actual_distance",
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.7 on 2026-10-18 13:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("rides", "0007_ride_actual_distance"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ride",
+            name="offer_expires_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="ride",
+            name="offered_driver",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="offered_rides",
+                to="users.driver",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="outboxevent",
+            name="event_type",
+            field=models.CharField(
+                choices=[
+                    ("RIDE_REQUESTED", "Ride Requested"),
+                    ("RIDE_OFFERED", "Ride Offered"),
+                    ("RIDE_ACCEPTED", "Ride Accepted"),
+                    ("RIDE_STARTED", "Ride Started"),
+                    ("RIDE_COMPLETED", "Ride Completed"),
+                    ("RIDE_CANCELLED", "Ride Cancelled"),
+                ],
+                max_length=30,
+            ),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.7 on 2026-10-18 13:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("rides", "0008_ride_dispatch_offer"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ride",
+            name="pool_partner",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to="rides.ride",
+            ),
+        ),
+    ]
@@ -1,11 +1,67 @@
 from django.db import models
+from django.utils import timezone
 from users.models import Driver, Passenger
 
 class Location(models.Model):
     latitude = models.FloatField()
     longitude = models.FloatField()
     address = models.CharField(max_length=255)
-    postcode = models.CharField(max_length=20)
+    postcode = models.CharField(max_length=20, db_index=True)
+
+class GeocodedPostcode(models.Model):
+    postcode = models.CharField(max_length=20, unique=True)
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.postcode} ({self.latitude}, {self.longitude})"
+
+class RoadFactor(models.Model):
+    # Ratio of road distance to straight-line distance for one grid region
+    cell_deg = models.FloatField()
+    cell_row = models.IntegerField()
+    cell_col = models.IntegerField()
+    factor = models.FloatField()
+    sample_count = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['cell_deg', 'cell_row', 'cell_col'], name='unique_road_factor_region'),
+        ]
+    
+    def __str__(self):
+        return f"Region {self.cell_row}:{self.cell_col} x{self.factor}"
+
+def available_to(driver):
+    # Rides a driver may accept: no live dispatch offer, or one made to this driver
+    return (
+        models.Q(offered_driver__isnull=True) |
+        models.Q(offer_expires_at__lt=timezone.now()) |
+        models.Q(offered_driver=driver)
+    )
+
+def pool_lead():
+    # Solo rides and the first ride of a pool. The second ride of a pool is never offered or
+    # listed on its own; it is accepted together with the first.
+    return models.Q(pool_partner__isnull=True) | models.Q(pool_partner_id__gt=models.F('id'))
+
+class RideQuerySet(models.QuerySet):
+    def for_response(self):
+        # Loads exactly what RideResponseSerializer reads, in a single query
+        return self.select_related(
+            'pickup_location', 'dropoff_location', 'driver__user', 'passenger__user'
+        ).only(
+            'id', 'request_time', 'pickup_time', 'dropoff_time', 'status', 'ride_type',
+            'fare', 'distance', 'actual_distance', 'rating', 'surge_multiplier', 'payment_method', 'pool_partner',
+            'pickup_location__latitude', 'pickup_location__longitude',
+            'pickup_location__address', 'pickup_location__postcode',
+            'dropoff_location__latitude', 'dropoff_location__longitude',
+            'dropoff_location__address', 'dropoff_location__postcode',
+            'driver__user__first_name', 'driver__user__last_name',
+            'passenger__user__first_name', 'passenger__user__last_name'
+        )
 
 class Ride(models.Model):
     class RideStatus(models.TextChoices):
@@ -31,9 +87,55 @@ class Ride(models.Model):
     ride_type = models.CharField(max_length=20, choices=RideType.choices, default=RideType.STANDARD)
     fare = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     distance = models.FloatField(default=0)
+    # Distance along the driver's location trail between pickup and dropoff
+    actual_distance = models.FloatField(null=True, blank=True)
     rating = models.IntegerField(null=True, blank=True)
     surge_multiplier = models.FloatField(default=1.0)
     payment_method = models.CharField(max_length=50, default='card')
+    # Set by the batch dispatcher (rides/dispatch.py); only this driver can accept until the offer expires
+    offered_driver = models.ForeignKey(Driver, on_delete=models.SET_NULL, null=True, blank=True, related_name='offered_rides')
+    offer_expires_at = models.DateTimeField(null=True, blank=True)
+    # The co-rider of a shared POOL ride (rides/pooling.py); set on both rides of the pair
+    pool_partner = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    
+    objects = RideQuerySet.as_manager()
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['passenger', 'request_time', 'id'], name='ride_passenger_history_idx'),
+            models.Index(fields=['driver', 'request_time', 'id'], name='ride_driver_history_idx'),
+            models.Index(fields=['request_time'], condition=models.Q(status='REQUESTED'), name='ride_open_idx'),
+        ]
+    
+    def __str__(self):
+        return f"Ride {self.id} - {self.status}"
+
+class OutboxEvent(models.Model):
+    # Ride lifecycle events, written in the same transaction as the state change and
+    # delivered to the observers by `run_outbox_worker`
+    class EventType(models.TextChoices):
+        RIDE_REQUESTED = 'RIDE_REQUESTED', 'Ride Requested'
+        RIDE_OFFERED = 'RIDE_OFFERED', 'Ride Offered'
+        RIDE_ACCEPTED = 'RIDE_ACCEPTED', 'Ride Accepted'
+        RIDE_STARTED = 'RIDE_STARTED', 'Ride Started'
+        RIDE_COMPLETED = 'RIDE_COMPLETED', 'Ride Completed'
+        RIDE_CANCELLED = 'RIDE_CANCELLED', 'Ride Cancelled'
+    
+    ride = models.ForeignKey(Ride, on_delete=models.CASCADE, related_name='events')
+    event_type = models.CharField(max_length=30, choices=EventType.choices)
+    payload = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    dispatched_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    # None once retries are exhausted
+    next_attempt_at = models.DateTimeField(null=True, blank=True, default=timezone.now)
+    last_error = models.TextField(blank=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['next_attempt_at', 'id'], condition=models.Q(dispatched_at__isnull=True), name='outbox_pending_idx'),
+            models.Index(fields=['dispatched_at'], condition=models.Q(dispatched_at__isnull=False), name='outbox_dispatched_idx'),
+        ]
     
     def __str__(self):
-        return f"Ride {self.id} - {self.status}"
\ No newline at end of file
+        return f"{self.event_type} for ride {self.ride_id}"
@@ -1,5 +1,8 @@
+import logging
 from abc import ABC, abstractmethod
 
+logger = logging.getLogger(__name__)
+
 class RideObserver(ABC):
     @abstractmethod
     def update(self, ride, event_type):
@@ -9,17 +12,24 @@ class DriverNotificationObserver(RideObserver):
     def update(self, ride, event_type):
         if event_type == 'RIDE_REQUESTED':
             # Notify nearby drivers
-            print(f"Notifying drivers about new ride request: {ride.id}")
+            logger.info("Notifying drivers about new ride request: %s", ride.id)
+        elif event_type == 'RIDE_OFFERED':
+            # Notify the driver picked by the dispatcher
+            logger.info("Offering ride %s to driver %s", ride.id, ride.offered_driver_id)
         elif event_type == 'RIDE_ACCEPTED':
             # Notify passenger that driver accepted
-            print(f"Driver {ride.driver.user.first_name} accepted ride {ride.id}")
+            logger.info("Driver %s accepted ride %s", ride.driver.user.first_name, ride.id)
+        elif event_type == 'RIDE_CANCELLED' and ride.driver_id is not None:
+            logger.info("Ride %s was cancelled", ride.id)
 
 class PassengerNotificationObserver(RideObserver):
     def update(self, ride, event_type):
         if event_type == 'DRIVER_ARRIVED':
-            print(f"Driver has arrived for ride {ride.id}")
+            logger.info("Driver has arrived for ride %s", ride.id)
         elif event_type == 'RIDE_STARTED':
-            print(f"Ride {ride.id} has started")
+            logger.info("Ride %s has started", ride.id)
+        elif event_type == 'RIDE_COMPLETED':
+            logger.info("Ride %s has been completed, fare %s", ride.id, ride.fare)
 
 class RideSubject:
     def __init__(self):
@@ -33,4 +43,9 @@ class RideSubject:
     
     def notify(self, ride, event_type):
         for observer in self._observers:
-            observer.update(ride, event_type)
\ No newline at end of file
+            observer.update(ride, event_type)
+
+# Observers fed by the outbox worker (see rides/outbox.py)
+ride_subject = RideSubject()
+ride_subject.attach(DriverNotificationObserver())
+ride_subject.attach(PassengerNotificationObserver())
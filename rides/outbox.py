@@ -0,0 +1,136 @@
+import logging
+import queue
+import threading
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import OutboxEvent, Ride
+from .observers import ride_subject
+
+logger = logging.getLogger(__name__)
+
+TRANSITION_EVENTS = {
+    'ACCEPTED': OutboxEvent.EventType.RIDE_ACCEPTED,
+    'PICKED_UP': OutboxEvent.EventType.RIDE_STARTED,
+    'COMPLETED': OutboxEvent.EventType.RIDE_COMPLETED,
+    'CANCELLED': OutboxEvent.EventType.RIDE_CANCELLED,
+}
+
+def record_event(ride_id, event_type, payload=None):
+    # Call inside the transaction that changes the ride, so the event exists if and only if the change commits
+    return OutboxEvent.objects.create(ride_id=ride_id, event_type=event_type, payload=payload or {})
+
+class OutboxDispatcher:
+    # Claims pending events in batches and hands them to a pool of worker threads
+    # that run the observers. Events of one ride always go to the same worker, so
+    # they are delivered in order within a batch. Each worker has a bounded queue:
+    # when observers fall behind, claiming stops instead of piling up events in memory.
+    # Delivery is at-least-once; a claim is a lease that expires if the process dies.
+    def __init__(self, subject=None, workers=None, batch_size=None, queue_size=None):
+        self.subject = subject or ride_subject
+        self.workers = workers or settings.OUTBOX_WORKERS
+        self.batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+        queue_size = queue_size or settings.OUTBOX_QUEUE_SIZE
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(self.workers)]
+        self._results_lock = threading.Lock()
+        self._delivered = []
+        self._failed = []
+        self._threads = []
+    
+    def start(self):
+        for worker_queue in self._queues:
+            thread = threading.Thread(target=self._work, args=(worker_queue,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+    
+    def stop(self):
+        for worker_queue in self._queues:
+            worker_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+    
+    def _work(self, worker_queue):
+        while True:
+            event = worker_queue.get()
+            try:
+                if event is None:
+                    # Observers may have lazily queried on this thread
+                    connection.close()
+                    return
+                try:
+                    self.subject.notify(event.ride, event.event_type)
+                except Exception as exc:
+                    logger.exception("Observer failed for outbox event %s", event.id)
+                    with self._results_lock:
+                        self._failed.append((event, repr(exc)))
+                else:
+                    with self._results_lock:
+                        self._delivered.append(event.id)
+            finally:
+                worker_queue.task_done()
+    
+    def claim(self):
+        now = timezone.now()
+        with transaction.atomic():
+            # skip_locked lets several worker processes claim disjoint batches
+            event_ids = list(
+                OutboxEvent.objects.select_for_update(skip_locked=True)
+                .filter(dispatched_at__isnull=True, next_attempt_at__lte=now)
+                .order_by('next_attempt_at', 'id')
+                .values_list('id', flat=True)[:self.batch_size]
+            )
+            OutboxEvent.objects.filter(id__in=event_ids).update(
+                attempts=F('attempts') + 1,
+                next_attempt_at=now + timedelta(seconds=settings.OUTBOX_LEASE_SECONDS)
+            )
+        # Observers get the ride and the event type; attempts sets the retry backoff
+        events = list(OutboxEvent.objects.filter(id__in=event_ids).only('ride_id', 'event_type', 'attempts').order_by('id'))
+        # Observers read the ride and both parties; load each ride once per batch
+        rides = Ride.objects.select_related('driver__user', 'passenger__user').in_bulk({event.ride_id for event in events})
+        for event in events:
+            event.ride = rides[event.ride_id]
+        return events
+    
+    def dispatch_batch(self):
+        # Returns the number of events claimed
+        events = self.claim()
+        for event in events:
+            # Blocks while the worker's queue is full
+            self._queues[event.ride_id % self.workers].put(event)
+        for worker_queue in self._queues:
+            worker_queue.join()
+        self._record_results()
+        return len(events)
+    
+    def _record_results(self):
+        with self._results_lock:
+            delivered, self._delivered = self._delivered, []
+            failed, self._failed = self._failed, []
+        
+        if delivered:
+            OutboxEvent.objects.filter(id__in=delivered).update(dispatched_at=timezone.now(), last_error='')
+        for event, error in failed:
+            OutboxEvent.objects.filter(id=event.id).update(next_attempt_at=self.retry_at(event.attempts), last_error=error)
+    
+    def prune(self):
+        # Deletes delivered events past OUTBOX_RETENTION_SECONDS, a batch per statement so no
+        # single DELETE holds a long run of locks. Events that ran out of retries are kept.
+        # Returns the number deleted.
+        cutoff = timezone.now() - timedelta(seconds=settings.OUTBOX_RETENTION_SECONDS)
+        deleted = 0
+        while True:
+            event_ids = list(
+                OutboxEvent.objects.filter(dispatched_at__lt=cutoff).values_list('id', flat=True)[:self.batch_size]
+            )
+            if not event_ids:
+                return deleted
+            deleted += OutboxEvent.objects.filter(id__in=event_ids).delete()[0]
+    
+    def retry_at(self, attempts):
+        if attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+            return None
+        delay = min(settings.OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1), settings.OUTBOX_RETRY_MAX_SECONDS)
+        return timezone.now() + timedelta(seconds=delay)
@@ -0,0 +1,41 @@
+import base64
+from datetime import datetime
+from django.db.models import Q
+
+class KeysetPagination:
+    # Newest-first keyset pagination on (timestamp field, id). The cursor is the
+    # position of the last row served, so every page is one index range scan
+    # no matter how deep the client has paged.
+    def __init__(self, field, page_size, max_page_size):
+        self.field = field
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+    
+    def paginate(self, queryset, request):
+        # Returns (rows, next_cursor); raises ValueError on a malformed cursor or limit
+        limit = min(int(request.GET.get('limit', self.page_size)), self.max_page_size)
+        if limit < 1:
+            raise ValueError('limit must be positive')
+        
+        cursor = request.GET.get('cursor')
+        if cursor:
+            timestamp, row_id = self.decode_cursor(cursor)
+            queryset = queryset.filter(
+                Q(**{f'{self.field}__lt': timestamp}) | Q(**{self.field: timestamp, 'id__lt': row_id})
+            )
+        
+        rows = list(queryset.order_by(f'-{self.field}', '-id')[:limit + 1])
+        if len(rows) > limit:
+            rows = rows[:limit]
+            return rows, self.encode_cursor(getattr(rows[-1], self.field), rows[-1].id)
+        return rows, None
+    
+    def encode_cursor(self, timestamp, row_id):
+        return base64.urlsafe_b64encode(f'{timestamp.isoformat()}|{row_id}'.encode()).decode()
+    
+    def decode_cursor(self, cursor):
+        try:
+            timestamp, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+            return datetime.fromisoformat(timestamp), int(row_id)
+        except (TypeError, UnicodeError) as e:
+            raise ValueError('Invalid cursor') from e
@@ -0,0 +1,166 @@
+import math
+import threading
+import time
+from itertools import permutations
+from django.conf import settings
+from django.db import connection
+from .geo import cell_for, ring_cells
+from .models import Ride
+
+def bearing_deg(lat1, lng1, lat2, lng2):
+    # Initial compass bearing from the first point to the second
+    lat1, lat2 = math.radians(lat1), math.radians(lat2)
+    d_lng = math.radians(lng2 - lng1)
+    x = math.sin(d_lng) * math.cos(lat2)
+    y = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(d_lng)
+    return math.degrees(math.atan2(x, y)) % 360
+
+# Open POOL rides waiting for a co-rider, bucketed by (pickup cell, dropoff cell, heading
+# sector). A lookup visits only the cells next to the new ride's pickup and dropoff in the
+# neighbouring sectors, so it costs the same with ten or ten thousand open requests. Trips
+# are (pickup_lat, pickup_lng, dropoff_lat, dropoff_lng). Like GridIndex, it is loaded from
+# the database, kept current in place and reloaded every `max_age` seconds.
+class PoolIndex:
+    def __init__(self, cell_deg=None, sectors=None, max_age=None):
+        self.cell_deg = cell_deg or settings.POOL_CELL_DEG
+        self.sectors = sectors or settings.POOL_HEADING_SECTORS
+        self.max_age = max_age if max_age is not None else settings.POOL_INDEX_MAX_AGE
+        self._buckets = {}
+        self._keys = {}
+        self._warmed_at = None
+        self._lock = threading.Lock()
+        self._warm_lock = threading.Lock()
+    
+    def key_for(self, trip):
+        pickup_lat, pickup_lng, dropoff_lat, dropoff_lng = trip
+        sector = int(bearing_deg(*trip) * self.sectors // 360) % self.sectors
+        return (
+            cell_for(pickup_lat, pickup_lng, self.cell_deg),
+            cell_for(dropoff_lat, dropoff_lng, self.cell_deg),
+            sector
+        )
+    
+    def load_rows(self):
+        return Ride.objects.filter(
+            status=Ride.RideStatus.REQUESTED, ride_type=Ride.RideType.POOL, pool_partner__isnull=True
+        ).values_list(
+            'id', 'pickup_location__latitude', 'pickup_location__longitude',
+            'dropoff_location__latitude', 'dropoff_location__longitude'
+        )
+    
+    def warm(self):
+        buckets, keys = {}, {}
+        for ride_id, *trip in self.load_rows().iterator(chunk_size=5000):
+            key = self.key_for(trip)
+            buckets.setdefault(key, {})[ride_id] = tuple(trip)
+            keys[ride_id] = key
+        with self._lock:
+            self._buckets, self._keys = buckets, keys
+            self._warmed_at = time.monotonic()
+    
+    def ensure_warm(self):
+        if self._warmed_at is None:
+            with self._warm_lock:
+                if self._warmed_at is None:
+                    self.warm()
+        elif time.monotonic() - self._warmed_at >= self.max_age and self._warm_lock.acquire(blocking=False):
+            threading.Thread(target=self._background_warm, daemon=True).start()
+    
+    def _background_warm(self):
+        try:
+            self.warm()
+        finally:
+            self._warm_lock.release()
+            connection.close()
+    
+    def add(self, ride_id, trip):
+        key = self.key_for(trip)
+        with self._lock:
+            self._remove(ride_id)
+            self._buckets.setdefault(key, {})[ride_id] = tuple(trip)
+            self._keys[ride_id] = key
+    
+    def remove(self, ride_id):
+        with self._lock:
+            self._remove(ride_id)
+    
+    def _remove(self, ride_id):
+        key = self._keys.pop(ride_id, None)
+        if key is not None:
+            bucket = self._buckets[key]
+            bucket.pop(ride_id, None)
+            if not bucket:
+                del self._buckets[key]
+    
+    def nearby(self, trip, limit):
+        # Up to `limit` (ride_id, trip) pairs with both ends in neighbouring cells and a similar heading
+        pickup_cell, dropoff_cell, sector = self.key_for(trip)
+        pickup_cells = [cell for ring in (0, 1) for cell in ring_cells(pickup_cell, ring)]
+        dropoff_cells = [cell for ring in (0, 1) for cell in ring_cells(dropoff_cell, ring)]
+        sectors = {sector, (sector - 1) % self.sectors, (sector + 1) % self.sectors}
+        found = []
+        with self._lock:
+            for pickup in pickup_cells:
+                for dropoff in dropoff_cells:
+                    for heading in sectors:
+                        bucket = self._buckets.get((pickup, dropoff, heading))
+                        if bucket:
+                            found.extend(bucket.items())
+                            if len(found) >= limit:
+                                return found[:limit]
+        return found
+    
+    def __len__(self):
+        return len(self._keys)
+
+class PoolMatcher:
+    # Finds a co-rider for a new POOL trip among the indexed open ones. A pair is compatible if
+    # some order of the two pickups followed by the two dropoffs keeps each rider's time in the
+    # car within the detour limits (ratio and extra km over riding alone).
+    def __init__(self, estimator, index=None, max_detour_ratio=None, max_detour_km=None, max_candidates=None):
+        self.estimator = estimator
+        self.index = index or pool_index
+        self.max_detour_ratio = max_detour_ratio or settings.POOL_MAX_DETOUR_RATIO
+        self.max_detour_km = max_detour_km if max_detour_km is not None else settings.POOL_MAX_DETOUR_KM
+        self.max_candidates = max_candidates or settings.POOL_MAX_CANDIDATES
+    
+    def route(self, trip, other):
+        # (route_km, solo km of each rider) for the shortest compatible shared route,
+        # or None if every order breaks a detour limit
+        stops = {
+            ('pickup', 0): trip[:2], ('dropoff', 0): trip[2:],
+            ('pickup', 1): other[:2], ('dropoff', 1): other[2:]
+        }
+        solo = (self.estimator.estimate_km(*trip), self.estimator.estimate_km(*other))
+        best = None
+        for first, second in permutations((0, 1)):
+            for third, fourth in permutations((0, 1)):
+                order = [('pickup', first), ('pickup', second), ('dropoff', third), ('dropoff', fourth)]
+                # Distance travelled when each stop is reached
+                travelled = [0.0]
+                for before, after in zip(order, order[1:]):
+                    travelled.append(travelled[-1] + self.estimator.estimate_km(*stops[before], *stops[after]))
+                at = dict(zip(order, travelled))
+                ride_km = tuple(at[('dropoff', rider)] - at[('pickup', rider)] for rider in (0, 1))
+                if any(
+                    ride > solo_km * self.max_detour_ratio or ride - solo_km > self.max_detour_km
+                    for ride, solo_km in zip(ride_km, solo)
+                ):
+                    continue
+                if best is None or travelled[-1] < best:
+                    best = travelled[-1]
+        return None if best is None else (best, solo)
+    
+    def find_partners(self, trip):
+        # Compatible open rides as (ride_id, route_km, solo km of each rider), most km saved first
+        self.index.ensure_warm()
+        matches = []
+        for ride_id, other in self.index.nearby(trip, self.max_candidates):
+            route = self.route(trip, other)
+            if route is not None:
+                route_km, solo = route
+                matches.append((sum(solo) - route_km, ride_id, route_km, solo))
+        matches.sort(key=lambda match: -match[0])
+        return [(ride_id, route_km, solo) for _, ride_id, route_km, solo in matches]
+
+pool_index = PoolIndex()
@@ -0,0 +1,120 @@
+import asyncio
+import threading
+from django.conf import settings
+from .geo import cell_for, ring_cells, min_cell_width_km
+
+# In-process fan-out of ride updates to streaming clients. Keys are ('ride', ride_id)
+# for status changes and ('cell', row, col) for new ride offers around a pickup.
+# Each subscriber keeps a short bounded list of undelivered messages on its event
+# loop; publishers may run on any thread and hand messages over with one
+# call_soon_threadsafe per loop. A slow client loses its oldest messages instead
+# of growing without bound. An idle subscriber costs one pending future and timer.
+class Subscription:
+    __slots__ = ('hub', 'keys', 'loop', 'maxsize', 'messages', 'waiter')
+    
+    def __init__(self, hub, keys, loop, maxsize):
+        self.hub = hub
+        self.keys = keys
+        self.loop = loop
+        self.maxsize = maxsize
+        self.messages = []
+        self.waiter = None
+    
+    def offer(self, message):
+        # Runs on the subscriber's loop
+        if len(self.messages) >= self.maxsize:
+            del self.messages[0]
+        self.messages.append(message)
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+    
+    async def get(self, timeout):
+        # Next message, or None if nothing arrives within `timeout` seconds
+        if not self.messages:
+            self.waiter = self.loop.create_future()
+            timer = self.loop.call_later(timeout, _wake, self.waiter)
+            try:
+                await self.waiter
+            finally:
+                timer.cancel()
+                self.waiter = None
+        return self.messages.pop(0) if self.messages else None
+    
+    def close(self):
+        self.hub.unsubscribe(self)
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+def _deliver(subscriptions, message):
+    for subscription in subscriptions:
+        subscription.offer(message)
+
+class PushHub:
+    def __init__(self, cell_deg=None, queue_size=None):
+        self.cell_deg = cell_deg or settings.PUSH_CELL_DEG
+        self.queue_size = queue_size or settings.PUSH_QUEUE_SIZE
+        self._subscribers = {}
+        self._lock = threading.Lock()
+    
+    def subscribe(self, keys):
+        # Call from the coroutine that will consume the subscription
+        subscription = Subscription(self, tuple(keys), asyncio.get_running_loop(), self.queue_size)
+        with self._lock:
+            for key in subscription.keys:
+                self._subscribers.setdefault(key, set()).add(subscription)
+        return subscription
+    
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for key in subscription.keys:
+                subscribers = self._subscribers.get(key)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[key]
+    
+    def publish(self, key, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(key, ()))
+        by_loop = {}
+        for subscription in subscribers:
+            by_loop.setdefault(subscription.loop, []).append(subscription)
+        for loop, subscriptions in by_loop.items():
+            try:
+                loop.call_soon_threadsafe(_deliver, subscriptions, message)
+            except RuntimeError:
+                # The subscribers' loop has shut down
+                for subscription in subscriptions:
+                    self.unsubscribe(subscription)
+        return len(subscribers)
+    
+    def ride_key(self, ride_id):
+        return ('ride', ride_id)
+    
+    def cell_key(self, latitude, longitude):
+        return ('cell',) + cell_for(latitude, longitude, self.cell_deg)
+    
+    def cell_keys_around(self, latitude, longitude, radius_km):
+        origin = cell_for(latitude, longitude, self.cell_deg)
+        rings = int(radius_km // min_cell_width_km(latitude, radius_km, self.cell_deg)) + 1
+        return [('cell',) + cell for ring in range(rings + 1) for cell in ring_cells(origin, ring)]
+    
+    def publish_status(self, ride_id, status):
+        return self.publish(self.ride_key(ride_id), {'type': 'status', 'ride_id': ride_id, 'status': status})
+    
+    def publish_offer(self, ride_id, latitude, longitude, fare=None):
+        return self.publish(self.cell_key(latitude, longitude), {
+            'type': 'offer', 'ride_id': ride_id, 'latitude': latitude, 'longitude': longitude,
+            'fare': None if fare is None else float(fare)
+        })
+    
+    def publish_withdrawn(self, ride_id, latitude, longitude):
+        return self.publish(self.cell_key(latitude, longitude), {'type': 'withdrawn', 'ride_id': ride_id})
+    
+    def __len__(self):
+        with self._lock:
+            return len({subscription for subscribers in self._subscribers.values() for subscription in subscribers})
+
+push_hub = PushHub()
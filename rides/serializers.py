@@ -24,6 +24,8 @@ class RideResponseSerializer(serializers.ModelSerializer):
     rideType = serializers.CharField(source='ride_type')
     surgeMultiplier = serializers.FloatField(source='surge_multiplier')
     paymentMethod = serializers.CharField(source='payment_method')
+    actualDistance = serializers.FloatField(source='actual_distance', allow_null=True)
+    poolPartnerId = serializers.IntegerField(source='pool_partner_id', allow_null=True)
     fare = serializers.SerializerMethodField()
     driver = serializers.SerializerMethodField()
     passengerName = serializers.SerializerMethodField()
@@ -32,7 +34,7 @@ class RideResponseSerializer(serializers.ModelSerializer):
         model = Ride
         fields = ['id', 'pickupLocation', 'dropoffLocation', 'requestTime', 
                  'pickupTime', 'dropoffTime', 'status', 'rideType', 'fare', 
-                 'distance', 'rating', 'surgeMultiplier', 'paymentMethod', 'driver', 'passengerName']
+                 'distance', 'actualDistance', 'poolPartnerId', 'rating', 'surgeMultiplier', 'paymentMethod', 'driver', 'passengerName']
     
     def get_fare(self, obj):
         return float(obj.fare) if obj.fare else 0.0
@@ -1,16 +1,154 @@
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from decimal import Decimal, ROUND_HALF_UP
 import googlemaps
+import numpy as np
 from django.conf import settings
-from .models import Ride, Location
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import DecimalField, F, Q, Value
+from django.db.models.functions import Least
+from .models import Ride, Location, GeocodedPostcode, OutboxEvent, available_to, pool_lead
+from .outbox import record_event
+from .geo import driver_index, open_ride_index, bounding_box, haversine_km
+from .dispatch import DispatchEngine
+from .distance import HaversineDistanceEngine, get_distance_engine
+from .pooling import PoolMatcher, pool_index
+from .surge import surge_engine
+from .push import push_hub
 from users.models import Driver
+from users.services import ledger_service, driver_rating_service
+from users.trails import location_trails
+
+logger = logging.getLogger(__name__)
+
+CENT = Decimal('0.01')
+
+# Fallback coordinates for London when a postcode can't be geocoded
+DEFAULT_COORDINATES = (51.5074, -0.1278)
+
+def normalize_postcode(postcode):
+    return ''.join(postcode.split()).upper()
+
+class GeocodeCache:
+    # Lookup order: in-process LRU, GeocodedPostcode table, then coordinates
+    # already stored on Location rows for the same postcode
+    def __init__(self):
+        self.cache = caches['geocode']
+        self._lock = threading.Lock()
+        self.reset_stats()
+    
+    def reset_stats(self):
+        with self._lock:
+            self.hits = {'memory': 0, 'database': 0, 'location': 0}
+            self.misses = 0
+    
+    def _record(self, tier=None):
+        with self._lock:
+            if tier:
+                self.hits[tier] += 1
+            else:
+                self.misses += 1
+    
+    def get(self, postcode):
+        key = normalize_postcode(postcode)
+        coordinates = self.cache.get(key)
+        if coordinates:
+            self._record('memory')
+            return coordinates
+        
+        coordinates = GeocodedPostcode.objects.filter(postcode=key).values_list('latitude', 'longitude').first()
+        if coordinates:
+            self._record('database')
+            self.cache.set(key, coordinates)
+            return coordinates
+        
+        # Skip rows that were saved with the fallback coordinates after a failed lookup
+        coordinates = Location.objects.filter(
+            postcode__in={postcode.strip(), key}
+        ).exclude(
+            latitude=DEFAULT_COORDINATES[0], longitude=DEFAULT_COORDINATES[1]
+        ).values_list('latitude', 'longitude').first()
+        if coordinates:
+            self._record('location')
+            self.set(postcode, *coordinates)
+            return coordinates
+        
+        self._record()
+        return None
+    
+    def set(self, postcode, latitude, longitude):
+        key = normalize_postcode(postcode)
+        GeocodedPostcode.objects.update_or_create(
+            postcode=key,
+            defaults={'latitude': latitude, 'longitude': longitude}
+        )
+        self.cache.set(key, (latitude, longitude))
+    
+    def stats(self):
+        with self._lock:
+            hits = sum(self.hits.values())
+            lookups = hits + self.misses
+            return {
+                'hits': dict(self.hits),
+                'misses': self.misses,
+                'hit_rate': hits / lookups if lookups else 0.0
+            }
+
+geocode_cache = GeocodeCache()
+
+# Distance Matrix API limits per request
+MAX_MATRIX_ORIGINS = 25
+MAX_MATRIX_DESTINATIONS = 25
+MAX_MATRIX_ELEMENTS = 100
+
+# Shared, bounded pool for outbound Maps calls so a slow provider can't pile up threads
+maps_executor = ThreadPoolExecutor(max_workers=settings.MAPS_MAX_WORKERS, thread_name_prefix='maps')
 
 class GoogleMapsService:
     def __init__(self):
-        self.client = googlemaps.Client(key=settings.GOOGLE_MAPS_API_KEY) if settings.GOOGLE_MAPS_API_KEY else None
+        self.client = googlemaps.Client(
+            key=settings.GOOGLE_MAPS_API_KEY,
+            timeout=settings.MAPS_CALL_TIMEOUT,
+            retry_timeout=settings.MAPS_CALL_TIMEOUT
+        ) if settings.GOOGLE_MAPS_API_KEY else None
+        self.geocode_cache = geocode_cache
+        self.estimator = HaversineDistanceEngine()
+    
+    def geocode_postcode(self, postcode, timeout=None):
+        return self.geocode_postcodes([postcode], timeout)[0]
+    
+    def geocode_postcodes(self, postcodes, timeout=None):
+        # Cache lookups stay on the calling thread (they may touch the database);
+        # only the remote calls for misses run concurrently on the pool
+        timeout = settings.MAPS_CALL_TIMEOUT if timeout is None else timeout
+        found, pending = {}, {}
+        for postcode in dict.fromkeys(postcodes):
+            coordinates = self.geocode_cache.get(postcode)
+            if coordinates:
+                found[postcode] = coordinates
+            elif self.client:
+                pending[postcode] = maps_executor.submit(self._geocode_remote, postcode)
+        
+        if pending:
+            wait(pending.values(), timeout=timeout)
+        for postcode, future in pending.items():
+            if not future.done():
+                future.cancel()
+                continue
+            coordinates = future.result()
+            if coordinates:
+                self.geocode_cache.set(postcode, *coordinates)
+                found[postcode] = coordinates
+        
+        return [found.get(postcode, DEFAULT_COORDINATES) for postcode in postcodes]
     
-    def geocode_postcode(self, postcode):
+    def _geocode_remote(self, postcode):
         if not self.client:
-            # Fallback coordinates for London if no API key
-            return 51.5074, -0.1278
+            return None
         try:
             result = self.client.geocode(postcode)
             if result:
@@ -18,46 +156,272 @@ class GoogleMapsService:
                 return location['lat'], location['lng']
         except:
             pass
-        return 51.5074, -0.1278  # Default to London
+        return None
     
-    def calculate_distance(self, pickup_location, dropoff_location):
+    def calculate_distance(self, pickup_location, dropoff_location, timeout=None):
         if not self.client:
-            return 5.0  # Default distance
+            return None
+        timeout = settings.MAPS_CALL_TIMEOUT if timeout is None else timeout
+        future = maps_executor.submit(self._distance_remote, pickup_location, dropoff_location)
         try:
-            result = self.client.distance_matrix(
-                origins=[(pickup_location.latitude, pickup_location.longitude)],
-                destinations=[(dropoff_location.latitude, dropoff_location.longitude)],
-                units="metric"
-            )
-            distance = result['rows'][0]['elements'][0]['distance']['value'] / 1000  # Convert to km
-            return distance
+            return future.result(timeout=timeout)
         except:
-            return 5.0
+            future.cancel()
+            return None
+    
+    def _distance_remote(self, pickup_location, dropoff_location):
+        result = self.client.distance_matrix(
+            origins=[(pickup_location.latitude, pickup_location.longitude)],
+            destinations=[(dropoff_location.latitude, dropoff_location.longitude)],
+            units="metric"
+        )
+        return result['rows'][0]['elements'][0]['distance']['value'] / 1000  # Convert to km
+    
+    def distance_matrix(self, origins, destinations, timeout=None):
+        # Origins and destinations are (lat, lng) pairs. Returns a len(origins) x len(destinations)
+        # matrix of (distance_km, duration_min); anything the provider can't answer in time is
+        # filled from the local estimate.
+        timeout = settings.MAPS_CALL_TIMEOUT if timeout is None else timeout
+        unique_origins, origin_slots = self._dedupe_coordinates(origins)
+        unique_destinations, destination_slots = self._dedupe_coordinates(destinations)
+        
+        results = {}
+        if self.client and unique_origins and unique_destinations:
+            origin_chunk, destination_chunk = self._matrix_chunk_sizes(len(unique_origins), len(unique_destinations))
+            futures = [
+                maps_executor.submit(
+                    self._distance_matrix_remote,
+                    unique_origins[i:i + origin_chunk], i,
+                    unique_destinations[j:j + destination_chunk], j
+                )
+                for i in range(0, len(unique_origins), origin_chunk)
+                for j in range(0, len(unique_destinations), destination_chunk)
+            ]
+            wait(futures, timeout=timeout)
+            for future in futures:
+                if not future.done():
+                    future.cancel()
+                elif future.exception() is None:
+                    results.update(future.result())
+        
+        matrix = []
+        for i in origin_slots:
+            row = []
+            for j in destination_slots:
+                element = results.get((i, j))
+                if element is None:
+                    distance = self.estimator.estimate_km(*unique_origins[i], *unique_destinations[j])
+                    element = (distance, self.estimator.estimate_minutes(distance))
+                row.append(element)
+            matrix.append(row)
+        return matrix
+    
+    def distances_to(self, origins, destination, timeout=None):
+        # Many-to-one: one (distance_km, duration_min) per origin
+        return [row[0] for row in self.distance_matrix(origins, [destination], timeout=timeout)]
+    
+    def _matrix_chunk_sizes(self, origin_count, destination_count):
+        # Pick the request shape within the API limits that needs the fewest calls
+        best = None
+        for destination_chunk in range(1, min(MAX_MATRIX_DESTINATIONS, destination_count) + 1):
+            origin_chunk = min(MAX_MATRIX_ORIGINS, MAX_MATRIX_ELEMENTS // destination_chunk, origin_count)
+            calls = -(-origin_count // origin_chunk) * -(-destination_count // destination_chunk)
+            if best is None or calls < best[0]:
+                best = (calls, origin_chunk, destination_chunk)
+        return best[1], best[2]
+    
+    def _dedupe_coordinates(self, coordinates):
+        unique, positions, slots = [], {}, []
+        for latitude, longitude in coordinates:
+            key = (round(latitude, 5), round(longitude, 5))
+            if key not in positions:
+                positions[key] = len(unique)
+                unique.append(key)
+            slots.append(positions[key])
+        return unique, slots
+    
+    def _distance_matrix_remote(self, origins, origin_offset, destinations, destination_offset):
+        result = self.client.distance_matrix(origins=origins, destinations=destinations, units="metric")
+        elements = {}
+        for i, row in enumerate(result['rows']):
+            for j, element in enumerate(row['elements']):
+                if element.get('status') == 'OK':
+                    elements[(origin_offset + i, destination_offset + j)] = (
+                        element['distance']['value'] / 1000,
+                        round(element['duration']['value'] / 60, 1)
+                    )
+        return elements
 
 class FareCalculationStrategy:
+    base_rates = {
+        'STANDARD': 2.0,
+        'POOL': 1.5,
+        'LUXURY': 3.5
+    }
+    default_rate = 2.0
+    base_fare = 5.0
+    
     def calculate_fare(self, distance, ride_type, surge_multiplier=1.0):
-        base_rates = {
-            'STANDARD': 2.0,
-            'POOL': 1.5,
-            'LUXURY': 3.5
-        }
-        base_fare = 5.0
-        rate_per_km = base_rates.get(ride_type, 2.0)
-        return (base_fare + (distance * rate_per_km)) * surge_multiplier
+        rate_per_km = self.base_rates.get(ride_type, self.default_rate)
+        fare = (self.base_fare + (distance * rate_per_km)) * surge_multiplier
+        return Decimal(fare).quantize(CENT, rounding=ROUND_HALF_UP)
+    
+    def calculate_fares(self, distances, ride_types, surge_multipliers=1.0):
+        # Fares repeat a lot across a batch, so each distinct amount becomes a Decimal once
+        cents = self.calculate_fares_in_cents(distances, ride_types, surge_multipliers)
+        amounts, positions = np.unique(cents, return_inverse=True)
+        decimals = np.array([Decimal(amount).scaleb(-2) for amount in amounts.tolist()], dtype=object)
+        return decimals[positions].tolist()
+    
+    def calculate_fares_in_cents(self, distances, ride_types, surge_multipliers=1.0):
+        # Vectorized calculate_fare: same float operations in the same order, so each
+        # fare matches the scalar path exactly. Returns an int64 array of pence.
+        # This is the fast path for bulk pricing: pass NumPy arrays, since converting
+        # Python lists and building Decimals (calculate_fares) cost more than the maths.
+        distances = np.asarray(distances, dtype=np.float64)
+        ride_types = np.asarray(ride_types)
+        rates = np.full(np.broadcast(distances, ride_types).shape, self.default_rate)
+        for ride_type, rate in self.base_rates.items():
+            rates[np.broadcast_to(ride_types == ride_type, rates.shape)] = rate
+        fares = (self.base_fare + (distances * rates)) * np.asarray(surge_multipliers, dtype=np.float64)
+        
+        scaled = fares * 100
+        cents = np.floor(scaled + 0.5).astype(np.int64)
+        # Scaling by 100 can itself round; values that land next to a half-penny
+        # boundary are rounded again exactly, the way calculate_fare does
+        ambiguous = np.abs(scaled - np.floor(scaled) - 0.5) <= 4 * np.spacing(scaled)
+        for index in zip(*np.nonzero(ambiguous)):
+            cents[index] = int(Decimal(float(fares[index])).quantize(CENT, rounding=ROUND_HALF_UP).scaleb(2))
+        return cents
+    
+    def split_fare(self, fare, weights):
+        # Shares of `fare` in proportion to `weights`, adding up to `fare` exactly
+        total = sum(weights)
+        shares = [
+            (fare * Decimal(weight / total if total else 1 / len(weights))).quantize(CENT, rounding=ROUND_HALF_UP)
+            for weight in weights[:-1]
+        ]
+        return shares + [fare - sum(shares)]
+    
+    def quote_all_ride_types(self, distance, surge_multiplier=1.0):
+        ride_types = list(self.base_rates)
+        return dict(zip(ride_types, self.calculate_fares([distance] * len(ride_types), ride_types, surge_multiplier)))
 
 class RideManagementSystem:
     def __init__(self):
         self.maps_service = GoogleMapsService()
+        self.distance_engine = get_distance_engine(self.maps_service)
         self.fare_calculator = FareCalculationStrategy()
+        self.surge_engine = surge_engine
+        self.dispatch_engine = DispatchEngine(self.maps_service.estimator)
+        self.pool_matcher = PoolMatcher(self.maps_service.estimator)
+    
+    def find_nearby_drivers(self, pickup_location, radius_km=10, limit=5):
+        latitude, longitude = pickup_location.latitude, pickup_location.longitude
+        if settings.NEARBY_DRIVER_BACKEND == 'memory':
+            driver_index.ensure_warm(wait=False)
+        
+        if settings.NEARBY_DRIVER_BACKEND == 'memory' and driver_index.is_loaded():
+            matches = driver_index.nearest(latitude, longitude, radius_km, limit)
+        else:
+            # Database mode, or the index is still loading
+            matches = self._find_nearby_drivers_in_db(latitude, longitude, radius_km, limit)
+        
+        # The index can lag behind other workers, so availability is re-checked here
+        drivers = Driver.objects.filter(is_available=True).in_bulk([driver_id for _, driver_id in matches])
+        nearby = []
+        for distance, driver_id in matches:
+            driver = drivers.get(driver_id)
+            if driver:
+                driver.distance_km = distance
+                nearby.append(driver)
+        return nearby
+    
+    def _find_nearby_drivers_in_db(self, latitude, longitude, radius_km, limit):
+        # Bounding-box prefilter on the (is_available, lat, lng) index, exact ranking in Python
+        min_lat, max_lat, min_lng, max_lng = bounding_box(latitude, longitude, radius_km)
+        candidates = Driver.objects.filter(
+            is_available=True,
+            current_latitude__range=(min_lat, max_lat),
+            current_longitude__range=(min_lng, max_lng)
+        ).values_list('id', 'current_latitude', 'current_longitude')
+        
+        matches = []
+        for driver_id, lat, lng in candidates:
+            distance = haversine_km(latitude, longitude, lat, lng)
+            if distance <= radius_km:
+                matches.append((distance, driver_id))
+        return heapq.nsmallest(limit, matches)
+    
+    def find_open_rides(self, latitude, longitude, radius_km=None, limit=None, driver=None):
+        # REQUESTED rides with a pickup within `radius_km` of the given point, nearest first;
+        # given a driver, rides offered to other drivers are left out
+        radius_km = radius_km or settings.OPEN_RIDE_RADIUS_KM
+        limit = limit or settings.OPEN_RIDE_FEED_LIMIT
+        open_ride_index.ensure_warm(wait=False)
+        
+        if open_ride_index.is_loaded():
+            # Over-fetch a little: rides closed by other workers drop out below
+            matches = open_ride_index.nearest(latitude, longitude, radius_km, limit * 2)
+        else:
+            matches = self._find_open_rides_in_db(latitude, longitude, radius_km, limit)
+        
+        rides = Ride.objects.for_response().filter(pool_lead(), status=Ride.RideStatus.REQUESTED)
+        if driver is not None:
+            rides = rides.filter(available_to(driver))
+        rides = rides.in_bulk([ride_id for _, ride_id in matches])
+        nearby = []
+        for distance, ride_id in matches:
+            ride = rides.get(ride_id)
+            if ride is None:
+                if driver is None:
+                    open_ride_index.remove(ride_id)
+            elif len(nearby) < limit:
+                nearby.append(ride)
+        return nearby
+    
+    def _find_open_rides_in_db(self, latitude, longitude, radius_km, limit):
+        min_lat, max_lat, min_lng, max_lng = bounding_box(latitude, longitude, radius_km)
+        candidates = Ride.objects.filter(
+            pool_lead(),
+            status=Ride.RideStatus.REQUESTED,
+            pickup_location__latitude__range=(min_lat, max_lat),
+            pickup_location__longitude__range=(min_lng, max_lng)
+        ).values_list('id', 'pickup_location__latitude', 'pickup_location__longitude')
+        
+        matches = []
+        for ride_id, lat, lng in candidates:
+            distance = haversine_km(latitude, longitude, lat, lng)
+            if distance <= radius_km:
+                matches.append((distance, ride_id))
+        return heapq.nsmallest(limit, matches)
     
-    def find_nearby_drivers(self, pickup_location, radius_km=10):
-        # Simple implementation - in production, use spatial queries
-        return Driver.objects.filter(is_available=True)[:5]
+    def rank_drivers_by_eta(self, pickup_location, drivers, timeout=None):
+        # One batched matrix call for all candidates instead of one call per driver
+        drivers = [driver for driver in drivers if driver.current_latitude is not None and driver.current_longitude is not None]
+        etas = self.maps_service.distances_to(
+            [(driver.current_latitude, driver.current_longitude) for driver in drivers],
+            (pickup_location.latitude, pickup_location.longitude),
+            timeout=timeout
+        )
+        for driver, (distance, minutes) in zip(drivers, etas):
+            driver.pickup_distance_km = distance
+            driver.eta_minutes = minutes
+        return sorted(drivers, key=lambda driver: driver.eta_minutes)
+    
+    def dispatch_requested_rides(self):
+        # One batch-dispatch window; `run_dispatcher` calls this continuously
+        return self.dispatch_engine.run_window()
     
     def create_ride(self, passenger, ride_data):
-        # Geocode postcodes to get coordinates
-        pickup_lat, pickup_lng = self.maps_service.geocode_postcode(ride_data['pickup_postcode'])
-        dropoff_lat, dropoff_lng = self.maps_service.geocode_postcode(ride_data['dropoff_postcode'])
+        # External lookups share one latency budget; each falls back to a default when it runs out
+        deadline = time.monotonic() + settings.RIDE_REQUEST_LATENCY_BUDGET
+        
+        # Geocode both postcodes concurrently
+        (pickup_lat, pickup_lng), (dropoff_lat, dropoff_lng) = self.maps_service.geocode_postcodes(
+            [ride_data['pickup_postcode'], ride_data['dropoff_postcode']],
+            timeout=self._remaining(deadline)
+        )
         
         pickup_location = Location.objects.create(
             latitude=pickup_lat,
@@ -73,19 +437,113 @@ class RideManagementSystem:
             postcode=ride_data['dropoff_postcode']
         )
         
-        distance = self.maps_service.calculate_distance(pickup_location, dropoff_location)
-        fare = self.fare_calculator.calculate_fare(distance, ride_data['ride_type'])
+        distance = self.distance_engine.distance_km(
+            pickup_location, dropoff_location, timeout=self._remaining(deadline)
+        )
         
-        print(f"Distance: {distance}km, Ride Type: {ride_data['ride_type']}, Fare: £{fare}")
+        # This request counts towards demand in its own pickup cell
+        self.surge_engine.record_request(pickup_lat, pickup_lng)
+        surge_multiplier = self.surge_engine.multiplier_for(pickup_lat, pickup_lng)
+        fare = self.fare_calculator.calculate_fare(distance, ride_data['ride_type'], surge_multiplier)
         
-        ride = Ride.objects.create(
-            passenger=passenger,
-            pickup_location=pickup_location,
-            dropoff_location=dropoff_location,
-            ride_type=ride_data['ride_type'],
-            distance=distance,
-            fare=fare,
-            payment_method=ride_data.get('payment_method', 'WALLET')
-        )
+        logger.debug('Distance: %skm, Ride Type: %s, Fare: £%s', distance, ride_data['ride_type'], fare)
+        
+        trip = (pickup_lat, pickup_lng, dropoff_lat, dropoff_lng)
+        is_pool = ride_data['ride_type'] == Ride.RideType.POOL
+        partners = self.pool_matcher.find_partners(trip) if is_pool else []
+        
+        with transaction.atomic():
+            ride = Ride.objects.create(
+                passenger=passenger,
+                pickup_location=pickup_location,
+                dropoff_location=dropoff_location,
+                ride_type=ride_data['ride_type'],
+                distance=distance,
+                fare=fare,
+                surge_multiplier=surge_multiplier,
+                payment_method=ride_data.get('payment_method', 'WALLET')
+            )
+            record_event(ride.id, OutboxEvent.EventType.RIDE_REQUESTED, {'status': ride.status})
+            partner_id = self._join_pool(ride, partners, surge_multiplier) if partners else None
+            if partner_id is None:
+                transaction.on_commit(lambda: push_hub.publish_offer(ride.id, pickup_lat, pickup_lng, ride.fare))
+        if partner_id is not None:
+            # Second ride of the pool: drivers see and accept the pool through the first one
+            pool_index.remove(partner_id)
+        else:
+            open_ride_index.update(ride.id, pickup_lat, pickup_lng)
+            if is_pool:
+                pool_index.add(ride.id, trip)
         
-        return ride
\ No newline at end of file
+        return ride
+    
+    def _join_pool(self, ride, partners, surge_multiplier):
+        # Pairs the new ride with the first candidate that is still waiting; returns its id.
+        # The shared route is priced as one STANDARD trip and split by each rider's solo
+        # distance, and neither rider ever pays more than their solo POOL fare.
+        for partner_id, route_km, solo_km in partners:
+            shared_fare = self.fare_calculator.calculate_fare(route_km, Ride.RideType.STANDARD, surge_multiplier)
+            share, partner_share = self.fare_calculator.split_fare(shared_fare, solo_km)
+            joined = Ride.objects.filter(
+                id=partner_id, status=Ride.RideStatus.REQUESTED, ride_type=Ride.RideType.POOL, pool_partner__isnull=True
+            ).update(
+                pool_partner=ride,
+                fare=Least(F('fare'), Value(partner_share, output_field=DecimalField(max_digits=10, decimal_places=2)))
+            )
+            if joined:
+                ride.pool_partner_id = partner_id
+                ride.fare = min(ride.fare, share)
+                ride.save(update_fields=['pool_partner', 'fare'])
+                return partner_id
+            # Taken by another request meanwhile
+            pool_index.remove(partner_id)
+        return None
+    
+    def settle_ride(self, ride):
+        # Call inside the transaction that completed the ride. The debit is a conditional
+        # UPDATE, so concurrent settlements and top-ups never lose an update; returns
+        # False when the wallet can't cover the fare.
+        if not ledger_service.debit_wallet(ride.passenger_id, ride.fare, ride=ride):
+            return False
+        ledger_service.credit_driver(ride.driver_id, ride.fare, ride=ride)
+        return True
+    
+    def record_actual_distance(self, ride):
+        # Measure the trip along the driver's location trail; leaves it unset without a trail
+        if ride.driver_id is None or ride.pickup_time is None or ride.dropoff_time is None:
+            return None
+        distance = location_trails.distance_km(ride.driver_id, ride.pickup_time, ride.dropoff_time)
+        if distance is not None:
+            ride.actual_distance = round(distance, 3)
+            Ride.objects.filter(id=ride.id).update(actual_distance=ride.actual_distance)
+        return distance
+    
+    def rate_ride(self, ride_id, passenger, rating):
+        # Conditional on the rating we read, so two concurrent ratings of the same ride
+        # can't both count; returns False if the ride isn't the passenger's completed ride
+        while True:
+            ride = Ride.objects.filter(id=ride_id, passenger=passenger, status=Ride.RideStatus.COMPLETED).values('driver_id', 'rating').first()
+            if ride is None:
+                return False
+            if ride['rating'] == rating:
+                return True
+            unchanged = Q(rating__isnull=True) if ride['rating'] is None else Q(rating=ride['rating'])
+            with transaction.atomic():
+                if Ride.objects.filter(unchanged, id=ride_id).update(rating=rating):
+                    if ride['driver_id'] is not None:
+                        driver_rating_service.apply(ride['driver_id'], rating, ride['rating'])
+                    return True
+    
+    def reprice_rides(self, rides, surge_multiplier=None):
+        # What-if repricing of existing rides in one batch; returns {ride_id: new_fare}.
+        # Each ride keeps its recorded surge unless one is given.
+        rows = list(rides.values_list('id', 'distance', 'ride_type', 'surge_multiplier'))
+        if not rows:
+            return {}
+        ride_ids, distances, ride_types, surges = zip(*rows)
+        if surge_multiplier is not None:
+            surges = surge_multiplier
+        return dict(zip(ride_ids, self.fare_calculator.calculate_fares(distances, ride_types, surges)))
+    
+    def _remaining(self, deadline):
+        return max(0.0, min(settings.MAPS_CALL_TIMEOUT, deadline - time.monotonic()))
\ No newline at end of file
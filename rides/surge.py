@@ -0,0 +1,65 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from django.conf import settings
+from .geo import cell_for
+
+# Rolling demand (ride requests) and supply (available drivers reporting a
+# position) per grid cell over a sliding window. Every call does amortized
+# O(1) work: expired entries are popped from the old end of each window.
+class SurgePricingEngine:
+    def __init__(self, cell_deg=None, window_seconds=None):
+        self.cell_deg = cell_deg or settings.SURGE_CELL_DEG
+        self.window_seconds = window_seconds or settings.SURGE_WINDOW_SECONDS
+        self._demand = {}
+        self._supply = {}
+        self._driver_cells = {}
+        self._lock = threading.Lock()
+    
+    def record_request(self, latitude, longitude, now=None):
+        now = time.monotonic() if now is None else now
+        cell = cell_for(latitude, longitude, self.cell_deg)
+        with self._lock:
+            self._demand.setdefault(cell, deque()).append(now)
+    
+    def record_driver(self, driver_id, latitude, longitude, is_available=True, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            old_cell = self._driver_cells.pop(driver_id, None)
+            if old_cell is not None:
+                self._supply[old_cell].pop(driver_id, None)
+            if not is_available or latitude is None or longitude is None:
+                return
+            cell = cell_for(latitude, longitude, self.cell_deg)
+            drivers = self._supply.setdefault(cell, OrderedDict())
+            drivers[driver_id] = now
+            drivers.move_to_end(driver_id)
+            self._driver_cells[driver_id] = cell
+    
+    def counts(self, latitude, longitude, now=None):
+        now = time.monotonic() if now is None else now
+        cutoff = now - self.window_seconds
+        cell = cell_for(latitude, longitude, self.cell_deg)
+        with self._lock:
+            requests = self._demand.get(cell)
+            while requests and requests[0] < cutoff:
+                requests.popleft()
+            drivers = self._supply.get(cell)
+            while drivers:
+                driver_id, last_seen = next(iter(drivers.items()))
+                if last_seen >= cutoff:
+                    break
+                drivers.popitem(last=False)
+                self._driver_cells.pop(driver_id, None)
+            return len(requests or ()), len(drivers or ())
+    
+    def multiplier_for(self, latitude, longitude, now=None):
+        demand, supply = self.counts(latitude, longitude, now)
+        ratio = demand / max(supply, 1)
+        if ratio <= settings.SURGE_DEMAND_THRESHOLD:
+            return 1.0
+        multiplier = 1.0 + settings.SURGE_SENSITIVITY * (ratio - settings.SURGE_DEMAND_THRESHOLD)
+        # Quote surge in 0.1 steps
+        return round(min(multiplier, settings.SURGE_MAX_MULTIPLIER), 1)
+
+surge_engine = SurgePricingEngine()
@@ -0,0 +1,453 @@
+import random
+import threading
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+import numpy as np
+from django.core.cache import caches
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import RefreshToken
+from riderapp.testing import AuthenticatedTestCase, make_driver, make_passenger, make_ride
+from users.models import Driver
+from .dispatch import DispatchEngine, greedy_assignment, solve_assignment
+from .geo import open_ride_index
+from .pooling import pool_index
+from .models import GeocodedPostcode, Location, OutboxEvent, Ride
+from .outbox import OutboxDispatcher
+from .services import FareCalculationStrategy, GoogleMapsService, RideManagementSystem, geocode_cache
+from .transitions import ride_transitions
+from .views import StreamToken
+
+class RideListQueryCountTests(AuthenticatedTestCase):
+    # The list endpoints must cost the same number of queries for one ride or many:
+    # the user joined to both profiles, then the page itself
+    def setUp(self):
+        super().setUp()
+        self.passenger = make_passenger('passenger')
+        self.driver = make_driver('driver', 51.5, -0.1)
+    
+    def test_ride_history_queries_do_not_grow_with_rides(self):
+        self.login(self.passenger.user)
+        self.client.get('/api/rides/history/')
+        for total in (1, 25):
+            while Ride.objects.count() < total:
+                make_ride(self.passenger, self.driver, status=Ride.RideStatus.COMPLETED)
+            with self.assertNumQueries(2):
+                response = self.client.get('/api/rides/history/')
+            self.assertEqual(len(response.json()), total)
+    
+    def test_available_rides_queries_do_not_grow_with_rides(self):
+        self.login(self.driver.user)
+        open_ride_index.warm()
+        self.client.get('/api/rides/available/')
+        # The feed is capped at OPEN_RIDE_FEED_LIMIT (20)
+        for total in (1, 15):
+            while Ride.objects.count() < total:
+                make_ride(self.passenger)
+            open_ride_index.warm()
+            # The driver's position comes with the user
+            with self.assertNumQueries(2):
+                response = self.client.get('/api/rides/available/')
+            self.assertEqual(len(response.json()), total)
+    
+    def test_available_rides_without_position_queries_do_not_grow_with_rides(self):
+        Driver.objects.filter(id=self.driver.id).update(current_latitude=None, current_longitude=None)
+        self.login(self.driver.user)
+        self.client.get('/api/rides/available/')
+        for total in (1, 15):
+            while Ride.objects.count() < total:
+                make_ride(self.passenger)
+            with self.assertNumQueries(2):
+                response = self.client.get('/api/rides/available/')
+            self.assertEqual(len(response.json()), total)
+
+@override_settings(GOOGLE_MAPS_API_KEY='test-key')
+class GeocodeCacheTests(TestCase):
+    def setUp(self):
+        caches['geocode'].clear()
+        geocode_cache.reset_stats()
+        patcher = mock.patch('rides.services.googlemaps.Client')
+        self.client_class = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.maps_client = self.client_class.return_value
+        self.maps_client.geocode.return_value = [{'geometry': {'location': {'lat': 51.501, 'lng': -0.142}}}]
+        self.service = GoogleMapsService()
+    
+    def test_repeat_postcodes_make_no_outbound_calls(self):
+        self.assertEqual(self.service.geocode_postcode('SW1A 1AA'), (51.501, -0.142))
+        self.assertEqual(self.service.geocode_postcode('sw1a1aa'), (51.501, -0.142))
+        self.assertEqual(self.service.geocode_postcodes(['SW1A 1AA', ' sw1a 1aa ']), [(51.501, -0.142)] * 2)
+        self.assertEqual(self.maps_client.geocode.call_count, 1)
+        self.assertEqual(geocode_cache.stats()['misses'], 1)
+    
+    def test_persistent_tier_survives_a_cold_process_cache(self):
+        self.service.geocode_postcode('SW1A 1AA')
+        caches['geocode'].clear()
+        self.assertEqual(self.service.geocode_postcode('SW1A 1AA'), (51.501, -0.142))
+        self.assertEqual(self.maps_client.geocode.call_count, 1)
+        self.assertEqual(geocode_cache.stats()['hits']['database'], 1)
+    
+    def test_existing_locations_are_reused(self):
+        Location.objects.create(latitude=51.52, longitude=-0.08, address='3 Old St', postcode='EC1V 9NR')
+        self.assertEqual(self.service.geocode_postcode('EC1V 9NR'), (51.52, -0.08))
+        self.maps_client.geocode.assert_not_called()
+        self.assertTrue(GeocodedPostcode.objects.filter(postcode='EC1V9NR').exists())
+
+class BatchFareTests(SimpleTestCase):
+    ride_types = ['STANDARD', 'POOL', 'LUXURY', 'UNKNOWN']
+    
+    def setUp(self):
+        self.calculator = FareCalculationStrategy()
+        self.rng = random.Random(7)
+    
+    def assertMatchesScalar(self, distances, ride_types, surges):
+        expected = [self.calculator.calculate_fare(*trip) for trip in zip(distances, ride_types, surges)]
+        self.assertEqual(self.calculator.calculate_fares(distances, ride_types, surges), expected)
+        self.assertEqual(
+            self.calculator.calculate_fares_in_cents(distances, ride_types, surges).tolist(),
+            [int(fare.scaleb(2)) for fare in expected]
+        )
+    
+    def random_trips(self, distances):
+        ride_types = [self.rng.choice(self.ride_types) for _ in distances]
+        surges = [self.rng.choice([1.0, 1.1, 1.25, 1.5, 1.7, 2.0, 2.5, 3.0]) for _ in distances]
+        return distances, ride_types, surges
+    
+    def test_random_fares_match_the_scalar_path(self):
+        self.assertMatchesScalar(*self.random_trips([self.rng.uniform(0, 60) for _ in range(20000)]))
+    
+    def test_exact_half_pennies_round_up(self):
+        # Sixteenths of a km at £2/km land on exact binary values such as £5.125
+        self.assertEqual(self.calculator.calculate_fare(0.0625, 'STANDARD'), Decimal('5.13'))
+        self.assertEqual(self.calculator.calculate_fares([0.0625, 0.75], 'STANDARD', [1.0, 1.25]), [Decimal('5.13'), Decimal('8.13')])
+        self.assertMatchesScalar(*self.random_trips([k / 16 for k in range(2000)]))
+    
+    def test_fares_next_to_half_pennies_match_the_scalar_path(self):
+        # Decimal ties like £5.005 aren't exact in binary and land either side of the half penny
+        self.assertMatchesScalar(*self.random_trips([k / 1000 + 0.0025 for k in range(20000)]))
+
+class RideTransitionTests(TestCase):
+    def setUp(self):
+        self.passenger = make_passenger('passenger')
+        self.drivers = [make_driver(f'driver{n}') for n in range(2)]
+    
+    def test_second_accept_loses(self):
+        ride = make_ride(self.passenger)
+        self.assertTrue(ride_transitions.accept(ride.id, self.drivers[0]))
+        self.assertFalse(ride_transitions.accept(ride.id, self.drivers[1]))
+        ride.refresh_from_db()
+        self.assertEqual((ride.status, ride.driver_id), (Ride.RideStatus.ACCEPTED, self.drivers[0].id))
+    
+    def test_transitions_follow_the_lifecycle(self):
+        ride = make_ride(self.passenger)
+        driver = self.drivers[0]
+        self.assertFalse(ride_transitions.start(ride.id, driver))
+        self.assertTrue(ride_transitions.accept(ride.id, driver))
+        self.assertFalse(ride_transitions.complete(ride.id, driver))
+        self.assertFalse(ride_transitions.start(ride.id, self.drivers[1]))
+        self.assertTrue(ride_transitions.start(ride.id, driver))
+        self.assertTrue(ride_transitions.complete(ride.id, driver))
+        self.assertFalse(ride_transitions.cancel(ride.id, self.passenger.user))
+    
+    def test_live_offer_reserves_the_ride(self):
+        ride = make_ride(
+            self.passenger, offered_driver=self.drivers[0], offer_expires_at=timezone.now() + timedelta(seconds=30)
+        )
+        self.assertFalse(ride_transitions.accept(ride.id, self.drivers[1]))
+        self.assertTrue(ride_transitions.accept(ride.id, self.drivers[0]))
+    
+    def test_pool_is_accepted_through_its_first_ride(self):
+        first = make_ride(
+            self.passenger, ride_type=Ride.RideType.POOL,
+            offered_driver=self.drivers[0], offer_expires_at=timezone.now() + timedelta(seconds=30)
+        )
+        second = make_ride(make_passenger('co-rider'), ride_type=Ride.RideType.POOL, pool_partner=first)
+        Ride.objects.filter(id=first.id).update(pool_partner=second)
+        
+        self.assertFalse(ride_transitions.accept(second.id, self.drivers[1]))
+        self.assertFalse(ride_transitions.accept(first.id, self.drivers[1]))
+        self.assertTrue(ride_transitions.accept(first.id, self.drivers[0]))
+        self.assertEqual(
+            set(Ride.objects.values_list('status', 'driver_id')), {(Ride.RideStatus.ACCEPTED, self.drivers[0].id)}
+        )
+
+@skipUnlessDBFeature('test_db_allows_multiple_connections')
+class ConcurrentTransitionTests(TransactionTestCase):
+    drivers_racing = 16
+    rounds = 10
+    
+    def race(self, *actions):
+        # Runs the actions at the same moment on their own connections; returns their results
+        start = threading.Barrier(len(actions))
+        results = [None] * len(actions)
+        
+        def run(position, action):
+            try:
+                start.wait()
+                results[position] = action()
+            finally:
+                connection.close()
+        
+        threads = [threading.Thread(target=run, args=item) for item in enumerate(actions)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+    
+    def test_exactly_one_driver_wins(self):
+        passenger = make_passenger('passenger')
+        drivers = [make_driver(f'driver{n}') for n in range(self.drivers_racing)]
+        ride = make_ride(passenger)
+        results = self.race(*(lambda driver=driver: ride_transitions.accept(ride.id, driver) for driver in drivers))
+        
+        winners = [driver.id for driver, won in zip(drivers, results) if won]
+        self.assertEqual(len(winners), 1)
+        ride.refresh_from_db()
+        self.assertEqual((ride.status, ride.driver_id), (Ride.RideStatus.ACCEPTED, winners[0]))
+    
+    def test_cancel_racing_accept(self):
+        passenger, driver = make_passenger('passenger'), make_driver('driver')
+        for _ in range(self.rounds):
+            ride = make_ride(passenger)
+            accepted, cancelled = self.race(
+                lambda: ride_transitions.accept(ride.id, driver),
+                lambda: ride_transitions.cancel(ride.id, passenger.user)
+            )
+            ride.refresh_from_db()
+            # Cancelling first leaves nothing to accept; accepting first still lets the passenger cancel
+            self.assertTrue(cancelled)
+            self.assertEqual(ride.status, Ride.RideStatus.CANCELLED)
+            self.assertEqual(ride.driver_id, driver.id if accepted else None)
+    
+    def test_cancel_racing_complete(self):
+        passenger, driver = make_passenger('passenger'), make_driver('driver')
+        for _ in range(self.rounds):
+            ride = make_ride(passenger, driver, status=Ride.RideStatus.PICKED_UP)
+            completed, cancelled = self.race(
+                lambda: ride_transitions.complete(ride.id, driver),
+                lambda: ride_transitions.cancel(ride.id, passenger.user)
+            )
+            ride.refresh_from_db()
+            # A completed ride can't be cancelled, so exactly one of them wins
+            self.assertNotEqual(completed, cancelled)
+            self.assertEqual(ride.status, Ride.RideStatus.COMPLETED if completed else Ride.RideStatus.CANCELLED)
+
+@override_settings(OUTBOX_RETENTION_SECONDS=3600)
+class OutboxPruneTests(TestCase):
+    def test_only_delivered_events_past_retention_are_deleted(self):
+        ride = make_ride(make_passenger('passenger'))
+        now = timezone.now()
+        old, recent = now - timedelta(hours=2), now - timedelta(minutes=5)
+        events = {
+            name: OutboxEvent.objects.create(ride=ride, event_type=OutboxEvent.EventType.RIDE_REQUESTED, **fields)
+            for name, fields in {
+                'delivered_old': {'dispatched_at': old},
+                'delivered_recent': {'dispatched_at': recent},
+                'pending': {'next_attempt_at': old},
+                'out_of_retries': {'next_attempt_at': None},
+            }.items()
+        }
+        
+        self.assertEqual(OutboxDispatcher(batch_size=1).prune(), 1)
+        self.assertEqual(
+            set(OutboxEvent.objects.values_list('id', flat=True)),
+            {events[name].id for name in ('delivered_recent', 'pending', 'out_of_retries')}
+        )
+
+class StreamTokenTests(AuthenticatedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.passenger = make_passenger('passenger')
+        self.ride = make_ride(self.passenger)
+        self.url = f'/api/rides/{self.ride.id}/events/'
+    
+    def open_stream(self, token):
+        response = self.client.get(self.url, {'token': token})
+        response.close()
+        return response.status_code
+    
+    def test_stream_token_opens_a_stream(self):
+        self.assertEqual(self.client.post('/api/rides/events/token/').status_code, 401)
+        self.login(self.passenger.user)
+        response = self.client.post('/api/rides/events/token/')
+        self.assertEqual(response.status_code, 200)
+        self.client.credentials()
+        self.assertEqual(self.open_stream(response.json()['token']), 200)
+    
+    def test_access_token_is_not_accepted_in_the_url(self):
+        self.assertEqual(self.open_stream(str(RefreshToken.for_user(self.passenger.user).access_token)), 401)
+    
+    def test_expired_stream_token_is_rejected(self):
+        token = StreamToken.for_user(self.passenger.user)
+        token.set_exp(lifetime=-timedelta(seconds=1))
+        self.assertEqual(self.open_stream(str(token)), 401)
+    
+    def test_stream_token_is_not_an_access_token(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {StreamToken.for_user(self.passenger.user)}')
+        self.assertEqual(self.client.get('/api/rides/history/').status_code, 401)
+
+class AssignmentTests(SimpleTestCase):
+    def assertMatches(self, result, pairs):
+        rows, cols = result
+        self.assertEqual(sorted(zip(rows.tolist(), cols.tolist())), pairs)
+    
+    def test_infeasible_pairs_never_beat_matching_more_rides(self):
+        # Alone, ride 0 would take driver 0 (1 km); matching both rides costs 50 + 2 km
+        # and must win, while the infeasible 1 km pair for ride 1 is never used
+        cost = np.array([[1.0, 50.0], [2.0, 1.0]])
+        feasible = np.array([[True, True], [True, False]])
+        self.assertMatches(solve_assignment(cost, feasible, exact_max_pairs=100), [(0, 1), (1, 0)])
+    
+    def test_ride_without_feasible_drivers_is_left_out(self):
+        cost = np.array([[1.0, 2.0], [0.5, 0.5]])
+        feasible = np.array([[True, True], [False, False]])
+        self.assertMatches(solve_assignment(cost, feasible, exact_max_pairs=100), [(0, 0)])
+    
+    def test_more_drivers_than_rides(self):
+        cost = np.array([[4.0, 1.0, 3.0], [2.0, 1.5, 9.0]])
+        feasible = np.ones(cost.shape, dtype=bool)
+        self.assertMatches(solve_assignment(cost, feasible, exact_max_pairs=100), [(0, 1), (1, 0)])
+        self.assertMatches(solve_assignment(cost, feasible, exact_max_pairs=0), [(0, 1), (1, 0)])
+    
+    def test_more_rides_than_drivers(self):
+        cost = np.array([[4.0, 2.0], [1.0, 3.0], [2.5, 2.5]])
+        feasible = np.ones(cost.shape, dtype=bool)
+        self.assertMatches(solve_assignment(cost, feasible, exact_max_pairs=100), [(0, 1), (1, 0)])
+        self.assertMatches(solve_assignment(cost, feasible, exact_max_pairs=0), [(0, 1), (1, 0)])
+    
+    def test_greedy_retries_rows_that_lost_their_candidates(self):
+        # With one candidate each, both rides want driver 0; ride 1 loses it in the
+        # first round and takes driver 1 in the second
+        cost = np.array([[1.0, 5.0], [2.0, 3.0]])
+        feasible = np.ones(cost.shape, dtype=bool)
+        self.assertMatches(greedy_assignment(cost, feasible, nearest=1), [(0, 0), (1, 1)])
+    
+    def test_greedy_stops_when_no_feasible_column_is_left(self):
+        cost = np.array([[1.0, 2.0], [2.0, 1.0]])
+        feasible = np.array([[True, True], [True, False]])
+        # Greedy takes the cheapest pair first and strands ride 1; the exact solver doesn't
+        self.assertMatches(greedy_assignment(cost, feasible, nearest=1), [(0, 0)])
+        self.assertMatches(solve_assignment(cost, feasible, exact_max_pairs=100), [(0, 1), (1, 0)])
+
+class DispatchOfferTests(TestCase):
+    def setUp(self):
+        self.ride = make_ride(make_passenger('passenger'), latitude=51.5, longitude=-0.1)
+        self.near = make_driver('near', 51.501, -0.1)
+        self.far = make_driver('far', 51.52, -0.1)
+        self.engine = DispatchEngine(offer_seconds=15)
+        self.now = timezone.now()
+    
+    def run_window(self, seconds):
+        stats = self.engine.run_window(self.now + timedelta(seconds=seconds))
+        self.ride.refresh_from_db()
+        return stats['offered']
+    
+    def test_offer_goes_to_the_nearest_driver_and_reserves_the_ride(self):
+        self.assertEqual(self.run_window(0), 1)
+        self.assertEqual(self.ride.offered_driver_id, self.near.id)
+        self.assertEqual(self.ride.offer_expires_at, self.now + timedelta(seconds=15))
+        self.assertEqual(OutboxEvent.objects.get(event_type=OutboxEvent.EventType.RIDE_OFFERED).payload['driver_id'], self.near.id)
+        # Not offered again while the offer is live
+        self.assertEqual(self.run_window(10), 0)
+        self.assertEqual(self.ride.offered_driver_id, self.near.id)
+    
+    def test_lapsed_offer_goes_to_the_next_driver_only(self):
+        self.run_window(0)
+        self.assertEqual(self.run_window(16), 1)
+        self.assertEqual(self.ride.offered_driver_id, self.far.id)
+        # Both drivers let it lapse: nobody is left to offer it to
+        self.assertEqual(self.run_window(32), 0)
+        self.assertEqual(self.ride.offered_driver_id, self.far.id)
+    
+    def test_driver_holding_an_offer_gets_no_other(self):
+        self.run_window(0)
+        other = make_ride(make_passenger('other'), latitude=51.501, longitude=-0.1)
+        self.assertEqual(self.run_window(1), 1)
+        other.refresh_from_db()
+        self.assertEqual(other.offered_driver_id, self.far.id)
+    
+    def test_accepted_ride_leaves_the_dispatch_pool(self):
+        self.run_window(0)
+        self.assertTrue(ride_transitions.accept(self.ride.id, self.near))
+        self.assertEqual(self.run_window(16), 0)
+        self.assertEqual(self.engine.open_rides(self.now), [])
+        self.assertNotIn(self.ride.id, self.engine._offered)
+
+class PoolTests(TestCase):
+    # Two riders a street apart heading the same way share a car; the reverse trip doesn't fit
+    POSTCODES = {'A1': (51.500, -0.100), 'A2': (51.501, -0.100), 'B1': (51.540, -0.100), 'B2': (51.541, -0.100)}
+    
+    def setUp(self):
+        self.system = RideManagementSystem()
+        patcher = mock.patch.object(
+            self.system.maps_service, 'geocode_postcodes',
+            side_effect=lambda postcodes, timeout=None: [self.POSTCODES[postcode] for postcode in postcodes]
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        pool_index.warm()
+        self.driver = make_driver('driver', 51.5, -0.1)
+    
+    def request(self, name, pickup, dropoff):
+        ride = self.system.create_ride(make_passenger(name), {
+            'pickup_postcode': pickup, 'pickup_address': '1 High St',
+            'dropoff_postcode': dropoff, 'dropoff_address': '2 High St',
+            'ride_type': Ride.RideType.POOL
+        })
+        self.addCleanup(open_ride_index.remove, ride.id)
+        self.addCleanup(pool_index.remove, ride.id)
+        return ride
+    
+    def pair(self, prefix=''):
+        first = self.request(f'{prefix}first', 'A1', 'B1')
+        second = self.request(f'{prefix}second', 'A2', 'B2')
+        first.refresh_from_db()
+        return first, second
+    
+    def test_compatible_requests_are_paired_and_neither_pays_more(self):
+        first = self.request('first', 'A1', 'B1')
+        solo_fare = first.fare
+        second = self.request('second', 'A2', 'B2')
+        first.refresh_from_db()
+        self.assertEqual((first.pool_partner_id, second.pool_partner_id), (second.id, first.id))
+        self.assertLessEqual(first.fare, solo_fare)
+        self.assertLessEqual(
+            second.fare, self.system.fare_calculator.calculate_fare(second.distance, Ride.RideType.POOL, second.surge_multiplier)
+        )
+        self.assertIsNone(self.request('reverse', 'B1', 'A1').pool_partner_id)
+    
+    def test_accepting_the_first_ride_takes_both(self):
+        first, second = self.pair()
+        self.assertTrue(ride_transitions.accept(first.id, self.driver))
+        self.assertEqual(
+            set(Ride.objects.filter(id__in=[first.id, second.id]).values_list('status', 'driver_id')),
+            {(Ride.RideStatus.ACCEPTED, self.driver.id)}
+        )
+    
+    def test_second_ride_cannot_be_accepted(self):
+        first, second = self.pair()
+        self.assertFalse(ride_transitions.accept(second.id, self.driver))
+        self.assertEqual(
+            set(Ride.objects.filter(id__in=[first.id, second.id]).values_list('status', 'driver_id')),
+            {(Ride.RideStatus.REQUESTED, None)}
+        )
+    
+    def test_cancelling_either_ride_relists_the_other_at_the_agreed_fare(self):
+        for cancelled_index in (0, 1):
+            with self.subTest(cancelled=('first', 'second')[cancelled_index]):
+                rides = self.pair(prefix=str(cancelled_index))
+                cancelled, other = rides[cancelled_index], rides[1 - cancelled_index]
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.assertTrue(ride_transitions.cancel(cancelled.id, cancelled.passenger.user))
+                cancelled.refresh_from_db()
+                self.assertEqual((cancelled.status, cancelled.pool_partner_id), (Ride.RideStatus.CANCELLED, None))
+                agreed_fare = other.fare
+                other.refresh_from_db()
+                self.assertEqual((other.status, other.pool_partner_id, other.fare), (Ride.RideStatus.REQUESTED, None, agreed_fare))
+                self.assertIsNotNone(open_ride_index.position(other.id))
+                # Now a solo ride, accepted on its own
+                self.assertTrue(ride_transitions.accept(other.id, self.driver))
+                Ride.objects.filter(id=other.id).update(status=Ride.RideStatus.CANCELLED)
@@ -0,0 +1,103 @@
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .geo import open_ride_index
+from .pooling import pool_index
+from .models import Ride, available_to, pool_lead
+from .push import push_hub
+from .outbox import TRANSITION_EVENTS, record_event
+
+class RideTransitions:
+    # Every state change is a single conditional UPDATE ... WHERE status = <expected>.
+    # A caller has won the transition only if its UPDATE matched the row, so when
+    # several drivers race for one ride exactly one of them gets it, and nobody
+    # waits on a lock for longer than that one statement.
+    def transition(self, ride_id, from_statuses, to_status, condition=None, **changes):
+        rides = Ride.objects.filter(id=ride_id, status__in=from_statuses)
+        if condition is not None:
+            rides = rides.filter(condition)
+        with transaction.atomic():
+            won = rides.update(status=to_status, **changes) == 1
+            if won:
+                # Committed together with the status change; delivered by `run_outbox_worker`
+                record_event(ride_id, TRANSITION_EVENTS[to_status], {'status': to_status})
+                # Runs once the transaction (or the caller's outer one) commits
+                transaction.on_commit(lambda: self.on_transition(ride_id, to_status))
+        return won
+    
+    def on_transition(self, ride_id, to_status):
+        push_hub.publish_status(ride_id, to_status)
+        if to_status != Ride.RideStatus.REQUESTED:
+            pickup = open_ride_index.position(ride_id)
+            open_ride_index.remove(ride_id)
+            pool_index.remove(ride_id)
+            if pickup is not None:
+                # Drivers streaming offers around the pickup drop it from their list
+                push_hub.publish_withdrawn(ride_id, *pickup)
+    
+    def accept(self, ride_id, driver):
+        # While a dispatch offer is live, only the offered driver can take the ride.
+        # The two rides of a pool are driven together: a pool is accepted through its
+        # first ride, which takes the second along, or not at all.
+        with transaction.atomic():
+            won = self.transition(
+                ride_id, [Ride.RideStatus.REQUESTED], Ride.RideStatus.ACCEPTED,
+                condition=available_to(driver) & pool_lead(), driver=driver
+            )
+            if won:
+                partner_id = Ride.objects.filter(id=ride_id).values_list('pool_partner_id', flat=True).first()
+                if partner_id is not None and not self.transition(
+                    partner_id, [Ride.RideStatus.REQUESTED], Ride.RideStatus.ACCEPTED,
+                    condition=available_to(driver), driver=driver
+                ):
+                    # Undoes the first ride's acceptance (and drops its on_commit hooks)
+                    transaction.set_rollback(True)
+                    won = False
+        return won
+    
+    def start(self, ride_id, driver):
+        return self.transition(
+            ride_id, [Ride.RideStatus.ACCEPTED], Ride.RideStatus.PICKED_UP,
+            condition=Q(driver=driver), pickup_time=timezone.now()
+        )
+    
+    def complete(self, ride_id, driver):
+        return self.transition(
+            ride_id, [Ride.RideStatus.PICKED_UP], Ride.RideStatus.COMPLETED,
+            condition=Q(driver=driver), dropoff_time=timezone.now()
+        )
+    
+    def cancel(self, ride_id, user):
+        # Either party can cancel. The condition must stay on the ride's own columns: with a
+        # join (passenger__user=...) Django runs UPDATE ... WHERE id IN (subquery), and
+        # PostgreSQL doesn't re-check that subquery's status filter against a row a
+        # concurrent accept or complete has just changed, so the cancel would overwrite it
+        parties = Q()
+        passenger, driver = getattr(user, 'passenger', None), getattr(user, 'driver', None)
+        if passenger:
+            parties |= Q(passenger_id=passenger.id)
+        if driver:
+            parties |= Q(driver_id=driver.id)
+        if not parties:
+            return False
+        
+        with transaction.atomic():
+            won = self.transition(
+                ride_id,
+                [Ride.RideStatus.REQUESTED, Ride.RideStatus.ACCEPTED, Ride.RideStatus.PICKED_UP],
+                Ride.RideStatus.CANCELLED,
+                condition=parties, pool_partner=None
+            )
+            if won:
+                # The pool is dissolved from both sides: the cancelled ride let go of its partner
+                # in the UPDATE above; the co-rider goes on alone, at the fare already agreed,
+                # and is listed as a solo ride
+                partner = Ride.objects.filter(pool_partner_id=ride_id, status=Ride.RideStatus.REQUESTED).values_list(
+                    'id', 'pickup_location__latitude', 'pickup_location__longitude'
+                ).first()
+                Ride.objects.filter(pool_partner_id=ride_id).update(pool_partner=None)
+                if partner is not None:
+                    transaction.on_commit(lambda: open_ride_index.update(*partner))
+        return won
+
+ride_transitions = RideTransitions()
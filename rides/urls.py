@@ -10,5 +10,9 @@ urlpatterns = [
     path('<int:ride_id>/complete/', views.complete_ride, name='complete_ride'),
     path('<int:ride_id>/cancel/', views.cancel_ride, name='cancel_ride'),
     path('<int:ride_id>/rate/', views.rate_ride, name='rate_ride'),
+    path('<int:ride_id>/events/', views.ride_events, name='ride_events'),
     path('available/', views.get_available_rides, name='get_available_rides'),
+    path('available/events/', views.available_ride_events, name='available_ride_events'),
+    path('events/token/', views.create_stream_token, name='create_stream_token'),
+    path('metrics/geocode-cache/', views.get_geocode_cache_stats, name='get_geocode_cache_stats'),
 ]
\ No newline at end of file
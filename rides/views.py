@@ -1,153 +1,272 @@
+import asyncio
+import json
+from datetime import timedelta
+from asgiref.sync import sync_to_async
 from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.response import Response
-from django.utils import timezone
-from .models import Ride
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.http import JsonResponse, StreamingHttpResponse
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken, TokenError
+from rest_framework_simplejwt.tokens import Token
+from .models import Ride, available_to, pool_lead
 from .serializers import RideRequestSerializer, RideResponseSerializer
-from .services import RideManagementSystem
-from users.models import Passenger, Driver
+from .pagination import KeysetPagination
+from .geo import haversine_km
+from .push import push_hub
+from .services import RideManagementSystem, geocode_cache
+from .transitions import ride_transitions
+from users.authentication import CachedJWTAuthentication
+from users.roles import load_fields
 
 ride_system = RideManagementSystem()
+ride_history_pagination = KeysetPagination('request_time', settings.RIDE_HISTORY_PAGE_SIZE, settings.RIDE_HISTORY_MAX_PAGE_SIZE)
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def request_ride(request):
-    try:
-        passenger = Passenger.objects.get(user=request.user)
-    except Passenger.DoesNotExist:
+    if not request.passenger:
         return Response({'error': 'User is not a passenger'}, status=status.HTTP_400_BAD_REQUEST)
     
     serializer = RideRequestSerializer(data=request.data)
     if serializer.is_valid():
-        ride = ride_system.create_ride(passenger, serializer.validated_data)
+        ride = ride_system.create_ride(request.passenger, serializer.validated_data)
         return Response(RideResponseSerializer(ride).data, status=status.HTTP_201_CREATED)
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_ride_history(request):
+    # Passenger history first, then driver
+    if request.passenger:
+        rides = Ride.objects.filter(passenger_id=request.passenger.id)
+    elif request.driver:
+        rides = Ride.objects.filter(driver_id=request.driver.id)
+    else:
+        return Response({'error': 'User is neither passenger nor driver'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    rides = rides.for_response().exclude(status='CANCELLED')
+    if request.GET.get('export') == 'ndjson':
+        return _stream_ndjson(request, rides.order_by('-request_time', '-id'), RideResponseSerializer())
+    
     try:
-        # Try passenger first
-        passenger = Passenger.objects.get(user=request.user)
-        rides = Ride.objects.filter(passenger=passenger).exclude(status='CANCELLED').order_by('-request_time')
-        return Response(RideResponseSerializer(rides, many=True).data)
-    except Passenger.DoesNotExist:
-        try:
-            # Try driver
-            driver = Driver.objects.get(user=request.user)
-            rides = Ride.objects.filter(driver=driver).exclude(status='CANCELLED').order_by('-request_time')
-            return Response(RideResponseSerializer(rides, many=True).data)
-        except Driver.DoesNotExist:
-            return Response({'error': 'User is neither passenger nor driver'}, status=status.HTTP_400_BAD_REQUEST)
+        page, next_cursor = ride_history_pagination.paginate(rides, request)
+    except ValueError:
+        return Response({'error': 'Invalid cursor or limit'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    # The body stays a plain list; the next page is advertised in a header
+    response = Response(RideResponseSerializer(page, many=True).data)
+    if next_cursor:
+        response['X-Next-Cursor'] = next_cursor
+    return response
+
+def _stream_ndjson(request, queryset, serializer):
+    # Rows come from a server-side cursor in chunks instead of loading the whole result.
+    # Under ASGI the body must be an async iterator: Django collects a sync one into a list
+    # before sending it.
+    def line(obj):
+        return json.dumps(serializer.to_representation(obj), cls=DjangoJSONEncoder) + '\n'
+    
+    if isinstance(request._request, ASGIRequest):
+        async def rows():
+            async for obj in queryset.aiterator(chunk_size=500):
+                yield line(obj)
+        return StreamingHttpResponse(rows(), content_type='application/x-ndjson')
+    return StreamingHttpResponse((line(obj) for obj in queryset.iterator(chunk_size=500)), content_type='application/x-ndjson')
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_current_ride(request):
-    try:
-        passenger = Passenger.objects.get(user=request.user)
-        ride = Ride.objects.filter(
-            passenger=passenger,
-            status__in=['REQUESTED', 'ACCEPTED', 'PICKED_UP']
-        ).first()
-        
-        if ride:
-            return Response(RideResponseSerializer(ride).data)
-        return Response({'message': 'No active ride'}, status=status.HTTP_404_NOT_FOUND)
-    except Passenger.DoesNotExist:
+    if not request.passenger:
         return Response({'error': 'User is not a passenger'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    ride = Ride.objects.for_response().filter(
+        passenger_id=request.passenger.id,
+        status__in=['REQUESTED', 'ACCEPTED', 'PICKED_UP']
+    ).first()
+    
+    if ride:
+        return Response(RideResponseSerializer(ride).data)
+    return Response({'message': 'No active ride'}, status=status.HTTP_404_NOT_FOUND)
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def accept_ride(request, ride_id):
-    try:
-        driver = Driver.objects.get(user=request.user)
-    except Driver.DoesNotExist:
+    if not request.driver:
         return Response({'error': 'User is not a driver'}, status=status.HTTP_400_BAD_REQUEST)
     
-    try:
-        ride = Ride.objects.get(id=ride_id, status='REQUESTED')
-        ride.driver = driver
-        ride.status = 'ACCEPTED'
-        ride.save()
-        return Response(RideResponseSerializer(ride).data)
-    except Ride.DoesNotExist:
+    if not ride_transitions.accept(ride_id, request.driver):
         return Response({'error': 'Ride not found or already accepted'}, status=status.HTTP_404_NOT_FOUND)
+    return Response(RideResponseSerializer(Ride.objects.for_response().get(id=ride_id)).data)
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def start_ride(request, ride_id):
-    try:
-        driver = Driver.objects.get(user=request.user)
-        ride = Ride.objects.get(id=ride_id, driver=driver, status='ACCEPTED')
-        ride.status = 'PICKED_UP'
-        ride.pickup_time = timezone.now()
-        ride.save()
-        return Response(RideResponseSerializer(ride).data)
-    except (Driver.DoesNotExist, Ride.DoesNotExist):
+    if not request.driver or not ride_transitions.start(ride_id, request.driver):
         return Response({'error': 'Ride not found'}, status=status.HTTP_404_NOT_FOUND)
+    return Response(RideResponseSerializer(Ride.objects.for_response().get(id=ride_id)).data)
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def complete_ride(request, ride_id):
-    from decimal import Decimal
     try:
-        driver = Driver.objects.get(user=request.user)
-        ride = Ride.objects.get(id=ride_id, driver=driver, status='PICKED_UP')
-        ride.status = 'COMPLETED'
-        ride.dropoff_time = timezone.now()
-        
-        # Process payment - deduct from passenger wallet and add to driver earnings
-        passenger = ride.passenger
-        fare = Decimal(str(ride.fare))
-        
-        if passenger.wallet_balance >= fare:
-            passenger.wallet_balance -= fare
-            passenger.save()
-            
-            driver.earnings += fare
-            driver.save()
-            
-        ride.save()
+        if not request.driver:
+            raise Ride.DoesNotExist
+        with transaction.atomic():
+            if not ride_transitions.complete(ride_id, request.driver):
+                raise Ride.DoesNotExist
+            ride = Ride.objects.for_response().get(id=ride_id)
+            # Process payment - deduct from passenger wallet and add to driver earnings
+            ride_system.settle_ride(ride)
+        ride_system.record_actual_distance(ride)
         return Response(RideResponseSerializer(ride).data)
-    except (Driver.DoesNotExist, Ride.DoesNotExist):
+    except Ride.DoesNotExist:
         return Response({'error': 'Ride not found'}, status=status.HTTP_404_NOT_FOUND)
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def cancel_ride(request, ride_id):
-    try:
-        ride = Ride.objects.get(id=ride_id)
-        if ride.passenger.user == request.user or (ride.driver and ride.driver.user == request.user):
-            ride.status = 'CANCELLED'
-            ride.save()
-            return Response(RideResponseSerializer(ride).data)
-        return Response({'error': 'Unauthorized'}, status=status.HTTP_403_FORBIDDEN)
-    except Ride.DoesNotExist:
+    if ride_transitions.cancel(ride_id, request.user):
+        return Response(RideResponseSerializer(Ride.objects.for_response().get(id=ride_id)).data)
+    
+    # Lost the update: work out why
+    ride = Ride.objects.filter(id=ride_id).values('passenger__user_id', 'driver__user_id').first()
+    if ride is None:
         return Response({'error': 'Ride not found'}, status=status.HTTP_404_NOT_FOUND)
+    if request.user.id not in (ride['passenger__user_id'], ride['driver__user_id']):
+        return Response({'error': 'Unauthorized'}, status=status.HTTP_403_FORBIDDEN)
+    return Response({'error': 'Ride can no longer be cancelled'}, status=status.HTTP_400_BAD_REQUEST)
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def rate_ride(request, ride_id):
-    try:
-        passenger = Passenger.objects.get(user=request.user)
-        ride = Ride.objects.get(id=ride_id, passenger=passenger, status='COMPLETED')
-        rating = int(request.data.get('rating') or request.GET.get('rating', 0))
-        
-        if 1 <= rating <= 5:
-            ride.rating = rating
-            ride.save()
-            return Response(RideResponseSerializer(ride).data)
+    if not request.passenger:
+        return Response({'error': 'Ride not found'}, status=status.HTTP_404_NOT_FOUND)
+    
+    rating = int(request.data.get('rating') or request.GET.get('rating', 0))
+    if not 1 <= rating <= 5:
         return Response({'error': 'Rating must be between 1 and 5'}, status=status.HTTP_400_BAD_REQUEST)
-    except (Passenger.DoesNotExist, Ride.DoesNotExist):
+    if not ride_system.rate_ride(ride_id, request.passenger, rating):
         return Response({'error': 'Ride not found'}, status=status.HTTP_404_NOT_FOUND)
+    return Response(RideResponseSerializer(Ride.objects.for_response().get(id=ride_id)).data)
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_available_rides(request):
+    driver = request.driver
+    if not driver:
+        return Response({'error': 'User is not a driver'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    try:
+        radius_km = min(float(request.GET.get('radius_km', settings.OPEN_RIDE_RADIUS_KM)), settings.OPEN_RIDE_MAX_RADIUS_KM)
+    except ValueError:
+        return Response({'error': 'Invalid radius'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    load_fields(driver, 'current_latitude', 'current_longitude')
+    if driver.current_latitude is None or driver.current_longitude is None:
+        # No known position yet: newest open rides, served from the partial index on status
+        rides = Ride.objects.for_response().filter(available_to(driver), pool_lead(), status='REQUESTED').order_by('-request_time')[:settings.OPEN_RIDE_FEED_LIMIT]
+    else:
+        rides = ride_system.find_open_rides(driver.current_latitude, driver.current_longitude, radius_km, driver=driver)
+    return Response(RideResponseSerializer(rides, many=True).data)
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def get_geocode_cache_stats(request):
+    return Response(geocode_cache.stats())
+
+# Server-Sent Events streams. These are plain async Django views rather than DRF ones so
+# an idle subscriber holds no thread; they need the ASGI entry point (riderapp/asgi.py).
+# Browsers' EventSource can't set headers, so a stream can also be opened with ?token=
+# carrying a StreamToken. URLs end up in access logs and browser history, so that token
+# only opens streams and expires soon; the access token is never accepted in the URL.
+class StreamToken(Token):
+    token_type = 'stream'
+    lifetime = timedelta(seconds=settings.PUSH_STREAM_TOKEN_SECONDS)
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def create_stream_token(request):
+    return Response({'token': str(StreamToken.for_user(request.user)), 'expires_in': settings.PUSH_STREAM_TOKEN_SECONDS})
+
+def _stream_user(request):
+    authenticator = CachedJWTAuthentication()
+    try:
+        raw_token = request.GET.get('token')
+        if raw_token:
+            return authenticator.get_user(StreamToken(raw_token))
+        result = authenticator.authenticate(request)
+        return result[0] if result else None
+    except (TokenError, InvalidToken, AuthenticationFailed):
+        return None
+
+def _sse(message):
+    return f"event: {message['type']}\ndata: {json.dumps(message, cls=DjangoJSONEncoder)}\n\n"
+
+def _event_stream(subscription, initial=(), accept=None):
+    async def events():
+        try:
+            loop = asyncio.get_running_loop()
+            # Streams end after a while and EventSource reconnects, so a subscription whose
+            # client vanished without the server noticing can't outlive this
+            closes_at = loop.time() + settings.PUSH_MAX_STREAM_SECONDS
+            yield 'retry: 3000\n\n'
+            for message in initial:
+                yield _sse(message)
+            while loop.time() < closes_at:
+                message = await subscription.get(settings.PUSH_HEARTBEAT_SECONDS)
+                if message is None:
+                    yield ': keep-alive\n\n'
+                elif accept is None or accept(message):
+                    yield _sse(message)
+        finally:
+            subscription.close()
+    
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+async def ride_events(request, ride_id):
+    user = await sync_to_async(_stream_user)(request)
+    if user is None:
+        return JsonResponse({'error': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
+    
+    # Subscribe before reading the status so a change in between isn't missed
+    subscription = push_hub.subscribe([push_hub.ride_key(ride_id)])
+    ride = await sync_to_async(
+        Ride.objects.filter(id=ride_id).values('status', 'passenger__user_id', 'driver__user_id').first
+    )()
+    if ride is None or user.id not in (ride['passenger__user_id'], ride['driver__user_id']):
+        subscription.close()
+        return JsonResponse({'error': 'Ride not found'}, status=status.HTTP_404_NOT_FOUND)
+    return _event_stream(subscription, [{'type': 'status', 'ride_id': ride_id, 'status': ride['status']}])
+
+async def available_ride_events(request):
+    user = await sync_to_async(_stream_user)(request)
+    if user is None:
+        return JsonResponse({'error': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
+    driver = getattr(user, 'driver', None)
+    if driver is None:
+        return JsonResponse({'error': 'User is not a driver'}, status=status.HTTP_400_BAD_REQUEST)
+    await sync_to_async(load_fields)(driver, 'current_latitude', 'current_longitude')
+    
     try:
-        driver = Driver.objects.get(user=request.user)
-        rides = Ride.objects.filter(status='REQUESTED')
-        return Response(RideResponseSerializer(rides, many=True).data)
-    except Driver.DoesNotExist:
-        return Response({'error': 'User is not a driver'}, status=status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
+        latitude = float(request.GET.get('latitude', driver.current_latitude))
+        longitude = float(request.GET.get('longitude', driver.current_longitude))
+        radius_km = min(float(request.GET.get('radius_km', settings.OPEN_RIDE_RADIUS_KM)), settings.OPEN_RIDE_MAX_RADIUS_KM)
+    except (TypeError, ValueError):
+        return JsonResponse({'error': 'A location and a valid radius are required'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    def within_radius(message):
+        # Cells cover a square around the driver; trim offers to the circle
+        if message['type'] != 'offer':
+            return True
+        return haversine_km(latitude, longitude, message['latitude'], message['longitude']) <= radius_km
+    
+    subscription = push_hub.subscribe(push_hub.cell_keys_around(latitude, longitude, radius_km))
+    return _event_stream(subscription, accept=within_radius)
\ No newline at end of file
@@ -1,6 +1,8 @@
 from django.contrib import admin
-from .models import User, Driver, Passenger
+from .models import User, Driver, Passenger, LedgerEntry, LocationSegment
 
 admin.site.register(User)
 admin.site.register(Driver)
-admin.site.register(Passenger)
\ No newline at end of file
+admin.site.register(Passenger)
+admin.site.register(LedgerEntry)
+admin.site.register(LocationSegment)
\ No newline at end of file
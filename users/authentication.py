@@ -0,0 +1,96 @@
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+from .models import Driver, Passenger, User
+from .roles import ROLE_RELATIONS, set_roles
+
+class RoleJWTAuthentication(JWTAuthentication):
+    # JWTAuthentication that fetches the user's Passenger and Driver profiles in the same
+    # query as the user, so role checks in the views cost nothing
+    def get_user(self, validated_token):
+        user = self.load_user(self.user_id_from(validated_token))
+        self.check_user(user, validated_token)
+        return user
+    
+    def user_id_from(self, validated_token):
+        try:
+            return validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+    
+    def load_user(self, user_id):
+        try:
+            return self.user_model.objects.select_related(*ROLE_RELATIONS).get(**{api_settings.USER_ID_FIELD: user_id})
+        except self.user_model.DoesNotExist:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+    
+    def check_user(self, user, validated_token):
+        if not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+        if api_settings.CHECK_REVOKE_TOKEN and validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+            raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+
+# What a cache entry keeps of each row. Profiles keep their ids (and the driver's availability);
+# their other fields come back deferred, so balances, earnings and positions are read fresh
+# from the database when a view uses them.
+def _cached_fields(model, *names):
+    # In model order, which is what from_db expects
+    return tuple(field.attname for field in model._meta.concrete_fields if not names or field.attname in names)
+
+USER_FIELDS = _cached_fields(User)
+PROFILE_FIELDS = {
+    'passenger': (Passenger, _cached_fields(Passenger, 'id', 'user_id')),
+    'driver': (Driver, _cached_fields(Driver, 'id', 'user_id', 'is_available')),
+}
+
+auth_cache = caches['auth']
+# Saves only invalidate the entry in the cache they run against. A per-process cache would
+# serve other workers' stale rows (names, role ids, driver availability, password hashes and
+# active flags) until the TTL, so with one users are loaded from the database on every
+# request, as RoleJWTAuthentication does. Caching needs a cache all workers share.
+AUTH_CACHE_SHARED = not isinstance(auth_cache, LocMemCache)
+
+def user_cache_key(user_id):
+    return f'user:{user_id}'
+
+def invalidate_user(user_id):
+    auth_cache.delete(user_cache_key(user_id))
+
+class CachedJWTAuthentication(RoleJWTAuthentication):
+    # Verifies the token as usual, then takes the user and their role ids from a bounded TTL
+    # cache instead of the database. Saving or deleting a user or profile drops the entry
+    # (users/signals.py), which covers profile updates, password resets and deactivation.
+    # Without a shared cache it is plain RoleJWTAuthentication.
+    def get_user(self, validated_token):
+        if not AUTH_CACHE_SHARED:
+            return super().get_user(validated_token)
+        user_id = self.user_id_from(validated_token)
+        key = user_cache_key(user_id)
+        entry = auth_cache.get(key)
+        if entry is None:
+            user = self.load_user(user_id)
+            auth_cache.set(key, self.pack(user))
+        else:
+            user = self.unpack(entry)
+        self.check_user(user, validated_token)
+        return user
+    
+    def pack(self, user):
+        profiles = {}
+        for name, (model, fields) in PROFILE_FIELDS.items():
+            profile = getattr(user, name, None)
+            profiles[name] = None if profile is None else tuple(getattr(profile, field) for field in fields)
+        return tuple(getattr(user, field) for field in USER_FIELDS), profiles
+    
+    def unpack(self, entry):
+        values, profiles = entry
+        user = User.from_db(DEFAULT_DB_ALIAS, USER_FIELDS, values)
+        return set_roles(user, **{
+            name: None if profiles[name] is None else model.from_db(DEFAULT_DB_ALIAS, fields, profiles[name])
+            for name, (model, fields) in PROFILE_FIELDS.items()
+        })
@@ -0,0 +1,85 @@
+import atexit
+import logging
+import threading
+import time
+from django.conf import settings
+from django.db import connection
+from rides.geo import driver_index
+from rides.surge import surge_engine
+from .models import Driver
+from .trails import location_trails
+
+logger = logging.getLogger(__name__)
+
+# Latest reported position per driver. Pings update the in-memory driver index and
+# surge counts straight away; the Driver table only gets each driver's last position
+# every `flush_interval` seconds, as one bulk UPDATE of the two location columns.
+# Every ping also goes to the driver's location trail, flushed on the same thread.
+class DriverPositionStore:
+    def __init__(self, flush_interval=None, batch_size=None):
+        self.flush_interval = flush_interval or settings.DRIVER_LOCATION_FLUSH_INTERVAL
+        self.batch_size = batch_size or settings.DRIVER_LOCATION_FLUSH_BATCH_SIZE
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+    
+    def record(self, driver_id, latitude, longitude, is_available=True, timestamp=None):
+        self.record_pings([(driver_id, timestamp or time.time(), latitude, longitude)], {driver_id: is_available})
+    
+    def record_pings(self, pings, availability):
+        # pings: (driver_id, timestamp, latitude, longitude), oldest first; availability maps
+        # each known driver to is_available, and pings for other drivers are dropped
+        latest = {}
+        for driver_id, timestamp, latitude, longitude in pings:
+            if driver_id in availability:
+                location_trails.append(driver_id, timestamp, latitude, longitude)
+                latest[driver_id] = (latitude, longitude)
+        with self._lock:
+            self._pending.update(latest)
+        for driver_id, (latitude, longitude) in latest.items():
+            driver_index.update(driver_id, latitude, longitude, availability[driver_id])
+            surge_engine.record_driver(driver_id, latitude, longitude, availability[driver_id])
+        self._ensure_flusher()
+    
+    def flush(self):
+        # Returns the number of Driver rows written
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        drivers = [
+            Driver(id=driver_id, current_latitude=latitude, current_longitude=longitude)
+            for driver_id, (latitude, longitude) in pending.items()
+        ]
+        try:
+            Driver.objects.bulk_update(drivers, ['current_latitude', 'current_longitude'], batch_size=self.batch_size)
+        except Exception:
+            # Put them back unless a newer ping arrived meanwhile
+            with self._lock:
+                for driver_id, position in pending.items():
+                    self._pending.setdefault(driver_id, position)
+            raise
+        return len(drivers)
+    
+    def _ensure_flusher(self):
+        if self._flusher is None:
+            with self._lock:
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target=self._run, daemon=True)
+                    self._flusher.start()
+                    atexit.register(self.flush)
+                    atexit.register(location_trails.flush, force=True)
+    
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+                location_trails.flush()
+            except Exception:
+                logger.exception("Failed to flush driver positions")
+            finally:
+                # Don't hold a connection open between flushes
+                connection.close()
+
+driver_positions = DriverPositionStore()
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from users.models import Driver
+from users.services import driver_rating_service
+
+class Command(BaseCommand):
+    help = 'Rebuild the Driver rating aggregates from the ratings of completed rides'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200)
+    
+    def handle(self, *args, **options):
+        # One short transaction per batch of drivers, so location updates and earnings
+        # credits only ever wait on the batch being rebuilt
+        batch_size = options['batch_size']
+        driver_ids = list(Driver.objects.order_by('id').values_list('id', flat=True))
+        rated = 0
+        for start in range(0, len(driver_ids), batch_size):
+            rated += driver_rating_service.rebuild(driver_ids[start:start + batch_size])
+        
+        self.stdout.write(self.style.SUCCESS(f'Backfilled ratings for {rated} rated driver(s) out of {len(driver_ids)}'))
@@ -0,0 +1,46 @@
+import time
+from collections import defaultdict
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from users.models import Driver, LedgerEntry
+
+class Command(BaseCommand):
+    help = 'Fold pending driver ledger entries into Driver.earnings'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--interval', type=float, help='Keep running, rolling up every INTERVAL seconds')
+    
+    def handle(self, *args, **options):
+        while True:
+            rolled_up = 0
+            while True:
+                count = self.rollup_batch(options['batch_size'])
+                rolled_up += count
+                if count < options['batch_size']:
+                    break
+            self.stdout.write(f'Rolled up {rolled_up} ledger entries')
+            
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
+    
+    def rollup_batch(self, batch_size):
+        with transaction.atomic():
+            # skip_locked lets several rollup workers run side by side
+            entries = list(
+                LedgerEntry.objects.select_for_update(skip_locked=True)
+                .filter(rolled_up=False)
+                .order_by('id')
+                .values_list('id', 'driver_id', 'amount')[:batch_size]
+            )
+            totals = defaultdict(int)
+            for _, driver_id, amount in entries:
+                totals[driver_id] += amount
+            
+            # One write per driver per batch, in id order so concurrent rollups can't deadlock
+            for driver_id in sorted(totals):
+                Driver.objects.filter(id=driver_id).update(earnings=F('earnings') + totals[driver_id])
+            LedgerEntry.objects.filter(id__in=[entry_id for entry_id, _, _ in entries]).update(rolled_up=True)
+        return len(entries)
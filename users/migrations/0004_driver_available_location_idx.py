@@ -0,0 +1,20 @@
+# Generated by Django 4.2.7 on 2026-10-18 12:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0003_driver_earnings"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="driver",
+            index=models.Index(
+                fields=["is_available", "current_latitude", "current_longitude"],
+                name="driver_available_location_idx",
+            ),
+        ),
+    ]
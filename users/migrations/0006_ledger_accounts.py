@@ -0,0 +1,113 @@
+# Generated by Django 4.2.7 on 2026-10-18 12:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def record_opening_balances(apps, schema_editor):
+    # One credit per non-zero balance so each snapshot equals the sum of its entries
+    Passenger = apps.get_model("users", "Passenger")
+    Driver = apps.get_model("users", "Driver")
+    LedgerEntry = apps.get_model("users", "LedgerEntry")
+    entries = [
+        LedgerEntry(
+            account="PASSENGER_WALLET",
+            entry_type="CREDIT",
+            passenger_id=passenger_id,
+            amount=balance,
+            rolled_up=True,
+        )
+        for passenger_id, balance in Passenger.objects.exclude(
+            wallet_balance=0
+        ).values_list("id", "wallet_balance")
+    ]
+    entries += [
+        LedgerEntry(
+            account="DRIVER_EARNINGS",
+            entry_type="CREDIT",
+            driver_id=driver_id,
+            amount=earnings,
+            rolled_up=True,
+        )
+        for driver_id, earnings in Driver.objects.exclude(earnings=0).values_list(
+            "id", "earnings"
+        )
+    ]
+    LedgerEntry.objects.bulk_create(entries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("payments", "0001_initial"),
+        ("users", "0005_ledger_entry"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ledgerentry",
+            name="account",
+            field=models.CharField(
+                choices=[
+                    ("PASSENGER_WALLET", "Passenger Wallet"),
+                    ("DRIVER_EARNINGS", "Driver Earnings"),
+                ],
+                default="DRIVER_EARNINGS",
+                max_length=20,
+            ),
+        ),
+        migrations.AddField(
+            model_name="ledgerentry",
+            name="entry_type",
+            field=models.CharField(
+                choices=[("CREDIT", "Credit"), ("DEBIT", "Debit")],
+                default="CREDIT",
+                max_length=10,
+            ),
+        ),
+        migrations.AddField(
+            model_name="ledgerentry",
+            name="passenger",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="ledger_entries",
+                to="users.passenger",
+            ),
+        ),
+        migrations.AddField(
+            model_name="ledgerentry",
+            name="payment",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                to="payments.payment",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="ledgerentry",
+            name="driver",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="ledger_entries",
+                to="users.driver",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="ledgerentry",
+            index=models.Index(
+                fields=["driver", "created_at"], name="ledger_driver_time_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="ledgerentry",
+            index=models.Index(
+                fields=["passenger", "created_at"], name="ledger_passenger_time_idx"
+            ),
+        ),
+        migrations.RunPython(record_opening_balances, migrations.RunPython.noop),
+    ]
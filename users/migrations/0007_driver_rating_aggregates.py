@@ -0,0 +1,28 @@
+# Generated by Django 4.2.7 on 2026-10-18 12:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0006_ledger_accounts"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="driver",
+            name="rating_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="driver",
+            name="rating_sum",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="driver",
+            name="recent_rating",
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.2.7 on 2026-10-18 13:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0007_driver_rating_aggregates"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LocationSegment",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("started_at", models.DateTimeField()),
+                ("ended_at", models.DateTimeField()),
+                ("point_count", models.PositiveIntegerField()),
+                ("data", models.BinaryField()),
+                (
+                    "driver",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="location_segments",
+                        to="users.driver",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["driver", "started_at"],
+                        name="location_segment_driver_idx",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -22,8 +22,18 @@ class Driver(models.Model):
     current_latitude = models.FloatField(null=True, blank=True)
     current_longitude = models.FloatField(null=True, blank=True)
     rating = models.FloatField(default=5.0)
+    # Running rating aggregates maintained by rate_ride; `rating` is rating_sum / rating_count
+    # once the driver has been rated, and recent_rating an exponentially decayed average
+    rating_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.PositiveIntegerField(default=0)
+    recent_rating = models.FloatField(null=True, blank=True)
     earnings = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     
+    class Meta:
+        indexes = [
+            models.Index(fields=['is_available', 'current_latitude', 'current_longitude'], name='driver_available_location_idx'),
+        ]
+    
     def __str__(self):
         return f"Driver: {self.user.get_full_name()}"
 
@@ -34,4 +44,57 @@ class Passenger(models.Model):
     wallet_balance = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     
     def __str__(self):
-        return f"Passenger: {self.user.get_full_name()}"
\ No newline at end of file
+        return f"Passenger: {self.user.get_full_name()}"
+
+class LedgerEntry(models.Model):
+    # Append-only record of every wallet and earnings movement. Passenger.wallet_balance
+    # and Driver.earnings are balance snapshots maintained alongside it; batched driver
+    # credits stay pending until `rollup_driver_earnings` folds them in.
+    class Account(models.TextChoices):
+        PASSENGER_WALLET = 'PASSENGER_WALLET', 'Passenger Wallet'
+        DRIVER_EARNINGS = 'DRIVER_EARNINGS', 'Driver Earnings'
+    
+    class EntryType(models.TextChoices):
+        CREDIT = 'CREDIT', 'Credit'
+        DEBIT = 'DEBIT', 'Debit'
+    
+    account = models.CharField(max_length=20, choices=Account.choices, default=Account.DRIVER_EARNINGS)
+    entry_type = models.CharField(max_length=10, choices=EntryType.choices, default=EntryType.CREDIT)
+    passenger = models.ForeignKey(Passenger, on_delete=models.CASCADE, null=True, blank=True, related_name='ledger_entries')
+    driver = models.ForeignKey(Driver, on_delete=models.CASCADE, null=True, blank=True, related_name='ledger_entries')
+    ride = models.ForeignKey('rides.Ride', on_delete=models.SET_NULL, null=True, blank=True)
+    payment = models.ForeignKey('payments.Payment', on_delete=models.SET_NULL, null=True, blank=True)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    created_at = models.DateTimeField(auto_now_add=True)
+    rolled_up = models.BooleanField(default=False)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['driver'], condition=models.Q(rolled_up=False), name='ledger_pending_idx'),
+            models.Index(fields=['driver', 'created_at'], name='ledger_driver_time_idx'),
+            models.Index(fields=['passenger', 'created_at'], name='ledger_passenger_time_idx'),
+        ]
+    
+    @property
+    def signed_amount(self):
+        return self.amount if self.entry_type == self.EntryType.CREDIT else -self.amount
+    
+    def __str__(self):
+        return f"Ledger {self.id} - {self.entry_type} {self.amount}"
+
+class LocationSegment(models.Model):
+    # A driver's location pings over one time bucket, encoded by users/trails.py.
+    # Rows are only ever inserted; several may cover the same bucket.
+    driver = models.ForeignKey(Driver, on_delete=models.CASCADE, related_name='location_segments')
+    started_at = models.DateTimeField()
+    ended_at = models.DateTimeField()
+    point_count = models.PositiveIntegerField()
+    data = models.BinaryField()
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['driver', 'started_at'], name='location_segment_driver_idx'),
+        ]
+    
+    def __str__(self):
+        return f"Driver {self.driver_id} trail {self.started_at} - {self.ended_at}"
\ No newline at end of file
@@ -0,0 +1,47 @@
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.functional import SimpleLazyObject
+from .models import User
+
+ROLE_RELATIONS = ('passenger', 'driver')
+
+def load_roles(user):
+    # Makes user.passenger and user.driver answer without queries: free if the user was
+    # loaded with select_related (see RoleJWTAuthentication), otherwise one query for both
+    relations = [User._meta.get_field(name) for name in ROLE_RELATIONS]
+    if not user.is_authenticated or all(relation.is_cached(user) for relation in relations):
+        return user
+    loaded = User.objects.select_related(*ROLE_RELATIONS).get(pk=user.pk)
+    return set_roles(user, **{name: getattr(loaded, name, None) for name in ROLE_RELATIONS})
+
+def set_roles(user, **profiles):
+    # Attaches the given profiles (or None) to the user and each profile back to the user
+    for name, profile in profiles.items():
+        relation = User._meta.get_field(name)
+        if profile is not None:
+            relation.field.set_cached_value(profile, user)
+        relation.set_cached_value(user, profile)
+    return user
+
+def load_fields(instance, *fields):
+    # Loads whichever of `fields` were deferred, in one query rather than one per attribute
+    deferred = instance.get_deferred_fields().intersection(fields)
+    if deferred:
+        instance.refresh_from_db(fields=deferred)
+    return instance
+
+def role_for(request, name):
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return None
+    return getattr(load_roles(user), name, None)
+
+class RoleMiddleware(MiddlewareMixin):
+    # Adds request.passenger and request.driver: the authenticated user's profiles, or None.
+    # Each is a SimpleLazyObject that resolves on first use, after DRF has authenticated
+    # the request. The attribute is always the proxy, never None itself: `request.driver is
+    # None` is False even for a passenger, so a check written that way lets every user
+    # through. Test them only by truthiness (`if request.driver:`, `if not
+    # request.passenger:`), which the proxy forwards to the resolved profile or None.
+    def process_request(self, request):
+        request.passenger = SimpleLazyObject(lambda: role_for(request, 'passenger'))
+        request.driver = SimpleLazyObject(lambda: role_for(request, 'driver'))
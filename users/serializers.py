@@ -1,3 +1,4 @@
+from decimal import Decimal
 from rest_framework import serializers
 from django.contrib.auth import authenticate
 from .models import User, Driver, Passenger
@@ -12,6 +13,14 @@ class UserResponseSerializer(serializers.ModelSerializer):
         model = User
         fields = ['id', 'email', 'first_name', 'last_name', 'phone', 'user_type', 'passenger_id', 'driver_id', 'wallet_balance']
     
+    def update(self, instance, validated_data):
+        # Writes only the edited columns. request.user may come from the auth cache, and a full
+        # save would write its cached copy of every other column back over newer values.
+        for field, value in validated_data.items():
+            setattr(instance, field, value)
+        instance.save(update_fields=list(validated_data))
+        return instance
+    
     def get_user_type(self, obj):
         if hasattr(obj, 'driver'):
             return 'driver'
@@ -85,4 +94,7 @@ class ForgotPasswordRequestSerializer(serializers.Serializer):
 
 class ResetPasswordRequestSerializer(serializers.Serializer):
     token = serializers.CharField()
-    new_password = serializers.CharField()
\ No newline at end of file
+    new_password = serializers.CharField()
+
+class FundWalletRequestSerializer(serializers.Serializer):
+    amount = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=Decimal('0.01'))
@@ -0,0 +1,118 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, FloatField, Sum, Value
+from django.db.models.functions import Cast, Coalesce
+from rides.models import Ride
+from .models import Driver, Passenger, LedgerEntry
+
+class LedgerService:
+    # Every movement appends a LedgerEntry and updates the matching balance snapshot
+    # in the same transaction, so snapshots always equal the sum of their entries
+    # (batched driver credits excepted until they are rolled up).
+    def credit_wallet(self, passenger_id, amount, payment=None):
+        with transaction.atomic():
+            LedgerEntry.objects.create(
+                account=LedgerEntry.Account.PASSENGER_WALLET, entry_type=LedgerEntry.EntryType.CREDIT,
+                passenger_id=passenger_id, payment=payment, amount=amount, rolled_up=True
+            )
+            Passenger.objects.filter(id=passenger_id).update(wallet_balance=F('wallet_balance') + amount)
+    
+    def debit_wallet(self, passenger_id, amount, ride=None, payment=None):
+        # Conditional debit; returns False without writing anything if funds are short
+        with transaction.atomic():
+            debited = Passenger.objects.filter(
+                id=passenger_id, wallet_balance__gte=amount
+            ).update(wallet_balance=F('wallet_balance') - amount)
+            if not debited:
+                return False
+            LedgerEntry.objects.create(
+                account=LedgerEntry.Account.PASSENGER_WALLET, entry_type=LedgerEntry.EntryType.DEBIT,
+                passenger_id=passenger_id, ride=ride, payment=payment, amount=amount, rolled_up=True
+            )
+            return True
+    
+    def credit_driver(self, driver_id, amount, ride=None):
+        with transaction.atomic():
+            batched = settings.DRIVER_EARNINGS_BATCHED
+            LedgerEntry.objects.create(
+                account=LedgerEntry.Account.DRIVER_EARNINGS, entry_type=LedgerEntry.EntryType.CREDIT,
+                driver_id=driver_id, ride=ride, amount=amount, rolled_up=not batched
+            )
+            if not batched:
+                Driver.objects.filter(id=driver_id).update(earnings=F('earnings') + amount)
+    
+    def pending_driver_earnings(self, driver_id):
+        return LedgerEntry.objects.filter(driver_id=driver_id, rolled_up=False).aggregate(total=Sum('amount'))['total'] or 0
+    
+    def driver_earnings_between(self, driver_id, start, end):
+        # Range scan on (driver, created_at); returns (total, number of credited rides)
+        totals = LedgerEntry.objects.filter(
+            driver_id=driver_id,
+            account=LedgerEntry.Account.DRIVER_EARNINGS,
+            entry_type=LedgerEntry.EntryType.CREDIT,
+            created_at__gte=start,
+            created_at__lt=end
+        ).aggregate(total=Sum('amount'), rides=Count('ride', distinct=True))
+        return totals['total'] or 0, totals['rides']
+
+ledger_service = LedgerService()
+
+class DriverRatingService:
+    # O(1) upkeep of the Driver rating aggregates with a single UPDATE, so the
+    # rating endpoint never has to average a driver's whole ride history
+    def __init__(self, decay=None):
+        self.decay = decay if decay is not None else settings.DRIVER_RATING_DECAY
+    
+    def apply(self, driver_id, rating, previous_rating=None):
+        # Call inside the transaction that stores the ride's new rating.
+        # A re-rating swaps the old score for the new one instead of counting twice.
+        count_delta = 0 if previous_rating is not None else 1
+        sum_delta = rating - (previous_rating or 0)
+        drivers = Driver.objects.filter(id=driver_id)
+        if previous_rating is None:
+            recent = Coalesce(F('recent_rating'), Value(float(rating))) * (1 - self.decay) + self.decay * rating
+        else:
+            # Exact when the re-rated ride was the driver's latest; close enough otherwise
+            recent = F('recent_rating') + self.decay * (rating - previous_rating)
+            # The old score must already be in the aggregates; it isn't for rides rated before
+            # they existed and not yet backfilled
+            drivers = drivers.filter(rating_count__gt=0, rating_sum__gte=previous_rating, recent_rating__isnull=False)
+        
+        if not drivers.update(
+            rating_count=F('rating_count') + count_delta,
+            rating_sum=F('rating_sum') + sum_delta,
+            # SET expressions all see the pre-update row
+            rating=Cast(F('rating_sum') + sum_delta, FloatField()) / (F('rating_count') + count_delta),
+            recent_rating=recent
+        ):
+            self.rebuild([driver_id])
+    
+    def rebuild(self, driver_ids):
+        # Recomputes the aggregates of the given drivers from their rated completed rides in
+        # one transaction; returns how many of them have been rated
+        with transaction.atomic():
+            # Lock the drivers before reading rides: a rating committed after the read
+            # waits for the lock and is then applied on top of the rebuilt aggregates
+            drivers = list(Driver.objects.select_for_update().filter(id__in=driver_ids).only('id'))
+            
+            # Oldest first per driver so the decayed average ends on the latest rating
+            aggregates = {}
+            rides = Ride.objects.filter(
+                status=Ride.RideStatus.COMPLETED, driver_id__in=driver_ids, rating__isnull=False
+            ).order_by('driver_id', 'dropoff_time', 'id').values_list('driver_id', 'rating')
+            for driver_id, rating in rides:
+                count, total, recent = aggregates.get(driver_id, (0, 0, None))
+                aggregates[driver_id] = (count + 1, total + rating, self.decay_step(recent, rating))
+            
+            for driver in drivers:
+                driver.rating_count, driver.rating_sum, driver.recent_rating = aggregates.get(driver.id, (0, 0, None))
+                # Unrated drivers keep the model default
+                driver.rating = driver.rating_sum / driver.rating_count if driver.rating_count else 5.0
+            Driver.objects.bulk_update(drivers, ['rating_count', 'rating_sum', 'recent_rating', 'rating'])
+        return len(aggregates)
+    
+    def decay_step(self, recent, rating):
+        # Python mirror of the recent_rating update in apply()
+        return float(rating) if recent is None else recent * (1 - self.decay) + self.decay * rating
+
+driver_rating_service = DriverRatingService()
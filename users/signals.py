@@ -0,0 +1,14 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .authentication import invalidate_user
+from .models import Driver, Passenger, User
+
+# Keep CachedJWTAuthentication from serving a user that was changed, deactivated or deleted
+@receiver([post_save, post_delete], sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    invalidate_user(instance.pk)
+
+@receiver([post_save, post_delete], sender=Driver)
+@receiver([post_save, post_delete], sender=Passenger)
+def invalidate_cached_profile_owner(sender, instance, **kwargs):
+    invalidate_user(instance.user_id)
@@ -0,0 +1,252 @@
+import random
+import threading
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+from unittest import mock
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, skipUnlessDBFeature
+from rest_framework_simplejwt.tokens import AccessToken
+from riderapp.testing import AuthenticatedTestCase, make_driver, make_passenger, make_user
+from rides.geo import driver_index
+from .authentication import CachedJWTAuthentication
+from .locations import driver_positions
+from .models import Driver, LedgerEntry, Passenger, User
+from .services import ledger_service
+from .trails import LocationTrailStore, decode_points, encode_points, to_fixed
+
+class RoleResolutionTests(AuthenticatedTestCase):
+    # request.passenger / request.driver come with the authenticated user, so role checks
+    # add no queries of their own. The default auth cache is per-process, so it isn't used:
+    # each request loads the user and both profiles in one query.
+    def setUp(self):
+        super().setUp()
+        self.passenger = make_passenger('passenger')
+        self.driver = make_driver('driver')
+    
+    def test_request_loads_user_and_roles_in_one_query(self):
+        self.login(self.passenger.user)
+        # The user joined to both profiles; the balance comes with the passenger row
+        for _ in range(2):
+            with self.assertNumQueries(1):
+                response = self.client.get(f'/api/users/passengers/{self.passenger.id}/wallet-balance/')
+            self.assertEqual(response.status_code, 200)
+    
+    def test_role_mismatch_is_rejected_without_queries(self):
+        self.login(self.driver.user)
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/api/users/passengers/{self.passenger.id}/wallet-balance/')
+        self.assertEqual(response.status_code, 404)
+        with self.assertNumQueries(1):
+            response = self.client.post('/api/rides/request/', {}, format='json')
+        self.assertEqual(response.status_code, 400)
+    
+    def test_profile_reports_roles_without_probe_queries(self):
+        self.login(self.driver.user)
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/users/profile/')
+        self.assertEqual(response.json()['user_type'], 'driver')
+        self.assertEqual(response.json()['driver_id'], self.driver.id)
+    
+    def test_changes_elsewhere_apply_immediately(self):
+        # Changed by another worker: no signal reaches this process
+        user = make_user('newcomer')
+        self.login(user)
+        self.assertIsNone(self.client.get('/api/users/profile/').json()['user_type'])
+        User.objects.filter(id=user.id).update(first_name='Renamed')
+        passenger = Passenger.objects.bulk_create([Passenger(user=user)])[0]
+        profile = self.client.get('/api/users/profile/').json()
+        self.assertEqual((profile['first_name'], profile['user_type'], profile['passenger_id']), ('Renamed', 'passenger', passenger.id))
+        
+        authenticator = CachedJWTAuthentication()
+        token = AccessToken.for_user(self.driver.user)
+        self.assertTrue(authenticator.get_user(token).driver.is_available)
+        Driver.objects.filter(id=self.driver.id).update(is_available=False)
+        self.assertFalse(authenticator.get_user(token).driver.is_available)
+        
+        User.objects.filter(id=user.id).update(is_active=False)
+        self.assertEqual(self.client.get('/api/users/profile/').status_code, 401)
+
+class SharedAuthCacheTests(AuthenticatedTestCase):
+    # With a cache all workers share, users and role ids are served from it. The test
+    # process is the only worker, so its locmem cache stands in for a shared one.
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('users.authentication.AUTH_CACHE_SHARED', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.passenger = make_passenger('passenger')
+        self.driver = make_driver('driver')
+    
+    def test_cached_request_checks_roles_without_queries(self):
+        self.login(self.passenger.user)
+        self.client.get(f'/api/users/passengers/{self.passenger.id}/wallet-balance/')
+        # Only the balance, which the cache never keeps
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/api/users/passengers/{self.passenger.id}/wallet-balance/')
+        self.assertEqual(response.status_code, 200)
+    
+    def test_role_mismatch_is_rejected_without_queries(self):
+        self.login(self.driver.user)
+        self.client.get('/api/users/profile/')
+        with self.assertNumQueries(0):
+            response = self.client.get(f'/api/users/passengers/{self.passenger.id}/wallet-balance/')
+        self.assertEqual(response.status_code, 404)
+        with self.assertNumQueries(0):
+            response = self.client.post('/api/rides/request/', {}, format='json')
+        self.assertEqual(response.status_code, 400)
+    
+    def test_saves_drop_the_cached_user(self):
+        self.login(self.driver.user)
+        self.client.get('/api/users/profile/')
+        self.driver.is_available = False
+        self.driver.save()
+        token = AccessToken.for_user(self.driver.user)
+        self.assertFalse(CachedJWTAuthentication().get_user(token).driver.is_available)
+        user = self.driver.user
+        user.is_active = False
+        user.save()
+        self.assertEqual(self.client.get('/api/users/profile/').status_code, 401)
+    
+    def test_profile_update_keeps_columns_changed_elsewhere(self):
+        self.login(self.passenger.user)
+        self.client.get('/api/users/profile/')
+        # Written without a signal: the cache still holds the old row
+        User.objects.filter(id=self.passenger.user_id).update(last_name='Elsewhere')
+        response = self.client.put('/api/users/profile/update/', {'first_name': 'New'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        user = User.objects.get(id=self.passenger.user_id)
+        self.assertEqual((user.first_name, user.last_name), ('New', 'Elsewhere'))
+
+@skipUnlessDBFeature('test_db_allows_multiple_connections')
+class ConcurrentWalletTests(TransactionTestCase):
+    threads = 8
+    
+    def test_debits_and_credits_lose_no_updates(self):
+        passenger = make_passenger('passenger', wallet_balance=Decimal('20.00'))
+        # More debits than the wallet can ever cover, interleaved with top-ups
+        operations = [('debit', Decimal('5.00'))] * 60 + [('credit', Decimal('2.50'))] * 40
+        start = threading.Barrier(self.threads)
+        debited = []
+        
+        def run(share):
+            try:
+                start.wait()
+                for kind, amount in share:
+                    if kind == 'credit':
+                        ledger_service.credit_wallet(passenger.id, amount)
+                    elif ledger_service.debit_wallet(passenger.id, amount):
+                        debited.append(amount)
+            finally:
+                connection.close()
+        
+        threads = [threading.Thread(target=run, args=(operations[n::self.threads],)) for n in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        passenger.refresh_from_db()
+        expected = Decimal('20.00') + 40 * Decimal('2.50') - sum(debited)
+        self.assertEqual(passenger.wallet_balance, expected)
+        self.assertGreaterEqual(passenger.wallet_balance, 0)
+        entries = LedgerEntry.objects.filter(passenger=passenger)
+        self.assertEqual(entries.filter(entry_type=LedgerEntry.EntryType.DEBIT).count(), len(debited))
+        self.assertEqual(sum(entry.signed_amount for entry in entries), expected - Decimal('20.00'))
+
+class FundWalletTests(AuthenticatedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.passenger = make_passenger('passenger', wallet_balance=Decimal('5.00'))
+        self.login(self.passenger.user)
+        self.url = f'/api/users/passengers/{self.passenger.id}/fund-wallet/'
+    
+    def test_funding_credits_the_wallet(self):
+        response = self.client.post(f'{self.url}?amount=12.50')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['balance'], 17.5)
+        self.assertEqual(LedgerEntry.objects.get(passenger=self.passenger).amount, Decimal('12.50'))
+    
+    def test_invalid_amounts_are_rejected(self):
+        for amount in ('', '0', '-10', 'ten', 'NaN', 'Infinity', '1.005', '1e9'):
+            response = self.client.post(f'{self.url}?amount={amount}')
+            self.assertEqual(response.status_code, 400, amount)
+        self.passenger.refresh_from_db()
+        self.assertEqual(self.passenger.wallet_balance, Decimal('5.00'))
+        self.assertFalse(LedgerEntry.objects.exists())
+
+class DriverLocationTests(AuthenticatedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.driver = make_driver('driver')
+        self.login(self.driver.user)
+        self.url = f'/api/users/drivers/{self.driver.id}/location/'
+        # Flushed by hand below rather than by the background thread
+        patcher = mock.patch.object(driver_positions, '_ensure_flusher')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(driver_index.remove, self.driver.id)
+    
+    def test_zero_coordinates_are_recorded(self):
+        response = self.client.put(self.url, {'latitude': 0.0, 'longitude': 0.0}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(driver_index.position(self.driver.id), (0.0, 0.0))
+        driver_positions.flush()
+        self.driver.refresh_from_db()
+        self.assertEqual((self.driver.current_latitude, self.driver.current_longitude), (0.0, 0.0))
+    
+    def test_invalid_coordinates_are_rejected(self):
+        for body in ({}, {'latitude': 51.5}, {'latitude': 'north', 'longitude': -0.1}, {'latitude': 91, 'longitude': 0}, {'latitude': 'nan', 'longitude': 0}):
+            response = self.client.put(self.url, body, format='json')
+            self.assertEqual(response.status_code, 400, body)
+        self.assertEqual(self.client.put(self.url, [51.5, -0.1], format='json').status_code, 400)
+        self.assertIsNone(driver_index.position(self.driver.id))
+
+class TrailEncodingTests(SimpleTestCase):
+    def assertRoundTrips(self, points):
+        self.assertEqual(decode_points(encode_points(points)), sorted(points))
+    
+    def test_random_walks_round_trip_exactly(self):
+        rng = random.Random(7)
+        for _ in range(50):
+            ts, lat, lng = rng.randrange(10**12, 2 * 10**12), rng.randrange(-90 * 10**6, 90 * 10**6), rng.randrange(-180 * 10**6, 180 * 10**6)
+            points = []
+            for _ in range(rng.randrange(1, 400)):
+                ts += rng.randrange(0, 10_000)
+                lat += rng.randrange(-500, 500)
+                lng += rng.randrange(-500, 500)
+                points.append((ts, lat, lng))
+            self.assertRoundTrips(points)
+    
+    def test_single_point(self):
+        self.assertRoundTrips([(1_700_000_000_000, 51_500_000, -100_000)])
+    
+    def test_unordered_duplicate_and_extreme_points(self):
+        # Pole to pole and across the antimeridian: the largest deltas a segment can hold
+        self.assertRoundTrips([
+            (1_700_000_120_000, 90_000_000, 180_000_000),
+            (1_700_000_000_000, -90_000_000, -180_000_000),
+            (1_700_000_060_000, 0, 0),
+            (1_700_000_060_000, 0, 0),
+        ])
+    
+    def test_fixed_point_keeps_microdegrees(self):
+        ts, lat, lng = decode_points(encode_points([to_fixed(1_700_000_000.123, 51.507351, -0.127758)]))[0]
+        self.assertEqual((ts, lat / 1e6, lng / 1e6), (1_700_000_000_123, 51.507351, -0.127758))
+
+class TrailStoreTests(TestCase):
+    def test_points_merge_stored_and_buffered_pings(self):
+        driver = make_driver('driver')
+        store = LocationTrailStore(segment_seconds=60, max_points=1000)
+        # The first 15 pings fill one 60 s bucket; the rest stay open
+        pings = [(1_699_999_980 + n * 4, 51.5 + n * 1e-4, -0.1 - n * 1e-4) for n in range(30)]
+        for ping in pings[:15]:
+            store.append(driver.id, *ping)
+        self.assertEqual(store.flush(now=1_700_000_040), 1)
+        for ping in pings[15:]:
+            store.append(driver.id, *ping)
+        
+        start, end = (datetime.fromtimestamp(ts, tz=dt_timezone.utc) for ts in (pings[0][0], pings[-1][0]))
+        expected = [(datetime.fromtimestamp(ts, tz=dt_timezone.utc), round(lat, 6), round(lng, 6)) for ts, lat, lng in pings]
+        self.assertEqual(store.points(driver.id, start, end), expected)
+        store.flush(force=True)
+        self.assertEqual(store.points(driver.id, start, end), expected)
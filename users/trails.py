@@ -0,0 +1,138 @@
+import math
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.conf import settings
+from rides.geo import haversine_km
+from .models import LocationSegment
+
+# Segment encoding: a header with the first point, then three columns (time in ms,
+# latitude and longitude in microdegrees) of int32 deltas from the previous point,
+# zlib-compressed. Consecutive GPS fixes differ by small amounts, so the deltas
+# are mostly tiny integers and compress well.
+HEADER = struct.Struct('<qiiI')
+
+def encode_points(points):
+    # points: (timestamp_ms, latitude_e6, longitude_e6) tuples
+    points = sorted(points)
+    first_ts, first_lat, first_lng = points[0]
+    columns = [array('i'), array('i'), array('i')]
+    previous = points[0]
+    for point in points[1:]:
+        for column, value, before in zip(columns, point, previous):
+            column.append(value - before)
+        previous = point
+    if sys.byteorder == 'big':
+        for column in columns:
+            column.byteswap()
+    body = b''.join(column.tobytes() for column in columns)
+    return HEADER.pack(first_ts, first_lat, first_lng, len(points)) + zlib.compress(body)
+
+def decode_points(data):
+    data = bytes(data)
+    first_ts, first_lat, first_lng, count = HEADER.unpack_from(data)
+    deltas = array('i')
+    deltas.frombytes(zlib.decompress(data[HEADER.size:]))
+    if sys.byteorder == 'big':
+        deltas.byteswap()
+    n = count - 1
+    points = [(first_ts, first_lat, first_lng)]
+    ts, lat, lng = first_ts, first_lat, first_lng
+    for i in range(n):
+        ts += deltas[i]
+        lat += deltas[n + i]
+        lng += deltas[2 * n + i]
+        points.append((ts, lat, lng))
+    return points
+
+def to_fixed(timestamp, latitude, longitude):
+    return int(timestamp * 1000), round(latitude * 1e6), round(longitude * 1e6)
+
+def _to_datetime(timestamp_ms):
+    return datetime.fromtimestamp(timestamp_ms / 1000, tz=dt_timezone.utc)
+
+# Append-only location history per driver. Pings collect in memory per time bucket;
+# once a bucket is over (or holds `max_points`) it is written as one immutable
+# LocationSegment row. Reads merge stored segments with this process's open buckets.
+class LocationTrailStore:
+    def __init__(self, segment_seconds=None, max_points=None):
+        self.segment_seconds = segment_seconds or settings.LOCATION_TRAIL_SEGMENT_SECONDS
+        self.max_points = max_points or settings.LOCATION_TRAIL_MAX_SEGMENT_POINTS
+        self._open = {}
+        self._closed = []
+        self._lock = threading.Lock()
+    
+    def append(self, driver_id, timestamp, latitude, longitude):
+        bucket = math.floor(timestamp / self.segment_seconds)
+        with self._lock:
+            current = self._open.get(driver_id)
+            if current is not None and (current[0] != bucket or len(current[1]) >= self.max_points):
+                self._closed.append((driver_id, current[1]))
+                current = None
+            if current is None:
+                current = self._open[driver_id] = (bucket, [])
+            current[1].append(to_fixed(timestamp, latitude, longitude))
+    
+    def flush(self, now=None, force=False):
+        # Writes finished segments (all of them when `force`); returns how many
+        now_bucket = math.floor((now if now is not None else time.time()) / self.segment_seconds)
+        with self._lock:
+            for driver_id, (bucket, points) in list(self._open.items()):
+                if force or bucket < now_bucket:
+                    self._closed.append((driver_id, points))
+                    del self._open[driver_id]
+            closed, self._closed = self._closed, []
+        if not closed:
+            return 0
+        try:
+            LocationSegment.objects.bulk_create([
+                LocationSegment(
+                    driver_id=driver_id,
+                    started_at=_to_datetime(min(points)[0]),
+                    ended_at=_to_datetime(max(points)[0]),
+                    point_count=len(points),
+                    data=encode_points(points)
+                )
+                for driver_id, points in closed
+            ], batch_size=500)
+        except Exception:
+            with self._lock:
+                self._closed[:0] = closed
+            raise
+        return len(closed)
+    
+    def points(self, driver_id, start, end):
+        # (datetime, latitude, longitude) for the driver between `start` and `end`, oldest first
+        start_ms, end_ms = int(start.timestamp() * 1000), int(end.timestamp() * 1000)
+        # A segment never spans more than one bucket, which bounds the scan on (driver, started_at)
+        segments = LocationSegment.objects.filter(
+            driver_id=driver_id,
+            started_at__gte=start - timedelta(seconds=self.segment_seconds),
+            started_at__lte=end,
+            ended_at__gte=start
+        ).values_list('data', flat=True)
+        fixed = [point for data in segments for point in decode_points(data)]
+        with self._lock:
+            current = self._open.get(driver_id)
+            fixed += current[1] if current else []
+            fixed += [point for closed_id, points in self._closed if closed_id == driver_id for point in points]
+        return [
+            (_to_datetime(ts), lat / 1e6, lng / 1e6)
+            for ts, lat, lng in sorted(set(fixed)) if start_ms <= ts <= end_ms
+        ]
+    
+    def distance_km(self, driver_id, start, end):
+        # Travelled distance along the trail, or None with fewer than two points
+        points = self.points(driver_id, start, end)
+        if len(points) < 2:
+            return None
+        return sum(
+            haversine_km(lat1, lng1, lat2, lng2)
+            for (_, lat1, lng1), (_, lat2, lng2) in zip(points, points[1:])
+        )
+
+location_trails = LocationTrailStore()
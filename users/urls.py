@@ -12,6 +12,8 @@ urlpatterns = [
     path('passengers/<int:passenger_id>/wallet-balance/', views.get_wallet_balance, name='get_wallet_balance'),
     path('passengers/<int:passenger_id>/fund-wallet/', views.fund_wallet, name='fund_wallet'),
     path('drivers/<int:driver_id>/earnings/', views.get_driver_earnings, name='get_driver_earnings'),
+    path('drivers/<int:driver_id>/earnings/report/', views.get_driver_earnings_report, name='get_driver_earnings_report'),
     path('drivers/<int:driver_id>/location/', views.update_driver_location, name='update_driver_location'),
+    path('drivers/locations/', views.update_driver_locations, name='update_driver_locations'),
     path('drivers/<int:driver_id>/rating/', views.get_driver_rating, name='get_driver_rating'),
 ]
\ No newline at end of file
@@ -3,9 +3,17 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework_simplejwt.tokens import RefreshToken
+import time
+from datetime import datetime
+from django.conf import settings
 from django.contrib.auth import authenticate
-from .models import User, Driver, Passenger
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from .models import User, Driver
 from .serializers import *
+from .locations import driver_positions
+from .roles import load_fields, load_roles
+from .services import ledger_service
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
@@ -45,6 +53,7 @@ def login(request):
         
         user = authenticate(username=email, password=password)
         if user:
+            load_roles(user)
             refresh = RefreshToken.for_user(user)
             return Response({
                 'user': UserResponseSerializer(user).data,
@@ -107,78 +116,142 @@ def reset_password(request):
 
 @api_view(['GET'])
 def get_wallet_balance(request, passenger_id):
-    try:
-        passenger = Passenger.objects.get(id=passenger_id, user=request.user)
-        return Response(float(passenger.wallet_balance))
-    except Passenger.DoesNotExist:
+    passenger = _own_passenger(request, passenger_id)
+    if passenger is None:
         return Response({'error': 'Passenger not found'}, status=status.HTTP_404_NOT_FOUND)
+    return Response(float(passenger.wallet_balance))
 
 @api_view(['POST'])
 def fund_wallet(request, passenger_id):
-    from decimal import Decimal
-    try:
-        passenger = Passenger.objects.get(id=passenger_id, user=request.user)
-        amount = Decimal(str(request.GET.get('amount', 0)))
-        passenger.wallet_balance += amount
-        passenger.save()
-        return Response({'balance': float(passenger.wallet_balance), 'message': 'Wallet funded successfully'})
-    except Passenger.DoesNotExist:
+    passenger = _own_passenger(request, passenger_id)
+    if passenger is None:
         return Response({'error': 'Passenger not found'}, status=status.HTTP_404_NOT_FOUND)
+    serializer = FundWalletRequestSerializer(data=request.GET)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    ledger_service.credit_wallet(passenger.id, serializer.validated_data['amount'])
+    passenger.refresh_from_db(fields=['wallet_balance'])
+    return Response({'balance': float(passenger.wallet_balance), 'message': 'Wallet funded successfully'})
+
+def _own_passenger(request, passenger_id):
+    if request.passenger and request.passenger.id == passenger_id:
+        return request.passenger
+    return None
+
+def _own_driver(request, driver_id):
+    # Accepts either the driver id or the user id (for frontend compatibility)
+    if request.driver and driver_id in (request.driver.id, request.user.id):
+        return request.driver
+    return None
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_driver_earnings(request, driver_id):
-    try:
-        # Try to find driver by driver_id first, then by user_id
-        try:
-            driver = Driver.objects.get(id=driver_id, user=request.user)
-        except Driver.DoesNotExist:
-            # If not found by driver_id, try finding by user_id (for frontend compatibility)
-            driver = Driver.objects.get(user_id=driver_id, user=request.user)
-        
-        return Response({'earnings': float(driver.earnings)}, status=status.HTTP_200_OK)
-    except Driver.DoesNotExist:
+    driver = _own_driver(request, driver_id)
+    if driver is None:
         return Response({'error': 'Driver not found'}, status=status.HTTP_404_NOT_FOUND)
+    
+    # Include ledger entries not yet rolled up into Driver.earnings
+    pending = ledger_service.pending_driver_earnings(driver.id)
+    return Response({'earnings': float(driver.earnings + pending)}, status=status.HTTP_200_OK)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_driver_earnings_report(request, driver_id):
+    driver = request.driver
+    if not driver or driver.id != driver_id:
+        return Response({'error': 'Driver not found'}, status=status.HTTP_404_NOT_FOUND)
+    
+    # Half-open [start, end) range of dates, e.g. ?start=2024-01-01&end=2024-02-01
+    try:
+        start, end = parse_date(request.GET.get('start', '')), parse_date(request.GET.get('end', ''))
+    except ValueError:
+        start = end = None
+    if start is None or end is None or start >= end:
+        return Response({'error': 'start and end must be dates with start before end'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    tz = timezone.get_current_timezone()
+    earnings, rides = ledger_service.driver_earnings_between(
+        driver.id,
+        datetime.combine(start, datetime.min.time(), tzinfo=tz),
+        datetime.combine(end, datetime.min.time(), tzinfo=tz)
+    )
+    return Response({'start': start, 'end': end, 'earnings': float(earnings), 'rides': rides})
 
 @api_view(['PUT'])
 @permission_classes([IsAuthenticated])
 def update_driver_location(request, driver_id):
-    try:
-        # Try to find driver by driver_id first, then by user_id
-        try:
-            driver = Driver.objects.get(id=driver_id, user=request.user)
-        except Driver.DoesNotExist:
-            driver = Driver.objects.get(user_id=driver_id, user=request.user)
-        
-        latitude = request.data.get('latitude')
-        longitude = request.data.get('longitude')
-        if latitude and longitude:
-            driver.current_latitude = latitude
-            driver.current_longitude = longitude
-            driver.save()
-        return Response({'message': 'Location updated successfully'})
-    except Driver.DoesNotExist:
+    driver = _own_driver(request, driver_id)
+    if driver is None:
         return Response({'error': 'Driver not found'}, status=status.HTTP_404_NOT_FOUND)
+    
+    try:
+        timestamp, latitude, longitude = _parse_ping(request.data, time.time())
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return Response({'error': 'A valid latitude and longitude are required'}, status=status.HTTP_400_BAD_REQUEST)
+    driver_positions.record(driver.id, latitude, longitude, driver.is_available, timestamp=timestamp)
+    return Response({'message': 'Location updated successfully'})
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def update_driver_locations(request):
+    # Batched pings, oldest first: {"pings": [{"latitude": .., "longitude": .., "timestamp": .., "driver_id": ..}]},
+    # timestamp in epoch seconds (defaults to now). Drivers send their own pings (driver_id
+    # optional); staff gateways may relay a whole fleet.
+    pings = request.data.get('pings') if isinstance(request.data, dict) else None
+    if not isinstance(pings, list) or not 0 < len(pings) <= settings.DRIVER_LOCATION_MAX_BATCH:
+        return Response({'error': f'pings must be a list of 1 to {settings.DRIVER_LOCATION_MAX_BATCH} locations'}, status=status.HTTP_400_BAD_REQUEST)
+    now = time.time()
+    try:
+        parsed = [(ping.get('driver_id'), *_parse_ping(ping, now)) for ping in pings]
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return Response({'error': 'Each ping needs a valid latitude, longitude and timestamp'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    if request.user.is_staff:
+        if any(ping[0] is None for ping in parsed):
+            return Response({'error': 'driver_id is required for every ping'}, status=status.HTTP_400_BAD_REQUEST)
+        driver_ids = {ping[0] for ping in parsed}
+        availability = dict(Driver.objects.filter(id__in=driver_ids).values_list('id', 'is_available'))
+    else:
+        driver = request.driver
+        if not driver:
+            return Response({'error': 'User is not a driver'}, status=status.HTTP_400_BAD_REQUEST)
+        if any(ping[0] not in (None, driver.id) for ping in parsed):
+            return Response({'error': 'Pings may only be sent for your own driver'}, status=status.HTTP_403_FORBIDDEN)
+        parsed = [(driver.id, *ping[1:]) for ping in parsed]
+        driver_ids = {driver.id}
+        availability = {driver.id: driver.is_available}
+    
+    driver_positions.record_pings(parsed, availability)
+    return Response({
+        'accepted': len(pings),
+        'drivers': len(availability),
+        'unknown_drivers': sorted(driver_ids - set(availability))
+    })
+
+def _parse_ping(ping, now):
+    latitude, longitude = float(ping['latitude']), float(ping['longitude'])
+    timestamp = float(ping.get('timestamp') or now)
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('Coordinates out of range')
+    # Allow for some clock skew, but nothing from the future or before the epoch
+    if not 0 < timestamp <= now + 60:
+        raise ValueError('Timestamp out of range')
+    return timestamp, latitude, longitude
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_driver_rating(request, driver_id):
-    from django.db.models import Avg
-    from rides.models import Ride
-    try:
-        # Try to find driver by driver_id first, then by user_id
-        try:
-            driver = Driver.objects.get(id=driver_id, user=request.user)
-        except Driver.DoesNotExist:
-            driver = Driver.objects.get(user_id=driver_id, user=request.user)
-        
-        # Calculate average rating from completed rides
-        avg_rating = Ride.objects.filter(
-            driver=driver, 
-            status='COMPLETED', 
-            rating__isnull=False
-        ).aggregate(Avg('rating'))['rating__avg']
-        
-        return Response({'rating': round(avg_rating, 1) if avg_rating else 0.0})
-    except Driver.DoesNotExist:
-        return Response({'error': 'Driver not found'}, status=status.HTTP_404_NOT_FOUND)
\ No newline at end of file
+    driver = _own_driver(request, driver_id)
+    if driver is None:
+        return Response({'error': 'Driver not found'}, status=status.HTTP_404_NOT_FOUND)
+    
+    # Aggregates are kept current by rate_ride (see `backfill_driver_ratings` for older rides)
+    load_fields(driver, 'rating_count', 'rating_sum', 'recent_rating')
+    if not driver.rating_count:
+        return Response({'rating': 0.0, 'recent_rating': 0.0, 'rating_count': 0})
+    return Response({
+        'rating': round(driver.rating_sum / driver.rating_count, 1),
+        'recent_rating': round(driver.recent_rating, 1),
+        'rating_count': driver.rating_count
+    })